@@ -1,61 +1,280 @@
-import re, torch
-from diffusers import DiffusionPipeline
+import os, math, time, zlib, sqlite3
+from concurrent.futures import as_completed
+from PIL import Image
+from core import config
+from core.flyer_ir import FlyerIR, build_flyer_ir, set_image_slot, serialize_flyer, image_footprint
 from core.state import FlyerState
-from utils.helpers import save_image_locally, inject_images_for_preview, get_position_coordinates, save_html
+from core.tracing import span, record_span
+from models.diffusion_model import get_pipeline_registry, make_generator
+from models.diffusion_scheduler import get_diffusion_scheduler
+from utils.assets import save_display_asset
+from utils.image_cache import get_image_cache, image_cache_key
+from utils.prompt_index import get_prompt_index, theme_scope
+from utils.helpers import save_job_image, inject_images_for_preview, save_html
 
-# Assuming pipe is defined globally or within a class/factory
-pipe = DiffusionPipeline.from_pretrained(
-    "runwayml/stable-diffusion-v1-5",
-    torch_dtype=torch.float16,
-    use_safetensors=True
-)
-pipe.to("cuda")
 
+# -------------------------------
+# Diffusion job helpers
+# -------------------------------
+_SIZE_STEP = 64  # Multiple of the VAE factor (8); coarse enough that similar footprints still batch together
+_REFERENCE_AREA = 512 * 512  # Resolution the configured step count is tuned for
 
-def image_generator_node(state: FlyerState) -> FlyerState:
+
+def generation_size(size, canvas: tuple = None) -> tuple:
+    """
+    (width, height, steps) for an image from its rendered footprint on the flyer canvas: small sub-images
+    generate at lower resolution with fewer steps, full-bleed backgrounds follow the canvas aspect ratio.
+    Returns (None, None, DIFFUSION_STEPS), i.e. the pipeline default, when resolution-aware sizing is off.
+    """
+    if not config.DIFFUSION_RESOLUTION_AWARE:
+        return None, None, config.DIFFUSION_STEPS
+    width, height = image_footprint(size, *(canvas or (FlyerIR.width, FlyerIR.height)))
+    width, height = width * config.DIFFUSION_RENDER_SCALE, height * config.DIFFUSION_RENDER_SCALE
+    # Scale up to the minimum side, then down to the maximum side, keeping the aspect ratio
+    factor = min(max(config.DIFFUSION_MIN_SIDE / min(width, height), 1.0),
+                 config.DIFFUSION_MAX_SIDE / max(width, height))
+    snap = lambda v: max(_SIZE_STEP, int(round(v * factor / _SIZE_STEP)) * _SIZE_STEP)
+    width, height = snap(width), snap(height)
+    # Fewer pixels need fewer denoising steps; never more than the configured count
+    steps = round(config.DIFFUSION_STEPS * min(1.0, math.sqrt(width * height / _REFERENCE_AREA)))
+    return width, height, max(min(config.DIFFUSION_MIN_STEPS, config.DIFFUSION_STEPS), steps)
+
+
+def build_image_job(idx: int, img_data: dict, tone: str = "elegant", canvas: tuple = None) -> dict:
+    """Turn one theme_json["images"] entry into a diffusion job (prompt, seed and generation size)."""
+    # We now have access to border_radius in images_meta, but we only store core generation data here.
+    desc = img_data.get("description", f"Flyer image {idx + 1}")
+    prompt = f"{desc}, professional high-end flyer, luxurious texture, {tone}"
+    # Prompt-derived seeds keep repeated descriptions reproducible (and cacheable)
+    seed = config.DIFFUSION_SEED + idx if config.DIFFUSION_SEED >= 0 else zlib.crc32(prompt.encode("utf-8"))
+    width, height, steps = generation_size(img_data.get("size", "40%"), canvas)
+    return {
+        "index": idx,
+        "description": desc,
+        "prompt": prompt,
+        "pos": img_data.get("position", "center"),
+        "size": img_data.get("size", "40%"),
+        "layer": img_data.get("layer", "foreground"),
+        "seed": seed,
+        "height": height,
+        "width": width,
+        "steps": steps,
+        "guidance_scale": config.DIFFUSION_GUIDANCE_SCALE,
+    }
+
+
+def flyer_canvas(state: FlyerState) -> tuple:
+    if not state.flyer_ir:
+        return FlyerIR.width, FlyerIR.height
+    return state.flyer_ir.get("width", FlyerIR.width), state.flyer_ir.get("height", FlyerIR.height)
+
+
+def build_image_jobs(state: FlyerState) -> list:
+    tone = state.theme_json.get('theme', {}).get('tone', 'elegant')
+    canvas = flyer_canvas(state)
+    return [build_image_job(idx, img_data, tone, canvas)
+            for idx, img_data in enumerate(state.theme_json.get("images", []))]
+
+
+def image_job_batch_key(job: dict) -> tuple:
+    """Jobs with the same key can share one pipeline call (same resolution, steps and guidance)."""
+    return job["height"], job["width"], job["steps"], job["guidance_scale"]
+
+
+def group_image_jobs(jobs: list, max_batch_size: int = None) -> list:
+    """Group jobs that can share one pipeline call (same resolution, steps and guidance)."""
+    max_batch_size = max(1, max_batch_size or config.DIFFUSION_MAX_BATCH_SIZE)
+    groups = {}
+    for job in jobs:
+        groups.setdefault(image_job_batch_key(job), []).append(job)
+    batches = []
+    for group in groups.values():
+        for i in range(0, len(group), max_batch_size):
+            batches.append(group[i:i + max_batch_size])
+    return batches
+
+
+def job_cache_key(job: dict, model_id: str) -> str:
+    return image_cache_key(job["prompt"], model_id, job["steps"], job["guidance_scale"], job["seed"],
+                           job["height"], job["width"])
+
+
+def run_diffusion_batch(pipe, device: str, batch: list) -> list:
+    """Run one pipeline call for a batch of jobs. Returns [(job, image_or_exception), ...]."""
+    first = batch[0]
+    kwargs = {"num_inference_steps": first["steps"], "guidance_scale": first["guidance_scale"]}
+    if first["height"] and first["width"]:
+        kwargs.update(height=first["height"], width=first["width"])
     try:
-        images_meta = state.theme_json.get("images", [])
-        generated_images = []
-
-        for idx, img_data in enumerate(images_meta):
-            # We now have access to border_radius in images_meta, but we only store core generation data here.
-            desc = img_data.get("description", f"Flyer image {idx + 1}")
-            pos = img_data.get("position", "center")
-            size = img_data.get("size", "40%")
-            layer = img_data.get("layer", "foreground")
-            state.log(f"🖼️ Generating image {idx + 1}: {desc}")
+        images = pipe(prompt=[job["prompt"] for job in batch],
+                      generator=[make_generator(device, job["seed"]) for job in batch], **kwargs).images
+        return list(zip(batch, images))
+    except Exception as e:
+        if len(batch) == 1:
+            return [(first, e)]
+    # Error isolation: retry one by one so a single bad prompt does not fail the whole batch
+    results = []
+    for job in batch:
+        results.extend(run_diffusion_batch(pipe, device, [job]))
+    return results
+
+
+def run_diffusion_jobs(pipe, device: str, jobs: list, batched: bool = None, on_result=None) -> list:
+    batched = config.DIFFUSION_BATCHED if batched is None else batched
+    batches = group_image_jobs(jobs) if batched else [[job] for job in jobs]
+    results = []
+    for batch in batches:
+        for job, outcome in run_diffusion_batch(pipe, device, batch):
+            results.append((job, outcome))
+            if on_result: on_result(job, outcome)
+    return sorted(results, key=lambda r: r[0]["index"])
+
+
+# -------------------------------
+# Image generation stages
+# -------------------------------
+def generate_images(state: FlyerState, jobs: list, saved: dict = None) -> dict:
+    """Serve jobs from the image cache or diffusion and save them. Returns {index: generated image entry}."""
+    registry = get_pipeline_registry()
+    cache = get_image_cache()
+    saved = {} if saved is None else saved
+    started = {}  # job index -> perf_counter when its diffusion request was issued
+
+    def save_result(job, img):
+        with span(state, "file.save", artifact="image", index=job["index"]) as sp:
+            original = save_job_image(state, img, job["index"])
+            sp["attributes"]["path"] = original
+        path = original
+        if config.ASSET_OPTIMIZATION_ENABLED:
+            # The flyer references a copy sized for its slot; the full-resolution PNG stays for export
+            with span(state, "asset.optimize", index=job["index"], format=config.ASSET_FORMAT) as sp:
+                path = save_display_asset(state, img, job["index"], job["size"], flyer_canvas(state))
+                sp["attributes"].update(original_bytes=os.path.getsize(original), asset_bytes=os.path.getsize(path))
+        saved[job["index"]] = {"index": job["index"], "path": path, "original_path": original, "pos": job["pos"],
+                               "size": job["size"], "layer": job["layer"], "seed": job["seed"]}
+        state.log(f"✅ Image {job['index'] + 1} saved: {path}")
+
+    def on_result(job, outcome):
+        record_span(state, "diffusion.image", time.perf_counter() - started[job["index"]], index=job["index"],
+                    resolution=f"{job['width']}x{job['height']}" if job["width"] else "model default",
+                    steps=job["steps"], seed=job["seed"], cache_hit=False, ok=not isinstance(outcome, Exception))
+        if isinstance(outcome, Exception):
+            state.log(f"❌ Error generating image {job['index'] + 1}: {outcome}")
+            return
+        if cache:
             try:
-                img = pipe(
-                    f"{desc}, professional high-end flyer, luxurious texture, {state.theme_json.get('theme', {}).get('tone', 'elegant')}",
-                    num_inference_steps=25, guidance_scale=7.5).images[0]
-                path = save_image_locally(img, idx)
-                generated_images.append({"path": path, "pos": pos, "size": size, "layer": layer})
-                state.log(f"✅ Image {idx + 1} saved: {path}")
-                if torch.cuda.is_available(): torch.cuda.empty_cache()
+                cache.put(job_cache_key(job, registry.model_id), outcome)
             except Exception as e:
-                state.log(f"❌ Error generating image {idx + 1}: {e}")
-
-        state.generated_images = generated_images
-
-        # Insert placeholders if missing
-        html = state.html_output or ""
-        for idx in range(len(generated_images)):
-            placeholder = f""
-            if placeholder not in html:
-                div_match = re.search(r'(<div[^>]*>)', html)
-                if div_match:
-                    insert_pos = div_match.end()
-                    html = html[:insert_pos] + placeholder + html[insert_pos:]
-                else:
-                    html += placeholder
-
-        state.html_final = html
+                state.log(f"⚠️ Could not cache image {job['index'] + 1}: {e}")
+        save_result(job, outcome)
+
+    # A reused near-duplicate theme yields the same jobs, so that flyer's full-resolution images fit as-is
+    reusable = ({img["index"]: img.get("original_path") or img["path"] for img in state.warm_start.get("images", [])}
+                if state.warm_start.get("reused") else {})
+
+    # Cache hits skip diffusion entirely
+    pending = []
+    for job in jobs:
+        source = reusable.get(job["index"])
+        if source and os.path.exists(source):
+            with span(state, "image.reuse", index=job["index"], source_job=state.warm_start.get("job_id")):
+                with Image.open(source) as img:
+                    img.load()
+            state.log(f"♻️ Image {job['index'] + 1} reused from the near-duplicate flyer: {job['description']}")
+            save_result(job, img)
+            continue
+        with span(state, "image.cache_get", index=job["index"], enabled=cache is not None) as sp:
+            cached = cache.get(job_cache_key(job, registry.model_id)) if cache else None
+            sp["attributes"]["cache_hit"] = cached is not None
+        if cached is not None:
+            state.log(f"♻️ Image {job['index'] + 1} served from cache: {job['description']}")
+            save_result(job, cached)
+        else:
+            pending.append(job)
+
+    # Concurrent flyers in this process share pipeline calls through the micro-batching scheduler
+    if pending and config.DIFFUSION_SCHEDULER_ENABLED and config.DIFFUSION_BATCHED:
+        scheduler = get_diffusion_scheduler(registry, run_diffusion_batch, image_job_batch_key)
+        start = time.perf_counter()
+        futures = {}
+        for job in pending:
+            state.log(f"🖼️ Generating image {job['index'] + 1}: {job['description']}")
+            started[job["index"]] = time.perf_counter()
+            futures[scheduler.submit(job)] = job
+        for future in as_completed(futures):
+            on_result(futures[future], future.result())
+        if cache: cache.record_generation(time.perf_counter() - start, len(pending))
+        sched_stats = scheduler.stats()
+        state.log(f"🧮 Diffusion scheduler: mean batch {sched_stats['mean_batch_size']}, queue wait "
+                  f"p95 {sched_stats['queue_wait_ms_p95']} ms over {sched_stats['batches']} batches")
+
+    # The pipeline is loaded lazily on first use and kept warm by the registry between flyers
+    elif pending:
+        with registry.acquire() as pipe:
+            stats = registry.stats()
+            state.log(f"🧠 Diffusion pipeline ready on {stats['device']} (load {stats['load_seconds']:.1f}s, "
+                      f"{', '.join(stats['optimizations'])})")
+            for job in pending:
+                state.log(f"🖼️ Generating image {job['index'] + 1}: {job['description']}")
+            with registry.run_lock:
+                start = time.perf_counter()
+                started.update((job["index"], start) for job in pending)
+                run_diffusion_jobs(pipe, registry.device, pending, on_result=on_result)
+            if cache: cache.record_generation(time.perf_counter() - start, len(pending))
+    if cache:
+        cache_stats = cache.stats()
+        state.log(f"📦 Image cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses, "
+                  f"~{cache_stats['saved_seconds_estimate']}s diffusion saved")
+    return saved
+
+
+def finalize_images(state: FlyerState, saved: dict) -> FlyerState:
+    """Record generated images on the state, build html_final and save the original preview."""
+    # Keep generated_images in theme order (batches can complete out of order)
+    generated_images = [saved[idx] for idx in sorted(saved)]
+    state.generated_images = generated_images
+
+    # Fill the image slots of the flyer IR and serialize once (no per-image string splicing)
+    if state.flyer_ir or "error" not in state.theme_json:
+        ir = FlyerIR.from_dict(state.flyer_ir) if state.flyer_ir else build_flyer_ir(state.theme_json)
+        for img in generated_images:
+            set_image_slot(ir, img["index"], img["path"])
+        state.flyer_ir = ir.to_dict()
+        state.html_final = serialize_flyer(ir)
+    else:
+        state.html_final = state.html_output or ""
+    with span(state, "preview.inject", html_bytes=len(state.html_final)) as sp:
         preview_html = inject_images_for_preview(state.html_final)
+        sp["attributes"]["preview_bytes"] = len(preview_html or "")
 
-        # 💡 FIX for File Saving (Problem 3): Use content_override
+    # 💡 FIX for File Saving (Problem 3): Use content_override
+    with span(state, "file.save", artifact="flyer_original.html"):
         save_path = save_html(state, filename="flyer_original.html", content_override=preview_html)
-        state.log(f"💾 HTML with image placeholders saved to: {save_path}")
+    state.log(f"💾 Original flyer HTML saved to: {save_path}")
+    remember_flyer(state)
+    return state
+
+
+def remember_flyer(state: FlyerState):
+    """Index this prompt's theme and images for near-duplicate lookups (a reused theme is already indexed)."""
+    index = None if state.bypass_cache or state.warm_start.get("reused") else get_prompt_index()
+    if index is None or not state.theme_json or "error" in state.theme_json or not state.user_prompt.strip():
+        return
+    try:
+        index.add(state.user_prompt.strip(), theme_scope(state.theme_model or config.ACTIVE_MODEL), state.theme_json,
+                  state.generated_images, state.job_id)
+    except sqlite3.Error as e:
+        state.log(f"⚠️ Could not index prompt for near-duplicate lookups: {e}")
+
+
+# -------------------------------
+# Image Generator Node
+# -------------------------------
+def image_generator_node(state: FlyerState) -> FlyerState:
+    try:
+        saved = generate_images(state, build_image_jobs(state))
+        finalize_images(state, saved)
     except Exception as e:
         state.log(f"❌ [image_generator_node] Critical error: {e}")
 
-    return state
\ No newline at end of file
+    return state
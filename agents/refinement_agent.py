@@ -1,19 +1,25 @@
-import re, json
+import re, time
+from core import config
 from core.state import FlyerState
-from utils.helpers import inject_images_for_preview, get_position_coordinates, save_html, parse_size
-from models.llm_model import initialize_llm
-from utils.prompt_utils import refinement_prompt
+from core.tracing import span
+from core.flyer_ir import FlyerIR, apply_style_edits, reconcile_image_tags, serialize_flyer, set_image_slot
+from utils.assets import display_image_path
+from utils.helpers import inject_images_for_preview, save_html, image_path, images_folder, html_structure_similarity
+from models.llm_model import estimate_tokens
+from models.llm_router import invoke_routed, flyer_complexity, record_routing
+from utils.json_utils import parse_llm_json
+from utils.prompt_utils import refinement_prompt, refinement_patch_prompt
 
-model = initialize_llm()
 
-
-def build_images_metadata(state: FlyerState) -> str:
+def build_images_metadata(state: FlyerState, images: list = None) -> str:
     metadata = []
     # Include border_radius in the metadata sent to the LLM for context
     theme_images_meta = state.theme_json.get("images", [])
+    images = getattr(state, "generated_images", []) if images is None else images
 
-    for idx, img in enumerate(getattr(state, "generated_images", [])):
+    for idx, img in enumerate(images):
         # Try to get border_radius from the original theme JSON
+        idx = img.get("index", idx)
         current_img_meta = theme_images_meta[idx] if idx < len(theme_images_meta) else {}
         radius = current_img_meta.get("border_radius", "10px")
 
@@ -22,61 +28,211 @@ def build_images_metadata(state: FlyerState) -> str:
     return "\n".join(metadata)
 
 
-def refinement_node(state: FlyerState) -> FlyerState:
-    state.log(
-        f"[refinement_node] Iteration {state.iteration_count} — sending HTML and images to LLM for high-end review.")
-    images_meta_str = build_images_metadata(state)
-    prompt = refinement_prompt.replace("{html_final}", state.html_final)
-
-    # 💡 Send the structured image metadata for better LLM context
-    prompt += f"\n\nImages (DO NOT change these assets):\n{images_meta_str}\n\nRefine HTML for optimal harmony, readability, and visual impact."
-
-    try:
-        response = model.invoke(prompt)
-        result_text = getattr(response, "content", str(response)).strip()
-        json_match = re.search(r"\{.*\}", result_text, re.DOTALL)
-        if json_match:
-            result = json.loads(json_match.group(0))
-            state.evaluation_json = result
-            refined_html = result.get("edited_html")
-            state.html_refined = refined_html if refined_html and len(refined_html) > 100 else state.html_final
-        else:
-            state.evaluation_json = {"judgment": "Could not parse LLM JSON. Check LLM output format."}
-            state.html_refined = state.html_final
-    except Exception as e:
-        state.evaluation_json = {"judgment": f"Critical LLM Error: {e}"}
-        state.html_refined = state.html_final
-        state.log(f"❌ Refinement failed: {e}")
-
-    # Inject images
-    if state.html_refined and getattr(state, "generated_images", None):
-        html = state.html_refined
-        theme_images_meta = state.theme_json.get("images", [])  # Get dynamic shape data
+def planned_images_metadata(state: FlyerState) -> list:
+    """Image entries as image_generator_node will record them; known as soon as theme_json exists."""
+    planned_path = display_image_path if config.ASSET_OPTIMIZATION_ENABLED else image_path
+    return [{"index": idx, "path": planned_path(idx, images_folder(state)), "pos": img.get("position", "center"),
+             "size": img.get("size", "40%"), "layer": img.get("layer", "foreground")}
+            for idx, img in enumerate(state.theme_json.get("images", []))]
 
-        for idx, img in enumerate(state.generated_images):
-            x, y = get_position_coordinates(img.get("pos", "center"))
-            z_index = 0 if img.get("layer", "foreground") == "background" else 2
-            size = parse_size(img.get("size", "40%"))
 
-            # 💡 FIX for Dynamic Shapes (Problem 1): Read the border_radius from theme_json
-            current_img_meta = theme_images_meta[idx] if idx < len(theme_images_meta) else {}
-            border_radius = current_img_meta.get("border_radius", "10px")  # Default is 10px
+def refinement_mode(state: FlyerState = None) -> str:
+    """Patch mode needs the flyer IR; states without one (e.g. old checkpoints) fall back to full HTML."""
+    if config.REFINEMENT_MODE == "patch" and (state is None or state.flyer_ir):
+        return "patch"
+    return "html"
 
-            # The z-index is set to 1 for the background image, and 2 for foreground images/shapes
-            z_index = 1 if '100%' in str(size) and 'background' in img.get("layer", "").lower() else 2
 
-            img_tag = f'<img src="{img["path"]}" style="position:absolute;top:{y}%;left:{x}%;width:{size};height:{size};transform:translate(-50%,-50%);z-index:{z_index};pointer-events:none;border-radius:{border_radius};object-fit:cover;"/>'
-            placeholder = f""
+def build_refinement_prompt(html_final: str, images_meta_str: str, mode: str = "html") -> str:
+    if mode == "patch":
+        return refinement_patch_prompt.replace("{html_final}", html_final).replace("{images_meta_str}", images_meta_str)
 
-            # Replace placeholder or append img tag if not found
-            html = html.replace(placeholder, img_tag) if placeholder in html else html + img_tag
+    prompt = refinement_prompt.replace("{html_final}", html_final)
 
-        state.html_refined = html
-        preview_html = inject_images_for_preview(html)
+    # 💡 Send the structured image metadata for better LLM context
+    prompt += f"\n\nImages (DO NOT change these assets):\n{images_meta_str}\n\nRefine HTML for optimal harmony, readability, and visual impact."
+    return prompt
+
+
+REFINEMENT_SCHEMA = {"judgment": str}
+
+
+def parse_refinement_response(result_text: str, mode: str = "html", reask=None) -> tuple:
+    """
+    (evaluation_json, refined_html or None). In patch mode the edits stay in evaluation_json["edits"].
+    Repairs and re-asks needed to recover the JSON are recorded in evaluation_json["json_recovery"].
+    """
+    result, report = parse_llm_json(result_text, REFINEMENT_SCHEMA, reask)
+    if report["repairs"] or report["reasks"]:
+        result["json_recovery"] = report
+    if mode == "patch":
+        if not isinstance(result.get("edits"), list): result["edits"] = []
+        return result, None
+    refined_html = result.get("edited_html")
+    return result, refined_html if refined_html and len(refined_html) > 100 else None
+
+
+def request_refinement(html_final: str, images_meta_str: str, mode: str = "html") -> tuple:
+    """
+    LLM half of the refinement step. Takes plain inputs only (no state) so it can run
+    on a worker thread while diffusion is still mutating the state.
+    Returns (evaluation_json, refined_html or None, error or None).
+    """
+    prompt = build_refinement_prompt(html_final, images_meta_str, mode)
+    # Routing decisions travel in evaluation_json["llm_routing"]; apply_refinement moves them to the state
+    decisions = []
+    try:
+        evaluation_json, refined_html = invoke_routed(
+            "refine", prompt, lambda raw, reask: parse_refinement_response(raw, mode, reask),
+            flyer_complexity(html_final), decisions)
+        evaluation_json["llm_routing"] = decisions
+        return evaluation_json, refined_html, None
+    except Exception as e:
+        return {"judgment": f"Critical LLM Error: {e}", "llm_routing": decisions}, None, e
+
+
+def refinement_call_attributes(evaluation_json: dict, prompt_tokens: int) -> dict:
+    """Span attributes of one refinement request, summed over its routed attempts (escalations included)."""
+    routing = evaluation_json.get("llm_routing") or []
+    return {"model": routing[-1]["model"] if routing else None, "tier": routing[-1]["tier"] if routing else None,
+            "escalated": len(routing) > 1,
+            "prompt_tokens": sum(d["prompt_tokens"] for d in routing) or prompt_tokens,
+            "completion_tokens": sum(d["completion_tokens"] for d in routing),
+            "reasks": sum(d.get("reasks", 0) for d in routing),
+            "tokens_estimated": not routing or any(d["tokens_estimated"] for d in routing)}
+
+
+def apply_refinement_edits(state: FlyerState, edits: list):
+    """Applies patch-mode style edits to the latest refined IR; returns the new HTML, or None if nothing applied."""
+    ir = FlyerIR.from_dict(state.flyer_ir_refined or state.flyer_ir)
+    with span(state, "refine.apply_edits", edits=len(edits) if isinstance(edits, list) else 0):
+        applied, rejected = apply_style_edits(ir, edits)
+    # Image sources always come from the image node's IR (the refined IR may predate finished images)
+    for el in FlyerIR.from_dict(state.flyer_ir).elements:
+        if el.kind == "image":
+            set_image_slot(ir, int(el.id.split("-")[1]), el.content)
+
+    state.evaluation_json["edits_applied"] = applied
+    state.evaluation_json["edits_rejected"] = rejected
+    state.log(f"🩹 Applied {applied} style edit(s)" + (f", rejected {len(rejected)}: {rejected[:3]}" if rejected else "."))
+    if not applied:
+        return None
+    state.flyer_ir_refined = ir.to_dict()
+    return serialize_flyer(ir)
+
+
+def apply_refinement(state: FlyerState, evaluation_json: dict, refined_html: str = None,
+                     error: Exception = None, duration_s: float = None, tokens_est: int = None) -> FlyerState:
+    previous_html = state.html_refined_base or state.html_final
+    record_routing(state, evaluation_json.pop("llm_routing", []))
+    state.evaluation_json = evaluation_json
+    if "edits" in evaluation_json and state.flyer_ir and not error:
+        refined_html = apply_refinement_edits(state, evaluation_json["edits"])
+    elif not refined_html and not error and "edited_html" in evaluation_json:
+        state.log("⚠️ Refined HTML was empty or truncated; keeping the previous version.")
+    state.html_refined = refined_html or previous_html
+    if error: state.log(f"❌ Refinement failed: {error}")
+
+    # Keep the refined HTML's <img> tags in sync with the IR's image slots (the LLM may drop,
+    # duplicate or reference images that failed to generate)
+    if state.html_refined and state.flyer_ir:
+        state.html_refined = reconcile_image_tags(state.html_refined, FlyerIR.from_dict(state.flyer_ir))
+    state.html_refined_base = state.html_refined
+    record_refinement_pass(state, previous_html, duration_s, tokens_est, error)
+
+    if state.html_refined:
+        with span(state, "preview.inject", html_bytes=len(state.html_refined)) as sp:
+            preview_html = inject_images_for_preview(state.html_refined)
+            sp["attributes"]["preview_bytes"] = len(preview_html or "")
 
         # 💡 FIX for File Saving (Problem 3): Use content_override
-        save_path = save_html(state, filename="flyer_refined.html", content_override=preview_html)
+        with span(state, "file.save", artifact="flyer_refined.html"):
+            save_path = save_html(state, filename="flyer_refined.html", content_override=preview_html)
         state.log(f"💾 Refined HTML saved: {save_path}")
 
     state.iteration_count += 1
-    return state
\ No newline at end of file
+    should_continue_refinement(state)
+    return state
+
+
+def refinement_node(state: FlyerState) -> FlyerState:
+    state.log(
+        f"[refinement_node] Iteration {state.iteration_count} — sending HTML and images to LLM for high-end review.")
+    # Later passes refine the previous pass's output rather than starting over from html_final
+    html_in = state.html_refined_base or state.html_final
+    images_meta_str = build_images_metadata(state)
+    mode = refinement_mode(state)
+    prompt_tokens = estimate_tokens(build_refinement_prompt(html_in, images_meta_str, mode))
+    start = time.perf_counter()
+    with span(state, "llm.refine", mode=mode, prompt_tokens=prompt_tokens) as sp:
+        evaluation_json, refined_html, error = request_refinement(html_in, images_meta_str, mode)
+        sp["attributes"].update(refinement_call_attributes(evaluation_json, prompt_tokens), parse_ok=not error)
+    duration_s = time.perf_counter() - start
+    tokens_est = sp["attributes"]["prompt_tokens"] + sp["attributes"]["completion_tokens"]
+    return apply_refinement(state, evaluation_json, refined_html, error, duration_s, tokens_est)
+
+
+# -------------------------------
+# Convergence-driven refinement loop
+# -------------------------------
+def parse_aesthetic_score(evaluation_json: dict):
+    """Read the 0-10 score from evaluation_json ("score" key or 'Score: 8.5/10' in the judgment)."""
+    score = evaluation_json.get("score") if evaluation_json else None
+    if isinstance(score, (int, float)):
+        return float(score)
+    match = re.search(r"(\d+(?:\.\d+)?)\s*/\s*10", str(evaluation_json.get("judgment", "")) if evaluation_json else "")
+    return float(match.group(1)) if match else None
+
+
+def record_refinement_pass(state: FlyerState, previous_html: str, duration_s: float = None,
+                           tokens_est: int = None, error: Exception = None):
+    entry = {
+        "iteration": state.iteration_count,
+        "score": parse_aesthetic_score(state.evaluation_json),
+        "similarity": round(html_structure_similarity(previous_html, state.html_refined_base), 4),
+        "duration_s": round(duration_s, 3) if duration_s is not None else None,
+        "tokens_est": tokens_est,
+        # Patch mode only: style edits that applied (None when the pass returned full HTML)
+        "edits_applied": state.evaluation_json.get("edits_applied"),
+        "error": str(error) if error else None,
+    }
+    state.refinement_history.append(entry)
+    state.log(f"📈 Refinement pass {entry['iteration']}: score {entry['score']}, "
+              f"structural similarity {entry['similarity']}")
+
+
+def refinement_stop_reason(state: FlyerState):
+    """Why the refinement loop should stop now, or None to run another pass."""
+    history = state.refinement_history
+    if not history:
+        return None
+    last = history[-1]
+    if last["error"]:
+        return "llm error"
+    if len(history) >= config.REFINEMENT_MAX_ITERATIONS:
+        return "max iterations"
+    if last["score"] is not None and last["score"] >= config.REFINEMENT_TARGET_SCORE:
+        return "target score reached"
+    if last.get("edits_applied") == 0:
+        return "no edits applied"
+    if len(history) > 1:
+        prev_score = history[-2]["score"]
+        if last["score"] is not None and prev_score is not None \
+                and last["score"] - prev_score < config.REFINEMENT_MIN_SCORE_GAIN:
+            return "score plateau"
+    if last["similarity"] >= config.REFINEMENT_HTML_SIMILARITY_STOP:
+        return "html converged"
+    if sum(h["duration_s"] or 0 for h in history) >= config.REFINEMENT_TIME_BUDGET_S:
+        return "latency budget"
+    if sum(h["tokens_est"] or 0 for h in history) >= config.REFINEMENT_TOKEN_BUDGET:
+        return "token budget"
+    return None
+
+
+def should_continue_refinement(state: FlyerState) -> bool:
+    reason = refinement_stop_reason(state)
+    state.needs_refinement = reason is None
+    if reason and state.refinement_history:
+        state.refinement_history[-1]["stop_reason"] = reason
+        state.log(f"🏁 Refinement stopped after {len(state.refinement_history)} pass(es): {reason}.")
+    return state.needs_refinement
\ No newline at end of file
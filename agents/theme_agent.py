@@ -1,134 +1,282 @@
-import re, json
+import sqlite3
+from core import config
+from core.flyer_ir import build_flyer_ir, serialize_flyer
 from core.state import FlyerState
-from models.llm_model import initialize_llm
+from core.tracing import span
+from models.llm_model import invoke_llm, stream_llm, estimate_tokens
+from models.llm_router import invoke_routed, prompt_complexity, record_routing, routed_models
 from utils.prompt_utils import THEME_ANALYZER_PROMPT
-from utils.helpers import get_position_coordinates, safe_float, get_valid_color, parse_size
+from utils.theme_cache import get_theme_cache, theme_cache_key
+from utils.prompt_index import get_prompt_index, find_similar_flyer
+from utils.json_utils import IncrementalJSONParser, parse_llm_json
 
 
 # -------------------------------
-# HTML Generator (No change from original file 3, kept for context)
+# HTML Generator
 # -------------------------------
 def generate_flyer_html(parsed: dict) -> str:
-    # ... (content remains exactly as your original File 3 for layout shapes and texts) ...
-    theme = parsed.get("theme", {})
-    texts = parsed.get("texts", [])
-    shapes = parsed.get("layout", {}).get("layout_shapes", [])
-    width_px, height_px = 800, 600
-    bg_color = parsed.get("layout", {}).get("background", {}).get(
-        "color", theme.get("theme_colors", ["#F8FBF8"])[0]
-    )
-
-    html_parts = [
-        f'<div style="width:{width_px}px;height:{height_px}px;border-radius:20px;overflow:hidden;position:relative;background:{bg_color};font-family:sans-serif;">']
-
-    # Shapes / decorative layers
-    for shape in shapes:
-        s_type = shape.get("shape", "rectangle")
-        x, y = get_position_coordinates(shape.get("position", "center"))
-        s_size = parse_size(shape.get("size", "40%"))
-        s_color = get_valid_color(shape.get("color", "#FFFFFF"))
-        opacity = min(safe_float(shape.get("opacity", 0.9), 0.9), 0.6)
-        border_radius = {"circle": "50%", "floral": "50%", "sticker": "20px"}.get(s_type, "15px")
-        z_index = 0
-
-        if s_type == "wave":
-            pos_style = "bottom:0;" if "bottom" in str(shape.get("position", "")).lower() else "top:0;"
-            html_parts.append(f"""
-            <svg viewBox="0 0 800 240" preserveAspectRatio="none"
-                 style="position:absolute;left:10%;width:80%;height:40%;{pos_style}z-index:{z_index};opacity:{opacity};">
-              <path d="M0,120 C200,40 400,200 800,120 L800,240 L0,240 Z" fill="{s_color}"/>
-            </svg>""")
-            continue
-
-        html_parts.append(f"""
-        <div style="position:absolute;top:{y}%;left:{x}%;
-                    width:{s_size};height:{s_size};background:{s_color};
-                    opacity:{opacity};border-radius:{border_radius};
-                    box-shadow:0 12px 30px rgba(0,0,0,0.15);
-                    transform:translate(-50%,-50%);
-                    z-index:{z_index};"></div>""")
-
-    # Text layers
-    for t in texts:
-        content = t.get("content", "")
-        font_family = t.get("font_style", "sans-serif")
-        font_size = t.get("font_size", "40px")
-        color = get_valid_color(t.get("font_color", "#000000"))
-        angle = t.get("angle", "0deg")
-        style_list = t.get("style", []) or []
-        x, y = get_position_coordinates(t.get("position", "center"))
-        font_weight = "700" if "bold" in style_list else "400"
-        font_style_css = "italic" if "italic" in style_list else "normal"
-        shadows = []
-        if "shadow" in style_list: shadows.append("2px 4px 12px rgba(0,0,0,0.35)")
-        if "glow" in style_list: shadows.append("0 0 12px rgba(255,255,255,0.35)")
-        text_shadow_css = ", ".join(shadows) if shadows else "none"
-        gradient_css = ("background: linear-gradient(90deg,#388E3C,#A5D6A7);"
-                        "-webkit-background-clip:text;color:transparent;"
-                        if "gradient" in style_list or "gradient(" in str(color) else f"color:{color};")
-        z_index = 3
-
-        html_parts.append(f"""
-        <div style="position:absolute;top:{y}%;left:{x}%;
-                    transform:translate(-50%,-50%) rotate({angle});
-                    font-family:{font_family};font-size:{font_size};
-                    font-weight:{font_weight};font-style:{font_style_css};
-                    {gradient_css};text-shadow:{text_shadow_css};
-                    z-index:{z_index};text-align:center;white-space:nowrap;">
-          {content}
-        </div>""")
-
-    # Image placeholders
-    images_meta = parsed.get("images", [])
-    for idx in range(len(images_meta)):
-        html_parts.append(f"")
-
-    # Overlay / visual finish
-    html_parts.append("""<div style="position:absolute;inset:0;border-radius:20px;
-                    box-shadow:inset 0 0 20px rgba(0,0,0,0.05),
-                                inset 0 -20px 40px rgba(0,0,0,0.08);
-                    z-index:10;pointer-events:none;"></div>""")
-    html_parts.append("</div>")
-    return "\n".join(html_parts)
+    # Layout shapes, texts and image slots are built as a FlyerIR and serialized with shared CSS classes
+    return serialize_flyer(build_flyer_ir(parsed))
+
+
+# -------------------------------
+# Theme validation & cache helpers
+# -------------------------------
+THEME_SCHEMA = {"theme": dict, "texts": list, "layout": dict, "images": list}
+REQUIRED_THEME_KEYS = list(THEME_SCHEMA)
+
+
+def apply_image_defaults(img_data: dict) -> dict:
+    # 💡 Critical Check: Ensure dynamic radius is present in images (new requirement)
+    if "border_radius" not in img_data:
+        # Inject a default if the LLM failed, but rely on prompt being updated
+        img_data["border_radius"] = "10px"
+    return img_data
+
+
+def validate_theme_json(parsed: dict) -> dict:
+    missing = [k for k in REQUIRED_THEME_KEYS if k not in parsed]
+    for img_data in parsed.get("images", []):
+        apply_image_defaults(img_data)
+    if missing: raise ValueError(f"Missing keys in LLM output: {missing}")
+    return parsed
+
+
+def lookup_similar_theme(state: FlyerState, prompt_text: str):
+    """
+    Near-duplicate of an earlier prompt, kept on state.warm_start. Its theme is returned (so the
+    LLM call is skipped) only in SEMANTIC_CACHE_MODE=reuse; in suggest mode the UI offers it instead.
+    """
+    if state.bypass_cache or get_prompt_index() is None:
+        return None
+    with span(state, "theme.similar_lookup", mode=config.SEMANTIC_CACHE_MODE) as sp:
+        try:
+            match = find_similar_flyer(prompt_text)
+        except sqlite3.Error as e:
+            state.log(f"⚠️ Prompt index unavailable: {e}")
+            match = None
+        sp["attributes"].update(hit=match is not None, similarity=match["similarity"] if match else None)
+    if not match:
+        return None
+
+    reuse = config.SEMANTIC_CACHE_MODE == "reuse"
+    state.warm_start = {"prompt": match["prompt"], "similarity": match["similarity"], "job_id": match["job_id"],
+                        "images": match["images"], "reused": reuse}
+    if not reuse:
+        state.log(f"💡 Similar earlier flyer found (\"{match['prompt']}\", similarity {match['similarity']:.2f}).")
+        return None
+    state.theme_model = match["model"]
+    state.log(f"♻️ Near-duplicate of \"{match['prompt']}\" (similarity {match['similarity']:.2f}); "
+              f"reusing its theme and {len(match['images'])} image(s).")
+    return match["theme_json"]
+
+
+def theme_key(prompt_text: str, model: str) -> str:
+    return theme_cache_key(prompt_text, model, config.LLM_TEMPERATURE, THEME_ANALYZER_PROMPT)
+
+
+def lookup_cached_theme(state: FlyerState, prompt_text: str) -> tuple:
+    """
+    Returns (cache, cached_theme). Only validated themes are ever stored, keyed on the model that
+    produced them; with adaptive routing either tier's entry is served (Pro first). An exact miss
+    falls back to the near-duplicate prompt index. A hit sets state.theme_model.
+    """
+    cache = None if state.bypass_cache else get_theme_cache()
+    cached = None
+    with span(state, "theme.cache_lookup", enabled=cache is not None) as sp:
+        try:
+            for model in (routed_models() if cache else []):
+                cached = cache.get(theme_key(prompt_text, model))
+                if cached is not None:
+                    state.theme_model = model
+                    sp["attributes"]["model"] = model
+                    break
+        except sqlite3.Error as e:
+            state.log(f"⚠️ Theme cache unavailable: {e}")
+            cache, cached = None, None
+        sp["attributes"]["cache_hit"] = cached is not None
+    if cached is None:
+        cached = lookup_similar_theme(state, prompt_text)
+    return cache, cached
+
+
+def store_theme(state: FlyerState, parsed: dict, cache=None, model: str = None):
+    """Keep a validated theme on the state; `model` is the one that just produced it (cached under its key)."""
+    state.theme_json = parsed
+    ir = build_flyer_ir(parsed)
+    state.flyer_ir = ir.to_dict()
+    state.html_output = serialize_flyer(ir)
+    if model: state.theme_model = model
+    if cache and model:
+        try:
+            cache.put(theme_key(state.user_prompt.strip(), model), parsed)
+        except sqlite3.Error as e:
+            state.log(f"⚠️ Could not cache theme: {e}")
+
+
+def log_json_repairs(state: FlyerState, report: dict):
+    if report["repairs"] or report["reasks"]:
+        state.log(f"🔧 Theme JSON recovered (repairs: {', '.join(report['repairs']) or 'none'}, "
+                  f"re-asks: {report['reasks']}).")
+
+
+def parse_theme_response(state: FlyerState, raw_content: str, reask=None) -> dict:
+    """Extract, repair and validate the theme JSON; raises ValueError when it cannot be recovered."""
+    with span(state, "json.parse", chars=len(raw_content)) as sp:
+        parsed, report = parse_llm_json(raw_content, THEME_SCHEMA, reask=reask)
+        sp["attributes"].update(repairs=",".join(report["repairs"]), reasks=report["reasks"])
+    log_json_repairs(state, report)
+    return validate_theme_json(parsed)
+
+
+def routing_attributes(decisions: list) -> dict:
+    last = decisions[-1] if decisions else {}
+    attrs = {"model": last.get("model"), "tier": last.get("tier"), "escalated": len(decisions) > 1}
+    if decisions:  # Otherwise the span keeps its estimated prompt tokens
+        attrs.update(prompt_tokens=sum(d["prompt_tokens"] for d in decisions),
+                     completion_tokens=sum(d["completion_tokens"] for d in decisions),
+                     reasks=sum(d.get("reasks", 0) for d in decisions),
+                     tokens_estimated=any(d["tokens_estimated"] for d in decisions))
+    return attrs
+
+
+def _reject_prompt(state: FlyerState) -> bool:
+    if state.user_prompt.strip():
+        return False
+    state.log("❌ Empty prompt. Skipping theme analysis.")
+    state.theme_json = {"error": "Empty prompt."}
+    state.html_output = "<p style='color:red'>Empty prompt.</p>"
+    return True
+
+
+def _theme_failed(state: FlyerState, e: Exception):
+    state.log(f"❌ Error during theme analysis: {e}")
+    state.theme_json = {"error": str(e)}
+    state.html_output = "<p style='color:red'>Error generating flyer theme.</p>"
 
 
 # -------------------------------
 # Theme Analyzer Node (File 3)
 # -------------------------------
 def theme_analyzer_node(state: FlyerState) -> FlyerState:
+    if _reject_prompt(state):
+        return state
     prompt_text = state.user_prompt.strip()
-    if not prompt_text:
-        state.log("❌ Empty prompt. Skipping theme analysis.")
-        state.theme_json = {"error": "Empty prompt."}
-        state.html_output = "<p style='color:red'>Empty prompt.</p>"
+
+    # Serve repeated prompts from the persistent cache
+    cache, cached = lookup_cached_theme(state, prompt_text)
+    if cached:
+        store_theme(state, cached)
+        state.log("♻️ Theme analysis served from cache. Flyer IR built with empty image slots.")
         return state
 
-    llm = initialize_llm()
     llm_prompt = THEME_ANALYZER_PROMPT.replace("{user_prompt}", prompt_text)
     state.log("⚙️ Running high-end theme analysis with LLM...")
 
+    decisions = []
+    try:
+        with span(state, "llm.theme", prompt_tokens=estimate_tokens(llm_prompt), tokens_estimated=True) as sp:
+            parsed = invoke_routed("theme", llm_prompt, lambda raw, reask: parse_theme_response(state, raw, reask),
+                                   prompt_complexity(prompt_text), decisions)
+            sp["attributes"].update(routing_attributes(decisions))
+        store_theme(state, parsed, cache, decisions[-1]["model"])
+        state.log("✅ Theme analysis complete. Flyer IR built with empty image slots.")
+    except Exception as e:
+        _theme_failed(state, e)
+    finally:
+        record_routing(state, decisions)
+
+    return state
+
+
+# -------------------------------
+# Streaming Theme Analyzer
+# -------------------------------
+def theme_analyzer_stream_node(state: FlyerState, on_image=None, on_html=None, on_reset=None) -> FlyerState:
+    """
+    Same result as theme_analyzer_node, but consumes the LLM token stream incrementally:
+      - on_image(index, img_data, tone) fires as soon as each "images" entry is complete
+      - on_html(html) fires once "texts" and "layout" are available (first-paint preview)
+      - on_reset() fires when a streamed answer failed validation and is escalated: the images and
+        preview already handed out are stale, and every image of the escalated theme follows
+    """
+    if _reject_prompt(state):
+        return state
+    prompt_text = state.user_prompt.strip()
+
+    cache, cached = lookup_cached_theme(state, prompt_text)
+    if cached:
+        store_theme(state, cached)
+        state.log("♻️ Theme analysis served from cache. Flyer IR built with empty image slots.")
+        if on_html: on_html(state.html_output)
+        tone = cached.get("theme", {}).get("tone", "elegant")
+        for idx, img_data in enumerate(cached.get("images", [])):
+            if on_image: on_image(idx, img_data, tone)
+        return state
+
+    llm_prompt = THEME_ANALYZER_PROMPT.replace("{user_prompt}", prompt_text)
+    state.log("⚙️ Streaming high-end theme analysis from LLM...")
+
+    def handle_value(key, value):
+        if key in ("texts", "layout") and "texts" in parser.values and "layout" in parser.values:
+            state.html_output = generate_flyer_html(parser.values)
+            state.log("🧩 Texts and layout received — early HTML preview ready.")
+            if on_html: on_html(state.html_output)
+
+    def handle_item(key, index, img_data):
+        apply_image_defaults(img_data)
+        tone = parser.values.get("theme", {}).get("tone", "elegant")
+        state.log(f"📨 Image {index + 1} description received.")
+        if on_image: on_image(index, img_data, tone)
+
+    parser = IncrementalJSONParser(on_value=handle_value, on_item=handle_item)
+    streamed = False
+
+    def call(llm, escalated):
+        nonlocal streamed, parser
+        streamed = not escalated
+        if escalated:  # An escalated (Pro) retry is a plain call that replaces everything streamed so far
+            if parser.item_count or parser.values:
+                state.log("↩️ Discarding the images and preview dispatched from the rejected streamed theme.")
+                if on_reset: on_reset()
+            parser = IncrementalJSONParser(on_value=handle_value, on_item=handle_item)
+            return invoke_llm(llm_prompt, llm)
+        chunks, incremental = [], True
+        for chunk in stream_llm(llm_prompt, llm):
+            chunks.append(chunk)
+            if incremental:
+                try:
+                    parser.feed(chunk)
+                except ValueError as e:
+                    # Comments or trailing commas break incremental parsing; repair the full response instead
+                    state.log(f"⚠️ Streamed JSON needs repair ({e}); parsing the complete response.")
+                    incremental = False
+            if parser.done: break
+        return "".join(chunks)
+
+    def parse(raw_content, reask):
+        if streamed and parser.done:
+            return validate_theme_json(parser.result())
+        parsed = parse_theme_response(state, raw_content, reask)
+        if on_html: on_html(generate_flyer_html(parsed))
+        # Images the incremental parser did not get to (all of them after an escalation) still need generating
+        tone = parsed["theme"].get("tone", "elegant")
+        for index, img_data in enumerate(parsed["images"][parser.item_count:], parser.item_count):
+            state.log(f"📨 Image {index + 1} description received.")
+            if on_image: on_image(index, img_data, tone)
+        return parsed
+
+    decisions = []
     try:
-        response = llm.invoke(llm_prompt)
-        raw_content = getattr(response, "content", str(response)).strip()
-        cleaned = re.sub(r"^```(?:json)?|```$", "", raw_content, flags=re.MULTILINE)
-        parsed = json.loads(cleaned)
-        required_keys = ["theme", "texts", "layout", "images"]
-        missing = [k for k in required_keys if k not in parsed]
-
-        # 💡 Critical Check: Ensure dynamic radius is present in images (new requirement)
-        if "images" in parsed:
-            for i, img_data in enumerate(parsed["images"]):
-                if "border_radius" not in img_data:
-                    # Inject a default if the LLM failed, but rely on prompt being updated
-                    parsed["images"][i]["border_radius"] = "10px"
-
-        if missing: raise ValueError(f"Missing keys in LLM output: {missing}")
-        state.theme_json = parsed
-        state.html_output = generate_flyer_html(parsed)
-        state.log("✅ Theme analysis complete. HTML generated with image placeholders.")
+        # JSON parsing is interleaved with the token stream, so it is part of this span
+        with span(state, "llm.theme_stream", prompt_tokens=estimate_tokens(llm_prompt), tokens_estimated=True) as sp:
+            parsed = invoke_routed("theme", llm_prompt, parse, prompt_complexity(prompt_text), decisions, call=call)
+            sp["attributes"].update(routing_attributes(decisions))
+        store_theme(state, parsed, cache, decisions[-1]["model"])
+        state.log("✅ Theme analysis complete. Flyer IR built with empty image slots.")
     except Exception as e:
-        state.log(f"❌ Error during theme analysis: {e}")
-        state.theme_json = {"error": str(e)}
-        state.html_output = "<p style='color:red'>Error generating flyer theme.</p>"
+        _theme_failed(state, e)
+    finally:
+        record_routing(state, decisions)
 
-    return state
\ No newline at end of file
+    return state
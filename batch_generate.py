@@ -0,0 +1,177 @@
+# batch_generate.py
+#
+# Headless batch generation (no Streamlit). Reads campaign prompts from JSONL or CSV and runs
+# theme -> image -> refine for each one, with bounded LLM concurrency and diffusion shared through
+# the micro-batching scheduler (or serialized per job when it is disabled). Every job writes to its own directory; a manifest summarizes the run.
+#
+# Usage:
+#   python batch_generate.py prompts.jsonl --out batch_runs/spring --llm-concurrency 4
+#   python batch_generate.py prompts.csv            (CSV needs a "prompt" column, optional "id")
+
+import os, sys, csv, json, time, re, argparse, threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from agents.image_agent import image_generator_node
+from agents.refinement_agent import refinement_node
+from agents.theme_agent import theme_analyzer_node
+from core import config
+from core.state import FlyerState
+from core.tracing import span
+from models.diffusion_scheduler import configure_scheduler
+from utils.rasterizer import flyer_ir_for, save_thumbnail
+from utils.summary_utils import generate_summary
+
+
+# -------------------------------
+# Input loading
+# -------------------------------
+def load_prompts(path: str) -> list:
+    jobs = []
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                jobs.append({"id": row.get("id"), "prompt": row.get("prompt", "")})
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line: continue
+                record = json.loads(line)
+                jobs.append(record if isinstance(record, dict) else {"prompt": str(record)})
+
+    seen = set()
+    for idx, job in enumerate(jobs):
+        job_id = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(job.get("id") or f"job_{idx + 1:04d}"))
+        # Ids name the output directories, so ids that coincide (as given or after sanitizing) get a suffix
+        unique_id, n = job_id, 1
+        while unique_id in seen:
+            n += 1
+            unique_id = f"{job_id}-{n}"
+        seen.add(unique_id)
+        job["id"] = unique_id
+    return jobs
+
+
+# -------------------------------
+# Job execution
+# -------------------------------
+class BatchRunner:
+    def __init__(self, out_dir: str, llm_concurrency: int = 4, verbose: bool = False, thumbnail_scale: float = 0.25):
+        self.out_dir = out_dir
+        self.thumbnail_scale = thumbnail_scale
+        self.llm_concurrency = max(1, llm_concurrency)
+        self.verbose = verbose
+        self._llm_slots = threading.BoundedSemaphore(self.llm_concurrency)
+        configure_scheduler(self.llm_concurrency + 1)  # Job threads, see run()
+        # With the micro-batching scheduler, concurrent jobs share pipeline calls; otherwise one job at a time
+        self._diffusion_gate = nullcontext() if config.DIFFUSION_SCHEDULER_ENABLED else threading.Lock()
+
+    def _stage(self, name: str, gate, fn, state: FlyerState, timings: dict) -> FlyerState:
+        wait_start = time.perf_counter()
+        with gate:
+            run_start = time.perf_counter()
+            with span(state, f"node.{name}", wait_ms=round((run_start - wait_start) * 1000, 3)):
+                state = fn(state)
+        end = time.perf_counter()
+        timings[name] = {"wait_s": round(run_start - wait_start, 3), "run_s": round(end - run_start, 3)}
+        if self.verbose: print(f"[{state.job_id}] {name} done in {end - run_start:.1f}s")
+        return state
+
+    def run_job(self, job: dict) -> dict:
+        job_dir = os.path.join(self.out_dir, job["id"])
+        os.makedirs(job_dir, exist_ok=True)
+        state = FlyerState(user_prompt=(job.get("prompt") or "").strip(), job_id=job["id"], output_dir=job_dir)
+        timings = {}
+        start = time.perf_counter()
+        error, thumbnail = None, None
+        try:
+            state = self._stage("theme", self._llm_slots, theme_analyzer_node, state, timings)
+            if "error" in state.theme_json:
+                raise RuntimeError(state.theme_json["error"])
+            state = self._stage("image", self._diffusion_gate, image_generator_node, state, timings)
+            state = self._stage("refine", self._llm_slots, refinement_node, state, timings)
+            while state.needs_refinement:
+                stage = f"refine_{len(state.refinement_history) + 1}"
+                state = self._stage(stage, self._llm_slots, refinement_node, state, timings)
+            state.flyer_summary = generate_summary(state.theme_json)
+            if self.thumbnail_scale > 0:
+                # Browser-free preview of the refined layout for galleries / quick review
+                render_start = time.perf_counter()
+                thumbnail = save_thumbnail(flyer_ir_for(state, refined=True),
+                                           os.path.join(job_dir, "thumbnail.webp"), self.thumbnail_scale)
+                timings["thumbnail"] = {"wait_s": 0.0, "run_s": round(time.perf_counter() - render_start, 3)}
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        result = {
+            "id": job["id"],
+            "prompt": state.user_prompt,
+            "status": "error" if error else "ok",
+            "error": error,
+            "output_dir": job_dir,
+            "images": [img["path"] for img in state.generated_images],
+            "originals": [img.get("original_path", img["path"]) for img in state.generated_images],
+            "thumbnail": thumbnail,
+            "refinement": state.refinement_history,
+            "near_duplicate": {k: state.warm_start[k] for k in ("prompt", "similarity", "reused")} if state.warm_start else None,
+            "timings": timings,
+            "total_s": round(time.perf_counter() - start, 3),
+        }
+        with open(os.path.join(job_dir, "result.json"), "w", encoding="utf-8") as f:
+            json.dump({**result, "theme_json": state.theme_json, "evaluation_json": state.evaluation_json,
+                       "summary": state.flyer_summary, "messages": state.messages, "spans": state.spans}, f, indent=2, ensure_ascii=False)
+        return result
+
+    def run(self, jobs: list) -> dict:
+        os.makedirs(self.out_dir, exist_ok=True)
+        start = time.perf_counter()
+        # Enough job threads to keep every LLM slot busy while other jobs are in diffusion
+        with ThreadPoolExecutor(max_workers=self.llm_concurrency + 1, thread_name_prefix="batch") as pool:
+            results = list(pool.map(self.run_job, jobs))
+        wall = time.perf_counter() - start
+
+        stage_totals = {}
+        for res in results:
+            for stage, t in res["timings"].items():
+                stage_totals.setdefault(stage.split("_")[0], []).append(t["run_s"])
+        ok = sum(1 for res in results if res["status"] == "ok")
+        manifest = {
+            "jobs": results,
+            "summary": {
+                "total_jobs": len(results),
+                "succeeded": ok,
+                "failed": len(results) - ok,
+                "wall_time_s": round(wall, 3),
+                "throughput_flyers_per_min": round(ok / wall * 60, 2) if wall else 0.0,
+                "llm_concurrency": self.llm_concurrency,
+                "stage_mean_run_s": {stage: round(sum(v) / len(v), 3) for stage, v in stage_totals.items()},
+            },
+        }
+        with open(os.path.join(self.out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate flyers for many prompts without the Streamlit UI")
+    parser.add_argument("input", help="JSONL (one {\"prompt\": ..., \"id\": ...} per line) or CSV with a prompt column")
+    parser.add_argument("--out", default=os.path.join("batch_runs", time.strftime("%Y%m%d-%H%M%S")))
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Max concurrent LLM calls")
+    parser.add_argument("--limit", type=int, default=0, help="Only run the first N prompts")
+    parser.add_argument("--thumbnail-scale", type=float, default=0.25, help="Thumbnail size vs 800x600 (0 = none)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    jobs = load_prompts(args.input)
+    if args.limit: jobs = jobs[:args.limit]
+    print(f"🚀 Running {len(jobs)} flyer jobs → {args.out}")
+    manifest = BatchRunner(args.out, args.llm_concurrency, args.verbose, args.thumbnail_scale).run(jobs)
+    summary = manifest["summary"]
+    print(f"✅ {summary['succeeded']}/{summary['total_jobs']} flyers in {summary['wall_time_s']:.1f}s "
+          f"({summary['throughput_flyers_per_min']} flyers/min). Manifest: {os.path.join(args.out, 'manifest.json')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# bench_batched_diffusion.py
+#
+# Compares wall time per flyer for batched vs. sequential diffusion on the configured model.
+# Usage: python benchmarks/bench_batched_diffusion.py --images 3 --runs 3 --steps 25
+
+import os, sys, time, argparse, statistics
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from agents.image_agent import run_diffusion_jobs
+from core import config
+from models.diffusion_model import get_pipeline_registry
+
+SAMPLE_DESCRIPTIONS = [
+    "Primary background image of a misty Japanese tea garden at dawn",
+    "Close-up shot of green tea leaves with dew drops",
+    "Ceramic tea cup with steam on a bamboo mat",
+]
+
+
+def make_jobs(n_images: int, steps: int) -> list:
+    jobs = []
+    for idx in range(n_images):
+        desc = SAMPLE_DESCRIPTIONS[idx % len(SAMPLE_DESCRIPTIONS)]
+        jobs.append({"index": idx, "description": desc,
+                     "prompt": f"{desc}, professional high-end flyer, luxurious texture, elegant",
+                     "pos": "center", "size": "40%", "layer": "foreground", "seed": 1234 + idx,
+                     "height": None, "width": None, "steps": steps,
+                     "guidance_scale": config.DIFFUSION_GUIDANCE_SCALE})
+    return jobs
+
+
+def time_mode(pipe, device, jobs, batched: bool, runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        results = run_diffusion_jobs(pipe, device, jobs, batched=batched)
+        timings.append(time.perf_counter() - start)
+        failed = [job["index"] for job, outcome in results if isinstance(outcome, Exception)]
+        if failed: print(f"⚠️ Failed images in {'batched' if batched else 'sequential'} run: {failed}")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched vs sequential diffusion wall time per flyer")
+    parser.add_argument("--images", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=config.DIFFUSION_STEPS)
+    parser.add_argument("--model", default=config.DIFFUSION_MODEL_ID)
+    args = parser.parse_args()
+
+    registry = get_pipeline_registry(args.model)
+    jobs = make_jobs(args.images, args.steps)
+
+    with registry.acquire() as pipe:
+        print(f"🧠 Loaded {args.model} on {registry.device} in {registry.stats()['load_seconds']:.1f}s")
+        time_mode(pipe, registry.device, jobs[:1], batched=False, runs=1)  # warm-up
+        sequential = time_mode(pipe, registry.device, jobs, batched=False, runs=args.runs)
+        batched = time_mode(pipe, registry.device, jobs, batched=True, runs=args.runs)
+
+    seq_med, bat_med = statistics.median(sequential), statistics.median(batched)
+    print(f"Images per flyer: {args.images}, steps: {args.steps}, runs: {args.runs}")
+    print(f"Sequential: median {seq_med:.2f}s/flyer (min {min(sequential):.2f}s)")
+    print(f"Batched:    median {bat_med:.2f}s/flyer (min {min(batched):.2f}s)")
+    print(f"Speed-up:   {seq_med / bat_med:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
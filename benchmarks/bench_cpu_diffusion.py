@@ -0,0 +1,121 @@
+# bench_cpu_diffusion.py
+#
+# Per-image diffusion latency on the CPU backend (models/diffusion_model.py: CPU dtype, thread tuning,
+# attention slicing, VAE slicing/tiling, optional torch.compile). Times one image per resolution the
+# resolution-aware image stage produces, after a warm-up call, and writes the results to JSON so CPU
+# node sizing can be documented per machine.
+#
+# --tiny runs a tiny Stable Diffusion pipeline (random weights, a few MB) end to end through
+# theme_analyzer_node -> image_generator_node with the recorded theme response: the CPU test
+# configuration for CI or a laptop. It checks wiring and overhead, not image quality.
+#
+# Usage:
+#   python benchmarks/bench_cpu_diffusion.py --steps 20
+#   python benchmarks/bench_cpu_diffusion.py --model segmind/tiny-sd --threads 8 --compile
+#   python benchmarks/bench_cpu_diffusion.py --tiny
+
+import os, sys, json, time, argparse, platform, statistics, tempfile
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from core import config
+
+TINY_MODEL_ID = "hf-internal-testing/tiny-stable-diffusion-pipe"
+RESOLUTIONS = [(320, 320), (448, 320), (512, 384), (768, 576)]
+
+
+def configure_cpu(args):
+    config.DIFFUSION_DEVICE = "cpu"
+    config.DIFFUSION_CPU_DTYPE = args.dtype
+    config.DIFFUSION_CPU_THREADS = args.threads
+    config.DIFFUSION_COMPILE = args.compile
+    if args.tiny:
+        config.DIFFUSION_CPU_MODEL_ID = TINY_MODEL_ID
+        config.DIFFUSION_STEPS = min(args.steps, 2)
+        config.DIFFUSION_MIN_STEPS = 1
+    else:
+        config.DIFFUSION_CPU_MODEL_ID = args.model or config.DIFFUSION_CPU_MODEL_ID
+        config.DIFFUSION_STEPS = args.steps
+
+
+def time_resolutions(registry, runs: int, steps: int) -> dict:
+    from agents.image_agent import run_diffusion_batch
+    make_job = lambda w, h, i: {"index": i, "prompt": "Misty Japanese tea garden at dawn, professional flyer",
+                                "seed": 1234 + i, "height": h, "width": w, "steps": steps,
+                                "guidance_scale": config.DIFFUSION_GUIDANCE_SCALE}
+    results = {}
+    with registry.acquire() as pipe:
+        run_diffusion_batch(pipe, registry.device, [make_job(*RESOLUTIONS[0], 0)])  # Warm-up (and compile)
+        for width, height in RESOLUTIONS:
+            timings = []
+            for i in range(runs):
+                start = time.perf_counter()
+                (_, outcome), = run_diffusion_batch(pipe, registry.device, [make_job(width, height, i)])
+                if isinstance(outcome, Exception): raise outcome
+                timings.append(time.perf_counter() - start)
+            results[f"{width}x{height}"] = {"median_s": round(statistics.median(timings), 3),
+                                            "min_s": round(min(timings), 3),
+                                            "s_per_step": round(statistics.median(timings) / steps, 3)}
+            print(f"{width}x{height:<4} {steps} steps: median {results[f'{width}x{height}']['median_s']:.2f}s/image")
+    return results
+
+
+def run_tiny_end_to_end(work_dir: str) -> dict:
+    from models.llm_model import set_llm_factory
+    from benchmarks.stubs import stub_llm_factory
+    from agents.theme_agent import theme_analyzer_node
+    from agents.image_agent import image_generator_node
+    from core.state import FlyerState
+
+    set_llm_factory(stub_llm_factory())
+    config.THEME_CACHE_ENABLED = False
+    config.SEMANTIC_CACHE_MODE = "off"
+    config.IMAGE_CACHE_ENABLED = False
+    state = FlyerState(user_prompt="Create a premium green tea poster", job_id="cpu_tiny",
+                       output_dir=os.path.join(work_dir, "cpu_tiny"))
+    start = time.perf_counter()
+    state = image_generator_node(theme_analyzer_node(state))
+    wall = time.perf_counter() - start
+    expected = len(state.theme_json.get("images", []))
+    print(f"Tiny end to end: {len(state.generated_images)}/{expected} images in {wall:.2f}s")
+    if len(state.generated_images) != expected:
+        print("\n".join(state.messages))
+        raise SystemExit(1)
+    return {"images": len(state.generated_images), "wall_s": round(wall, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU diffusion latency per image")
+    parser.add_argument("--model", help="Model id or local path (default: DIFFUSION_CPU_MODEL_ID / DIFFUSION_MODEL_ID)")
+    parser.add_argument("--steps", type=int, default=config.DIFFUSION_STEPS)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=config.DIFFUSION_CPU_THREADS, help="0 = all available cores")
+    parser.add_argument("--dtype", default=config.DIFFUSION_CPU_DTYPE, choices=["float32", "bfloat16"])
+    parser.add_argument("--compile", action="store_true", default=config.DIFFUSION_COMPILE)
+    parser.add_argument("--tiny", action="store_true", help="Tiny random-weight pipeline, end to end")
+    parser.add_argument("--out", default=os.path.join("benchmarks", "results",
+                                                      f"cpu-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    args = parser.parse_args()
+    configure_cpu(args)
+
+    from models.diffusion_model import get_pipeline_registry
+    registry = get_pipeline_registry()
+    results = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "model": registry.model_id,
+                        "processor": platform.processor() or platform.machine(), "cpus": os.cpu_count(),
+                        "python": platform.python_version(), "steps": config.DIFFUSION_STEPS}}
+    if args.tiny:
+        with tempfile.TemporaryDirectory(prefix="flyer-cpu-") as work_dir:
+            results["end_to_end"] = run_tiny_end_to_end(work_dir)
+    else:
+        results["per_image"] = time_resolutions(registry, args.runs, config.DIFFUSION_STEPS)
+    stats = registry.stats()
+    results["meta"].update(load_seconds=round(stats["load_seconds"], 2), optimizations=stats["optimizations"])
+    print(f"🧠 {registry.model_id} on cpu ({', '.join(stats['optimizations'])}), load {stats['load_seconds']:.1f}s")
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# bench_pipeline_offline.py
+#
+# Offline benchmark of the whole flyer pipeline: recorded LLM responses (benchmarks/stubs.py) and a
+# tiny CPU stub diffusion backend, so it runs anywhere without a Gemini key or a GPU. Reports per-stage
+# latency percentiles, HTML sizes, per-stage memory peaks and end-to-end throughput, and writes them to
+# JSON; pass --baseline with an earlier result to see regressions.
+#
+# Usage:
+#   python benchmarks/bench_pipeline_offline.py --flyers 20
+#   python benchmarks/bench_pipeline_offline.py --flyers 20 --concurrency 4 --baseline benchmarks/results/old.json
+
+import os, sys, json, time, argparse, platform, resource, statistics, subprocess, tempfile, tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from core import config
+from models.llm_model import set_llm_factory
+from models.diffusion_model import set_pipeline_factory
+from models.diffusion_scheduler import configure_scheduler
+from benchmarks.stubs import stub_llm_factory, stub_pipeline_factory
+
+from agents.image_agent import image_generator_node
+from agents.refinement_agent import refinement_node
+from agents.theme_agent import theme_analyzer_node, generate_flyer_html
+from core.state import FlyerState
+from utils.helpers import inject_images_for_preview
+from utils.summary_utils import generate_summary
+
+STAGES = ["theme_analyzer_node", "image_generator_node", "refinement_node", "generate_flyer_html",
+          "inject_images_for_preview", "generate_summary"]
+
+
+def configure_offline(args, work_dir: str):
+    set_llm_factory(stub_llm_factory(args.llm_latency_ms / 1000))
+    set_pipeline_factory(stub_pipeline_factory)
+    # Measure the work itself, not cache hits from earlier runs
+    config.THEME_CACHE_ENABLED = False
+    config.SEMANTIC_CACHE_MODE = "off"
+    config.IMAGE_CACHE_ENABLED = False
+    config.DIFFUSION_DEVICE = "cpu"
+    config.DIFFUSION_STEPS = args.steps
+    config.REFINEMENT_MODE = args.refinement_mode
+    config.CHECKPOINT_DIR = os.path.join(work_dir, "checkpoints")
+    configure_scheduler(args.concurrency)  # As the worker would for the same number of concurrent flyers
+
+
+def run_flyer(idx: int, work_dir: str, timings: dict = None, memory: dict = None) -> dict:
+    """
+    One flyer through every measured stage; fills timings[stage] (seconds) and memory[stage] (KiB peak).
+    Returns the HTML sizes in bytes.
+    """
+    state = FlyerState(user_prompt=f"Create a premium green tea poster for Gyokuro #{idx}",
+                       job_id=f"bench_{idx:04d}", output_dir=os.path.join(work_dir, f"bench_{idx:04d}"))
+    results = {}
+
+    def measure(stage, fn, *args):
+        if memory is not None: tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = fn(*args)
+        if timings is not None: timings.setdefault(stage, []).append(time.perf_counter() - start)
+        if memory is not None: memory[stage] = max(memory.get(stage, 0), tracemalloc.get_traced_memory()[1] // 1024)
+        return result
+
+    state = measure("theme_analyzer_node", theme_analyzer_node, state)
+    state = measure("image_generator_node", image_generator_node, state)
+    state = measure("refinement_node", refinement_node, state)
+    results["html_output"] = measure("generate_flyer_html", generate_flyer_html, state.theme_json)
+    results["preview"] = measure("inject_images_for_preview", inject_images_for_preview, state.html_final)
+    state.flyer_summary = measure("generate_summary", generate_summary, state.theme_json)
+    return {
+        "html_output": len(results["html_output"].encode("utf-8")),
+        "html_final": len(state.html_final.encode("utf-8")),
+        "html_refined": len((state.html_refined or "").encode("utf-8")),
+        "preview_with_base64": len((results["preview"] or "").encode("utf-8")),
+    }
+
+
+def percentiles(values: list) -> dict:
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return {"n": len(ordered), "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+            "p50_ms": round(pick(0.50) * 1000, 3), "p95_ms": round(pick(0.95) * 1000, 3),
+            "p99_ms": round(pick(0.99) * 1000, 3)}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: dict, baseline_path: str, tolerance: float = 0.10):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nvs baseline {baseline['meta'].get('git_revision') or baseline_path}:")
+    for stage, stats in results["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if not old or not old["p50_ms"]: continue
+        ratio = stats["p50_ms"] / old["p50_ms"]
+        flag = "  ⚠️ regression" if ratio > 1 + tolerance else ""
+        print(f"  {stage:<28} p50 {old['p50_ms']:>9.2f} → {stats['p50_ms']:>9.2f} ms ({ratio:.2f}x){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark with stub LLM and stub diffusion")
+    parser.add_argument("--flyers", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1, help="Threads for the end-to-end throughput pass")
+    parser.add_argument("--steps", type=int, default=config.DIFFUSION_STEPS)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Simulated LLM latency per call")
+    parser.add_argument("--refinement-mode", default=config.REFINEMENT_MODE, choices=["patch", "html"])
+    parser.add_argument("--out", default=os.path.join("benchmarks", "results",
+                                                      f"offline-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    parser.add_argument("--baseline", help="Earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="flyer-bench-") as work_dir:
+        configure_offline(args, work_dir)
+        for i in range(args.warmup):
+            run_flyer(-1 - i, work_dir)
+
+        # Latency pass: sequential, so stage timings are not inflated by contention
+        timings, sizes = {}, []
+        for i in range(args.flyers):
+            sizes.append(run_flyer(i, work_dir, timings=timings))
+
+        # Memory pass: tracemalloc slows Python code down, so it runs separately on one flyer
+        memory = {}
+        tracemalloc.start()
+        run_flyer(args.flyers, work_dir, memory=memory)
+        tracemalloc.stop()
+
+        # Throughput pass: whole flyers end to end, optionally concurrent
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+            list(pool.map(lambda i: run_flyer(args.flyers + 1 + i, work_dir), range(args.flyers)))
+        wall = time.perf_counter() - start
+
+    sizes = {key: statistics.median(s[key] for s in sizes) for key in sizes[0]}
+    results = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_revision": git_revision(),
+                 "python": platform.python_version(), "platform": platform.platform(),
+                 "flyers": args.flyers, "concurrency": args.concurrency, "steps": args.steps,
+                 "llm_latency_ms": args.llm_latency_ms, "refinement_mode": args.refinement_mode,
+                 "diffusion_scheduler": config.DIFFUSION_SCHEDULER_ENABLED},
+        "stages": {stage: percentiles(timings[stage]) for stage in STAGES if stage in timings},
+        "html_bytes_median": sizes,
+        "memory_peak_kib": memory,
+        "max_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "end_to_end": {"flyers": args.flyers, "wall_s": round(wall, 3),
+                       "flyers_per_min": round(args.flyers / wall * 60, 2) if wall else 0.0},
+    }
+
+    for stage, stats in results["stages"].items():
+        print(f"{stage:<28} p50 {stats['p50_ms']:>9.2f} ms  p95 {stats['p95_ms']:>9.2f} ms  "
+              f"p99 {stats['p99_ms']:>9.2f} ms  peak {memory.get(stage, 0):>7} KiB")
+    print(f"HTML bytes (median): {sizes}")
+    print(f"End to end: {results['end_to_end']['flyers_per_min']} flyers/min "
+          f"({args.flyers} flyers, concurrency {args.concurrency}), max RSS {results['max_rss_mib']} MiB")
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"💾 Results written to {args.out}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
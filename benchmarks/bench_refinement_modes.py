@@ -0,0 +1,117 @@
+# bench_refinement_modes.py
+#
+# Compares the two refinement protocols on the configured Gemini model:
+#   html  - the model returns the complete edited_html
+#   patch - the model returns style edits addressed to flyer IR element ids
+# Reports completion size, latency, parse failures and whether the text content survived.
+# Usage: python benchmarks/bench_refinement_modes.py --runs 3 [--theme-json theme.json]
+
+import os, sys, json, time, argparse, statistics
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from agents.refinement_agent import build_refinement_prompt, parse_refinement_response, estimate_tokens
+from core.flyer_ir import FlyerIR, build_flyer_ir, set_image_slot, serialize_flyer, apply_style_edits
+from models.llm_model import invoke_llm
+
+SAMPLE_THEME = {
+    "theme": {"theme_colors": ["#F1F8E9", "#2E7D32", "#A5D6A7"], "tone": "premium, calm"},
+    "texts": [
+        {"content": "Gyokuro Reserve", "font_size": "56px", "font_color": "#1B5E20", "position": "top",
+         "style": ["bold", "shadow"]},
+        {"content": "Refresh Your Soul", "font_size": "32px", "font_color": "#2E7D32", "position": "center",
+         "style": ["italic"]},
+        {"content": "Shaded-grown in Yame, Japan", "font_size": "20px", "font_color": "#33691E",
+         "position": "bottom", "style": []},
+    ],
+    "layout": {"background": {"color": "#F1F8E9"}, "layout_shapes": [
+        {"shape": "circle", "position": "top right", "size": "30%", "color": "#A5D6A7", "opacity": 0.5},
+        {"shape": "wave", "position": "bottom", "size": "100%", "color": "#C8E6C9", "opacity": 0.6},
+    ]},
+    "images": [
+        {"description": "Misty Japanese tea garden at dawn", "position": "center", "size": "100%",
+         "layer": "background", "border_radius": "0px"},
+        {"description": "Close-up of green tea leaves", "position": "bottom right", "size": "30%",
+         "layer": "foreground", "border_radius": "50%"},
+    ],
+}
+
+
+def sample_flyer(theme_json: dict) -> tuple:
+    ir = build_flyer_ir(theme_json)
+    images = []
+    for idx, img in enumerate(theme_json.get("images", [])):
+        path = f"flyer_images/flyer_img_{idx}.png"
+        set_image_slot(ir, idx, path)
+        images.append(f"{idx}: {path} — pos:{img.get('position')}, size:{img.get('size')}, "
+                      f"layer:{img.get('layer')}, radius:{img.get('border_radius', '10px')}")
+    return ir, "\n".join(images)
+
+
+def run_mode(mode: str, ir: FlyerIR, images_meta_str: str, runs: int) -> dict:
+    html = serialize_flyer(ir)
+    prompt = build_refinement_prompt(html, images_meta_str, mode)
+    texts = [el.content for el in ir.elements if el.kind == "text"]
+    latencies, completion_tokens, failures, text_kept, edits = [], [], 0, 0, []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        raw = invoke_llm(prompt)
+        latencies.append(time.perf_counter() - start)
+        completion_tokens.append(estimate_tokens(raw))
+        try:
+            evaluation_json, refined_html = parse_refinement_response(raw, mode)
+        except ValueError:
+            failures += 1
+            continue
+
+        if mode == "patch":
+            patched = FlyerIR.from_dict(ir.to_dict())
+            applied, rejected = apply_style_edits(patched, evaluation_json.get("edits", []))
+            edits.append({"applied": applied, "rejected": len(rejected)})
+            refined_html = serialize_flyer(patched) if applied else None
+        if refined_html is None:
+            failures += 1
+            continue
+        text_kept += all(t in refined_html for t in texts)
+
+    return {
+        "mode": mode,
+        "prompt_tokens_est": estimate_tokens(prompt),
+        "completion_tokens_median": statistics.median(completion_tokens),
+        "latency_median_s": round(statistics.median(latencies), 2),
+        "latency_min_s": round(min(latencies), 2),
+        "failed_runs": failures,
+        "text_content_preserved": f"{text_kept}/{runs}",
+        "edits": edits,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-HTML vs patch-based refinement: tokens and latency")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--theme-json", help="theme_json file to refine instead of the built-in sample")
+    parser.add_argument("--out", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    theme_json = SAMPLE_THEME
+    if args.theme_json:
+        with open(args.theme_json, encoding="utf-8") as f:
+            theme_json = json.load(f)
+    ir, images_meta_str = sample_flyer(theme_json)
+
+    results = [run_mode(mode, ir, images_meta_str, args.runs) for mode in ("html", "patch")]
+    for res in results:
+        print(f"{res['mode']:>5}: prompt ~{res['prompt_tokens_est']} tok, completion ~{res['completion_tokens_median']} tok, "
+              f"latency median {res['latency_median_s']}s (min {res['latency_min_s']}s), "
+              f"failed {res['failed_runs']}/{args.runs}, text preserved {res['text_content_preserved']}")
+    html_res, patch_res = results
+    if patch_res["completion_tokens_median"] and patch_res["latency_median_s"]:
+        print(f"Completion tokens: {html_res['completion_tokens_median'] / patch_res['completion_tokens_median']:.1f}x fewer, "
+              f"latency: {html_res['latency_median_s'] / patch_res['latency_median_s']:.2f}x faster with patches")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
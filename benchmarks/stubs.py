@@ -0,0 +1,107 @@
+# stubs.py
+#
+# Offline stand-ins for the two external backends, so the pipeline can be measured without a
+# Gemini key or a GPU:
+#   StubChatModel          - answers theme / refinement prompts with recorded responses
+#   StubDiffusionPipeline  - tiny CPU "diffusion": numpy work that scales with steps x resolution
+
+import json, time
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+
+RECORDED_THEME = {
+    "theme": {"theme_colors": ["#F1F8E9", "#2E7D32", "#A5D6A7"], "tone": "premium, calm",
+              "imagery_ideas": ["misty tea garden", "tea leaves close-up"]},
+    "texts": [
+        {"content": "Gyokuro Reserve", "font_size": "56px", "font_color": "#1B5E20", "font_style": "serif",
+         "position": "top", "style": ["bold", "shadow"]},
+        {"content": "Refresh Your Soul", "font_size": "32px", "font_color": "#2E7D32", "position": "center",
+         "style": ["italic"]},
+        {"content": "Shade-grown in Yame, Japan", "font_size": "20px", "font_color": "#33691E",
+         "position": "bottom", "style": []},
+    ],
+    "layout": {"background": {"color": "#F1F8E9"}, "layout_shapes": [
+        {"shape": "circle", "position": "top right", "size": "30%", "color": "#A5D6A7", "opacity": 0.5},
+        {"shape": "wave", "position": "bottom", "size": "100%", "color": "#C8E6C9", "opacity": 0.6},
+    ]},
+    "images": [
+        {"description": "Misty Japanese tea garden at dawn", "position": "center", "size": "100%",
+         "layer": "background", "border_radius": "0px"},
+        {"description": "Close-up of green tea leaves with dew", "position": "bottom right", "size": "30%",
+         "layer": "foreground", "border_radius": "50%"},
+    ],
+}
+
+RECORDED_PATCH = {
+    "judgment": "Good hierarchy; the title needs more contrast against the background. Score: 8.2/10",
+    "score": 8.2,
+    "edits": [{"id": "text-0", "style": {"text-shadow": "2px 4px 14px rgba(0,0,0,0.45)"}},
+              {"id": "shape-0", "style": {"opacity": "0.4"}}],
+}
+
+
+class StubChatModel:
+    """Duck-types the LangChain chat model methods the repo uses (invoke / stream / ainvoke)."""
+
+    def __init__(self, latency_s: float = 0.0, responses: dict = None):
+        self.latency_s = latency_s
+        self.responses = responses or {}
+        self.calls = 0
+
+    def _answer(self, prompt: str) -> str:
+        self.calls += 1
+        if self.latency_s: time.sleep(self.latency_s)
+        prompt = str(prompt)
+        if '"edits"' in prompt:
+            return json.dumps(self.responses.get("refine_patch", RECORDED_PATCH))
+        if '"edited_html"' in prompt:
+            html = prompt.split("Here is the flyer HTML:", 1)[-1].split("Images (", 1)[0].strip()
+            return json.dumps(self.responses.get("refine_html", {**RECORDED_PATCH, "edited_html": html}))
+        return "```json\n" + json.dumps(self.responses.get("theme", RECORDED_THEME), indent=2) + "\n```"
+
+    def invoke(self, prompt):
+        return SimpleNamespace(content=self._answer(prompt))
+
+    def stream(self, prompt):
+        text = self._answer(prompt)
+        for i in range(0, len(text), 64):
+            yield SimpleNamespace(content=text[i:i + 64])
+
+    async def ainvoke(self, prompt):
+        return self.invoke(prompt)
+
+
+def stub_llm_factory(latency_s: float = 0.0, responses: dict = None):
+    model = StubChatModel(latency_s, responses)
+    return lambda name, api_key, temperature: model
+
+
+class StubDiffusionPipeline:
+    """CPU stand-in for a diffusers pipeline: a small latent updated once per step, then upsampled."""
+
+    def __init__(self, device: str = "cpu"):
+        self.device = device
+
+    def to(self, device):
+        self.device = device
+        return self
+
+    def __call__(self, prompt, generator=None, num_inference_steps: int = 25, guidance_scale: float = 7.5,
+                 height: int = None, width: int = None):
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        generators = generator if isinstance(generator, list) else [generator] * len(prompts)
+        height, width = height or 512, width or 512
+        images = []
+        for gen in generators:
+            rng = np.random.default_rng(gen.initial_seed() if gen is not None else 0)
+            latent = rng.standard_normal((height // 8, width // 8, 4), dtype=np.float32)
+            for _ in range(num_inference_steps):
+                latent = 0.9 * latent + 0.1 * np.tanh(latent * guidance_scale / 7.5)
+            rgb = ((latent[..., :3] - latent.min()) / (np.ptp(latent) or 1.0) * 255).astype(np.uint8)
+            images.append(Image.fromarray(rgb).resize((width, height), Image.Resampling.BILINEAR))
+        return SimpleNamespace(images=images)
+
+
+def stub_pipeline_factory(model_id: str, device: str, dtype):
+    return StubDiffusionPipeline(device)
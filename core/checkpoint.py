@@ -0,0 +1,73 @@
+import os, json, time, shutil, tempfile
+from dataclasses import asdict, fields
+from core.state import FlyerState
+
+
+# -------------------------------
+# File-based per-node checkpoints
+# -------------------------------
+def state_to_dict(state: FlyerState) -> dict:
+    return asdict(state)
+
+
+def state_from_dict(data: dict) -> FlyerState:
+    known = {f.name for f in fields(FlyerState)}
+    return FlyerState(**{k: v for k, v in data.items() if k in known})
+
+
+class CheckpointStore:
+    """
+    Keeps the FlyerState written after each completed graph node under
+    <root>/<job_id>/<seq>_<node>.json, plus a small index of the completion order.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def _index_path(self, job_id: str) -> str:
+        return os.path.join(self._job_dir(job_id), "index.json")
+
+    def _write_json(self, path: str, payload):
+        # Atomic: a crash mid-write never leaves a truncated checkpoint behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def history(self, job_id: str) -> list:
+        path = self._index_path(job_id)
+        if not os.path.exists(path): return []
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save(self, job_id: str, node: str, state: FlyerState) -> str:
+        os.makedirs(self._job_dir(job_id), exist_ok=True)
+        history = self.history(job_id)
+        filename = f"{len(history):03d}_{node}.json"
+        self._write_json(os.path.join(self._job_dir(job_id), filename), state_to_dict(state))
+        history.append({"node": node, "file": filename, "saved_at": time.time()})
+        self._write_json(self._index_path(job_id), history)
+        return filename
+
+    def load(self, job_id: str, node: str = None):
+        """Latest checkpoint for the job (or the latest one written by `node`), or None."""
+        for entry in reversed(self.history(job_id)):
+            if node is None or entry["node"] == node:
+                with open(os.path.join(self._job_dir(job_id), entry["file"]), encoding="utf-8") as f:
+                    return state_from_dict(json.load(f))
+        return None
+
+    def last_node(self, job_id: str):
+        history = self.history(job_id)
+        return history[-1]["node"] if history else None
+
+    def delete(self, job_id: str) -> bool:
+        """Remove every checkpoint of the job; returns whether it had any."""
+        job_dir = self._job_dir(job_id)
+        if not os.path.isdir(job_dir):
+            return False
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return True
@@ -15,11 +15,112 @@ Gemini2Flash_MODEL = os.getenv("Gemini2Flash_MODEL", "models/gemini-2.5-flash")
 ACTIVE_MODEL = Gemini2Pro_MODEL
 ACTIVE_API_KEY = Gemini2Pro_API_KEY
 
-MODEL_MODE = "pro"
+MODEL_MODE = os.getenv("MODEL_MODE", "pro")  # Model used when LLM_ROUTING is "fixed"
 if MODEL_MODE == "flash":
     ACTIVE_MODEL = Gemini2Flash_MODEL
     ACTIVE_API_KEY = Gemini2Flash_API_KEY
 
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.6"))
+LLM_JSON_REASK_ATTEMPTS = int(os.getenv("LLM_JSON_REASK_ATTEMPTS", "1"))  # Targeted re-asks when repair is not enough
+
+# Per-call Flash / Pro routing (models/llm_router.py)
+LLM_ROUTING = os.getenv("LLM_ROUTING", "adaptive")  # adaptive | fixed (always MODEL_MODE)
+LLM_ROUTER_COMPLEXITY_THRESHOLD = float(os.getenv("LLM_ROUTER_COMPLEXITY_THRESHOLD", "0.6"))  # 0..1, Pro above
+LLM_THEME_SLO_SECONDS = float(os.getenv("LLM_THEME_SLO_SECONDS", "30"))
+LLM_REFINE_SLO_SECONDS = float(os.getenv("LLM_REFINE_SLO_SECONDS", "30"))
+LLM_ROUTER_QUEUE_DEPTH = int(os.getenv("LLM_ROUTER_QUEUE_DEPTH", "4"))  # Queued jobs + in-flight calls forcing Flash
+LLM_ROUTER_MAX_FLASH_FAILURE_RATE = float(os.getenv("LLM_ROUTER_MAX_FLASH_FAILURE_RATE", "0.3"))
+LLM_ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "20"))  # Recent calls per node/model for failure rates
+# USD per 1M tokens (input, output), for the recorded cost impact of each decision
+LLM_PRO_PRICE_PER_MTOK = (float(os.getenv("LLM_PRO_INPUT_PRICE", "1.25")),
+                          float(os.getenv("LLM_PRO_OUTPUT_PRICE", "10.00")))
+LLM_FLASH_PRICE_PER_MTOK = (float(os.getenv("LLM_FLASH_INPUT_PRICE", "0.30")),
+                            float(os.getenv("LLM_FLASH_OUTPUT_PRICE", "2.50")))
+
 
 if ACTIVE_API_KEY:
-    os.environ["GOOGLE_API_KEY"] = ACTIVE_API_KEY
\ No newline at end of file
+    os.environ["GOOGLE_API_KEY"] = ACTIVE_API_KEY
+
+
+# Diffusion pipeline
+DIFFUSION_MODEL_ID = os.getenv("DIFFUSION_MODEL_ID", "runwayml/stable-diffusion-v1-5")
+DIFFUSION_DEVICE = os.getenv("DIFFUSION_DEVICE", "auto")  # auto | cuda | mps | cpu
+DIFFUSION_IDLE_OFFLOAD_SECONDS = float(os.getenv("DIFFUSION_IDLE_OFFLOAD_SECONDS", "300"))
+DIFFUSION_MEMORY_BUDGET_MB = float(os.getenv("DIFFUSION_MEMORY_BUDGET_MB", "0"))  # 0 = no budget
+DIFFUSION_STEPS = int(os.getenv("DIFFUSION_STEPS", "25"))
+DIFFUSION_GUIDANCE_SCALE = float(os.getenv("DIFFUSION_GUIDANCE_SCALE", "7.5"))
+DIFFUSION_SEED = int(os.getenv("DIFFUSION_SEED", "-1"))  # -1 = seed derived from the image prompt
+DIFFUSION_BATCHED = os.getenv("DIFFUSION_BATCHED", "true").lower() == "true"
+DIFFUSION_MAX_BATCH_SIZE = int(os.getenv("DIFFUSION_MAX_BATCH_SIZE", "4"))
+# Cross-request batching: auto = only in processes running several flyers at once (worker.py, batch_generate.py)
+DIFFUSION_SCHEDULER_MODE = os.getenv("DIFFUSION_SCHEDULER_ENABLED", "auto").lower()  # auto | true | false
+DIFFUSION_SCHEDULER_ENABLED = DIFFUSION_SCHEDULER_MODE == "true"
+DIFFUSION_BATCH_MAX_WAIT_MS = float(os.getenv("DIFFUSION_BATCH_MAX_WAIT_MS", "50"))  # Latency vs throughput knob
+DIFFUSION_RESOLUTION_AWARE = os.getenv("DIFFUSION_RESOLUTION_AWARE", "true").lower() == "true"  # Size from the layout
+DIFFUSION_RENDER_SCALE = float(os.getenv("DIFFUSION_RENDER_SCALE", "1.0"))  # Generated px per rendered CSS px
+DIFFUSION_MIN_SIDE = int(os.getenv("DIFFUSION_MIN_SIDE", "320"))  # SD quality drops sharply below this
+DIFFUSION_MAX_SIDE = int(os.getenv("DIFFUSION_MAX_SIDE", "768"))
+DIFFUSION_MIN_STEPS = int(os.getenv("DIFFUSION_MIN_STEPS", "12"))
+# CPU backend (used when DIFFUSION_DEVICE resolves to cpu)
+DIFFUSION_CPU_MODEL_ID = os.getenv("DIFFUSION_CPU_MODEL_ID", "")  # e.g. a distilled model; "" = DIFFUSION_MODEL_ID
+DIFFUSION_CPU_DTYPE = os.getenv("DIFFUSION_CPU_DTYPE", "float32")  # float32 | bfloat16 (needs AVX512-BF16/AMX)
+DIFFUSION_CPU_THREADS = int(os.getenv("DIFFUSION_CPU_THREADS", "0"))  # 0 = all cores available to the process
+DIFFUSION_ATTENTION_SLICING = os.getenv("DIFFUSION_ATTENTION_SLICING", "auto")  # auto (cpu/mps) | true | false
+DIFFUSION_VAE_TILING = os.getenv("DIFFUSION_VAE_TILING", "auto")  # auto (cpu/mps) | true | false
+DIFFUSION_COMPILE = os.getenv("DIFFUSION_COMPILE", "false").lower() == "true"  # torch.compile the UNet
+
+# Generated image cache
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "cache/images")
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+
+# Theme analysis (LLM response) cache
+THEME_CACHE_ENABLED = os.getenv("THEME_CACHE_ENABLED", "true").lower() == "true"
+THEME_CACHE_PATH = os.getenv("THEME_CACHE_PATH", "cache/theme_cache.sqlite3")
+THEME_CACHE_TTL_SECONDS = float(os.getenv("THEME_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+THEME_CACHE_MAX_ENTRIES = int(os.getenv("THEME_CACHE_MAX_ENTRIES", "5000"))
+
+# Near-duplicate prompt cache (utils/prompt_index.py)
+SEMANTIC_CACHE_MODE = os.getenv("SEMANTIC_CACHE_MODE", "suggest")  # off | suggest (warm-start preview) | reuse (skip the LLM)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "cache/prompt_index.sqlite3")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.8"))  # Cosine similarity of hashed n-grams
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(THEME_CACHE_TTL_SECONDS)))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "1024"))
+
+# Pipeline execution
+PIPELINE_OVERLAP_REFINEMENT = os.getenv("PIPELINE_OVERLAP_REFINEMENT", "true").lower() == "true"
+THEME_STREAMING = os.getenv("THEME_STREAMING", "false").lower() == "true"
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+
+# Background job queue (Streamlit submits, worker.py runs)
+JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE_ENABLED", "true").lower() == "true"  # Used only while a worker is alive
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "cache/jobs.sqlite3")
+JOB_QUEUE_MAX_PENDING = int(os.getenv("JOB_QUEUE_MAX_PENDING", "20"))  # Admission control; 0 = unbounded
+JOB_QUEUE_POLL_SECONDS = float(os.getenv("JOB_QUEUE_POLL_SECONDS", "1.0"))
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))  # Re-queue running jobs after this long without a heartbeat
+
+# Refinement loop
+REFINEMENT_MODE = os.getenv("REFINEMENT_MODE", "patch")  # patch (style edits by element id) | html (full edited_html)
+REFINEMENT_MAX_ITERATIONS = int(os.getenv("REFINEMENT_MAX_ITERATIONS", "3"))
+REFINEMENT_TARGET_SCORE = float(os.getenv("REFINEMENT_TARGET_SCORE", "9.0"))
+REFINEMENT_MIN_SCORE_GAIN = float(os.getenv("REFINEMENT_MIN_SCORE_GAIN", "0.25"))
+REFINEMENT_HTML_SIMILARITY_STOP = float(os.getenv("REFINEMENT_HTML_SIMILARITY_STOP", "0.98"))
+REFINEMENT_TIME_BUDGET_S = float(os.getenv("REFINEMENT_TIME_BUDGET_S", "120"))
+REFINEMENT_TOKEN_BUDGET = int(os.getenv("REFINEMENT_TOKEN_BUDGET", "60000"))
+
+# Per-job artifacts (content-addressed images / HTML shared by concurrent sessions)
+ARTIFACT_STORE_ENABLED = os.getenv("ARTIFACT_STORE_ENABLED", "true").lower() == "true"
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+ARTIFACT_RETENTION_HOURS = float(os.getenv("ARTIFACT_RETENTION_HOURS", "24"))  # 0 = keep until max jobs
+ARTIFACT_MAX_JOBS = int(os.getenv("ARTIFACT_MAX_JOBS", "500"))  # 0 = unbounded
+
+# Preview rendering
+PREVIEW_ASSET_CACHE_MB = float(os.getenv("PREVIEW_ASSET_CACHE_MB", "64"))
+
+# Display assets: generated images downscaled to their rendered size and transcoded for HTML/previews
+ASSET_OPTIMIZATION_ENABLED = os.getenv("ASSET_OPTIMIZATION_ENABLED", "true").lower() == "true"
+ASSET_FORMAT = os.getenv("ASSET_FORMAT", "webp").lower()  # webp | jpeg | png
+ASSET_QUALITY = int(os.getenv("ASSET_QUALITY", "82"))
+ASSET_SCALE = float(os.getenv("ASSET_SCALE", "1.0"))  # Asset px per rendered CSS px (2.0 for HiDPI screens)
@@ -0,0 +1,282 @@
+import re, html
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List
+from utils.helpers import get_position_coordinates, safe_float, get_valid_color, parse_size
+
+
+# -------------------------------
+# Flyer intermediate representation
+# -------------------------------
+@dataclass
+class FlyerElement:
+    id: str  # Stable address used by the nodes (and by refinement patches): shape-0, text-1, image-0 ...
+    kind: str  # shape | wave | text | image | overlay
+    style: Dict[str, str] = field(default_factory=dict)
+    content: str = ""  # Text content, or the image src (empty = image slot not filled yet)
+
+
+@dataclass
+class FlyerIR:
+    width: int = 800
+    height: int = 600
+    style: Dict[str, str] = field(default_factory=dict)
+    elements: List[FlyerElement] = field(default_factory=list)
+
+    def find(self, element_id: str):
+        for el in self.elements:
+            if el.id == element_id:
+                return el
+        return None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        data = dict(data or {})
+        elements = [FlyerElement(**el) for el in data.pop("elements", [])]
+        return cls(elements=elements, **data)
+
+
+# -------------------------------
+# theme_json -> IR
+# -------------------------------
+def _image_style(pos, size, layer, border_radius) -> Dict[str, str]:
+    x, y = get_position_coordinates(pos or "center")
+    size = parse_size(size or "40%")
+    # The z-index is set to 1 for the background image, and 2 for foreground images/shapes
+    z_index = 1 if '100%' in str(size) and 'background' in str(layer or "").lower() else 2
+    return {"position": "absolute", "top": f"{y}%", "left": f"{x}%", "width": size, "height": size,
+            "transform": "translate(-50%,-50%)", "z-index": str(z_index), "pointer-events": "none",
+            "border-radius": border_radius or "10px", "object-fit": "cover"}
+
+
+def image_footprint(size, canvas_width: int = FlyerIR.width, canvas_height: int = FlyerIR.height) -> tuple:
+    """Rendered (width, height) in CSS px of an image slot styled by _image_style (object-fit: cover)."""
+    size = parse_size(size or "40%")
+    if size.endswith("px"):
+        side = max(1.0, safe_float(size))
+        return side, side
+    # Percent sizes apply to both CSS width and height, so the box follows the canvas aspect ratio
+    fraction = min(max(safe_float(size, 40.0), 1.0), 100.0) / 100 if size.endswith("%") else 0.4
+    return canvas_width * fraction, canvas_height * fraction
+
+
+def build_flyer_ir(parsed: dict) -> FlyerIR:
+    theme = parsed.get("theme", {})
+    texts = parsed.get("texts", [])
+    shapes = parsed.get("layout", {}).get("layout_shapes", [])
+    bg_color = parsed.get("layout", {}).get("background", {}).get(
+        "color", theme.get("theme_colors", ["#F8FBF8"])[0]
+    )
+    ir = FlyerIR(style={"width": "800px", "height": "600px", "border-radius": "20px", "overflow": "hidden",
+                        "position": "relative", "background": bg_color, "font-family": "sans-serif"})
+
+    # Shapes / decorative layers
+    for idx, shape in enumerate(shapes):
+        s_type = shape.get("shape", "rectangle")
+        x, y = get_position_coordinates(shape.get("position", "center"))
+        s_size = parse_size(shape.get("size", "40%"))
+        s_color = get_valid_color(shape.get("color", "#FFFFFF"))
+        opacity = min(safe_float(shape.get("opacity", 0.9), 0.9), 0.6)
+        border_radius = {"circle": "50%", "floral": "50%", "sticker": "20px"}.get(s_type, "15px")
+
+        if s_type == "wave":
+            edge = "bottom" if "bottom" in str(shape.get("position", "")).lower() else "top"
+            ir.elements.append(FlyerElement(f"shape-{idx}", "wave", {
+                "position": "absolute", "left": "10%", "width": "80%", "height": "40%", edge: "0",
+                "z-index": "0", "opacity": str(opacity), "fill": s_color}))
+            continue
+
+        ir.elements.append(FlyerElement(f"shape-{idx}", "shape", {
+            "position": "absolute", "top": f"{y}%", "left": f"{x}%", "width": s_size, "height": s_size,
+            "background": s_color, "opacity": str(opacity), "border-radius": border_radius,
+            "box-shadow": "0 12px 30px rgba(0,0,0,0.15)", "transform": "translate(-50%,-50%)", "z-index": "0"}))
+
+    # Text layers
+    for idx, t in enumerate(texts):
+        color = get_valid_color(t.get("font_color", "#000000"))
+        style_list = t.get("style", []) or []
+        x, y = get_position_coordinates(t.get("position", "center"))
+        shadows = []
+        if "shadow" in style_list: shadows.append("2px 4px 12px rgba(0,0,0,0.35)")
+        if "glow" in style_list: shadows.append("0 0 12px rgba(255,255,255,0.35)")
+        style = {"position": "absolute", "top": f"{y}%", "left": f"{x}%",
+                 "transform": f"translate(-50%,-50%) rotate({t.get('angle', '0deg')})",
+                 "font-family": t.get("font_style", "sans-serif"), "font-size": t.get("font_size", "40px"),
+                 "font-weight": "700" if "bold" in style_list else "400",
+                 "font-style": "italic" if "italic" in style_list else "normal"}
+        if "gradient" in style_list or "gradient(" in str(color):
+            style.update({"background": "linear-gradient(90deg,#388E3C,#A5D6A7)",
+                          "-webkit-background-clip": "text", "color": "transparent"})
+        else:
+            style["color"] = color
+        style.update({"text-shadow": ", ".join(shadows) if shadows else "none", "z-index": "3",
+                      "text-align": "center", "white-space": "nowrap"})
+        ir.elements.append(FlyerElement(f"text-{idx}", "text", style, str(t.get("content", ""))))
+
+    # Image slots (filled by the image node)
+    for idx, img in enumerate(parsed.get("images", [])):
+        ir.elements.append(FlyerElement(f"image-{idx}", "image", _image_style(
+            img.get("position", "center"), img.get("size", "40%"), img.get("layer", "foreground"),
+            img.get("border_radius", "10px"))))
+
+    # Overlay / visual finish
+    ir.elements.append(FlyerElement("overlay", "overlay", {
+        "position": "absolute", "inset": "0", "border-radius": "20px",
+        "box-shadow": "inset 0 0 20px rgba(0,0,0,0.05), inset 0 -20px 40px rgba(0,0,0,0.08)",
+        "z-index": "10", "pointer-events": "none"}))
+    return ir
+
+
+def set_image_slot(ir: FlyerIR, index: int, src: str, pos=None, size=None, layer=None, border_radius=None):
+    """Fill (or clear, with src='') an image slot in place; geometry is refreshed when given."""
+    element = ir.find(f"image-{index}")
+    if element is None:
+        element = FlyerElement(f"image-{index}", "image", _image_style(pos, size, layer, border_radius))
+        ir.elements.insert(len(ir.elements) - 1 if ir.elements and ir.elements[-1].kind == "overlay"
+                           else len(ir.elements), element)
+    elif pos is not None or size is not None:
+        element.style = _image_style(pos, size, layer, border_radius or element.style.get("border-radius"))
+    element.content = src or ""
+    return element
+
+
+# -------------------------------
+# IR -> compact HTML
+# -------------------------------
+def _css(style: Dict[str, str]) -> str:
+    return ";".join(f"{prop}:{value}" for prop, value in style.items())
+
+
+def _element_html(el: FlyerElement, class_name: str, inline: Dict[str, str]) -> str:
+    cls = f' class="{class_name}"' if class_name else ""
+    style = f' style="{_css(inline)}"' if inline else ""
+    if el.kind == "wave":
+        return (f'<svg id="{el.id}"{cls}{style} viewBox="0 0 800 240" preserveAspectRatio="none">'
+                f'<path d="M0,120 C200,40 400,200 800,120 L800,240 L0,240 Z" fill="{el.style.get("fill", "#FFFFFF")}"/>'
+                f'</svg>')
+    if el.kind == "image":
+        return f'<img id="{el.id}"{cls}{style} src="{el.content}"/>'
+    if el.kind == "text":
+        return f'<div id="{el.id}"{cls}{style}>{html.escape(el.content, quote=False)}</div>'
+    return f'<div id="{el.id}"{cls}{style}></div>'
+
+
+def image_tag(ir: FlyerIR, index: int) -> str:
+    """Standalone <img> for one filled slot (all styles inline), used when re-inserting images."""
+    element = ir.find(f"image-{index}")
+    return _element_html(element, "", element.style) if element and element.content else ""
+
+
+def serialize_flyer(ir: FlyerIR, include_images: bool = True) -> str:
+    """
+    Emits the flyer in one pass over the elements. Declarations shared by two or more elements
+    are moved into deduplicated CSS classes; only element-specific declarations stay inline.
+    """
+    visible = [el for el in ir.elements if el.kind != "image" or (include_images and el.content)]
+
+    def own_style(el):
+        return {k: v for k, v in el.style.items() if not (el.kind == "wave" and k == "fill")}
+
+    counts = {}
+    for el in visible:
+        for decl in own_style(el).items():
+            counts[decl] = counts.get(decl, 0) + 1
+
+    classes, body = {}, []
+    for el in visible:
+        style = own_style(el)
+        shared = tuple(decl for decl in style.items() if counts[decl] > 1)
+        class_name = ""
+        if shared:
+            class_name = classes.setdefault(shared, f"f{len(classes)}")
+        inline = {k: v for k, v in style.items() if counts[(k, v)] <= 1}
+        body.append(_element_html(el, class_name, inline))
+
+    css = "".join(f".{name}{{{_css(dict(decls))}}}" for decls, name in classes.items())
+    parts = [f"<style>{css}</style>"] if css else []
+    parts.append(f'<div id="flyer" style="{_css(ir.style)}">')
+    parts.extend(body)
+    parts.append("</div>")
+    return "\n".join(parts)
+
+
+# -------------------------------
+# Style edits addressed to element ids (patch-based refinement)
+# -------------------------------
+_CSS_PROPERTY = re.compile(r"^-?[a-z][a-z-]*$")
+_UNSAFE_VALUE = re.compile(r'[;{}<>"]|url\s*\(|expression\s*\(', re.IGNORECASE)
+_LOCKED_PROPERTIES = {"src", "content"}
+
+
+def apply_style_edits(ir: FlyerIR, edits: list) -> tuple:
+    """
+    Applies [{"id": "text-0", "style": {"color": "#FFF", "opacity": null}}, ...] to the IR in place.
+    A null/empty value removes the declaration. Text content and image sources cannot be edited.
+    Returns (applied edit count, list of rejection reasons).
+    """
+    applied, rejected = 0, []
+    for edit in edits if isinstance(edits, list) else []:
+        target = edit.get("id") if isinstance(edit, dict) else None
+        element = ir.find(target) if isinstance(target, str) else None
+        style = edit.get("style") if isinstance(edit, dict) else None
+        if target == "flyer":
+            element_style = ir.style
+        elif element is not None:
+            element_style = element.style
+        else:
+            rejected.append(f"unknown element id: {target!r}")
+            continue
+        if not isinstance(style, dict) or not style:
+            rejected.append(f"{target}: no style declarations")
+            continue
+
+        valid = {}
+        for prop, value in style.items():
+            prop = str(prop).strip().lower()
+            if prop in _LOCKED_PROPERTIES or not _CSS_PROPERTY.match(prop):
+                rejected.append(f"{target}: property {prop!r} is not editable")
+            elif value is not None and (not isinstance(value, (str, int, float)) or _UNSAFE_VALUE.search(str(value))):
+                rejected.append(f"{target}: invalid value for {prop}: {value!r}")
+            else:
+                valid[prop] = None if value is None or str(value).strip() == "" else str(value).strip()
+        for prop, value in valid.items():
+            if value is None:
+                element_style.pop(prop, None)
+            else:
+                element_style[prop] = value
+        applied += 1 if valid else 0
+    return applied, rejected
+
+
+# -------------------------------
+# Keeping image tags in sync with the IR
+# -------------------------------
+_IMG_SRC_PATTERN = re.compile(r'(\bsrc=["\'])([^"\']*)(["\'])')
+_IMG_ID_PATTERN = re.compile(r'<img\b[^>]*\bid=["\']image-(\d+)["\'][^>]*/?>')
+
+
+def reconcile_image_tags(html_content: str, ir: FlyerIR) -> str:
+    """
+    Makes free-form HTML (e.g. LLM-refined) agree with the IR's image slots: tags for empty or
+    unknown slots are dropped, kept tags get the slot's src, and filled slots the HTML lost are
+    re-inserted before the last </div>.
+    """
+    filled = {int(el.id.split("-")[1]): el for el in ir.elements if el.kind == "image" and el.content}
+    present = set()
+
+    def keep_or_drop(match):
+        index = int(match.group(1))
+        if index in filled and index not in present:
+            present.add(index)
+            # The IR owns the source (planned paths reviewed before diffusion finished may differ)
+            return _IMG_SRC_PATTERN.sub(lambda m: f'{m.group(1)}{filled[index].content}{m.group(3)}', match.group(0), 1)
+        return ""
+
+    html_content = _IMG_ID_PATTERN.sub(keep_or_drop, html_content or "")
+    missing = "".join(image_tag(ir, idx) for idx in sorted(filled) if idx not in present)
+    if not missing:
+        return html_content
+    close = html_content.rfind("</div>")
+    return html_content[:close] + missing + html_content[close:] if close >= 0 else html_content + missing
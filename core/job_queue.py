@@ -0,0 +1,156 @@
+import os, json, time, sqlite3, uuid, threading
+from contextlib import closing
+from core import config
+
+
+# -------------------------------
+# Local job queue (SQLite)
+# -------------------------------
+class QueueFullError(RuntimeError):
+    """Raised by submit() when admission control rejects a job."""
+
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class JobQueue:
+    """
+    Durable flyer job queue shared by the Streamlit processes (submit + poll) and worker.py
+    (claim + progress). A job outlives the browser session that submitted it: the UI only keeps
+    the job id. Claims use BEGIN IMMEDIATE, so several worker processes can share one queue.
+    """
+
+    def __init__(self, db_path: str, max_pending: int = 0, stale_seconds: float = 0):
+        self.db_path = db_path
+        self.max_pending = max_pending
+        self.stale_seconds = stale_seconds
+        if os.path.dirname(db_path): os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                job_id TEXT PRIMARY KEY,
+                                prompt TEXT NOT NULL,
+                                options TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                node TEXT,
+                                progress INTEGER NOT NULL DEFAULT 0,
+                                message TEXT,
+                                error TEXT,
+                                worker_id TEXT,
+                                submitted_at REAL NOT NULL,
+                                started_at REAL,
+                                finished_at REAL,
+                                heartbeat_at REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, submitted_at)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS workers (
+                                worker_id TEXT PRIMARY KEY,
+                                heartbeat_at REAL NOT NULL,
+                                running INTEGER NOT NULL DEFAULT 0)""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # Submitting side (UI)
+    def submit(self, prompt: str, options: dict = None, job_id: str = None) -> str:
+        """Queue a job (re-queues an existing id, e.g. to resume it). Raises QueueFullError when full."""
+        job_id = job_id or uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            active = conn.execute(f"SELECT COUNT(*) FROM jobs WHERE status IN {ACTIVE_STATUSES}").fetchone()[0]
+            if self.max_pending and active >= self.max_pending:
+                conn.execute("ROLLBACK")
+                raise QueueFullError(f"{active} flyer jobs are already queued or running; try again shortly.")
+            conn.execute("""INSERT OR REPLACE INTO jobs (job_id, prompt, options, status, progress, message, submitted_at)
+                            VALUES (?, ?, ?, 'queued', 0, 'Waiting for a worker', ?)""",
+                         (job_id, prompt, json.dumps(options or {}), time.time()))
+            conn.execute("COMMIT")
+        return job_id
+
+    def get(self, job_id: str):
+        """Job record as a dict (with its position in the queue while queued), or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            job["options"] = json.loads(job["options"])
+            if job["status"] == "queued":
+                job["position"] = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND submitted_at <= ?",
+                                               (job["submitted_at"],)).fetchone()[0]
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job that no worker has claimed yet."""
+        with closing(self._connect()) as conn:
+            return conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? "
+                                "AND status = 'queued'", (time.time(), job_id)).rowcount > 0
+
+    # Worker side
+    def claim(self, worker_id: str):
+        """Atomically take the oldest queued job, or None."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT job_id FROM jobs WHERE status = 'queued' "
+                               "ORDER BY submitted_at LIMIT 1").fetchone()
+            if row:
+                conn.execute("""UPDATE jobs SET status = 'running', worker_id = ?, started_at = ?, heartbeat_at = ?,
+                                message = 'Started' WHERE job_id = ?""", (worker_id, now, now, row["job_id"]))
+            conn.execute("COMMIT")
+        return self.get(row["job_id"]) if row else None
+
+    def progress(self, job_id: str, node: str, percent: int, message: str):
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE jobs SET node = ?, progress = ?, message = ?, heartbeat_at = ? WHERE job_id = ?",
+                         (node, int(percent), message, time.time(), job_id))
+
+    def finish(self, job_id: str, error: str = None):
+        with closing(self._connect()) as conn:
+            conn.execute("""UPDATE jobs SET status = ?, progress = 100, message = ?, error = ?, finished_at = ?
+                            WHERE job_id = ?""",
+                         ("failed" if error else "done", "Failed" if error else "Completed", error, time.time(), job_id))
+
+    def worker_heartbeat(self, worker_id: str, running: int):
+        with closing(self._connect()) as conn:
+            now = time.time()
+            conn.execute("INSERT OR REPLACE INTO workers (worker_id, heartbeat_at, running) VALUES (?, ?, ?)",
+                         (worker_id, now, running))
+            # Long nodes (diffusion) report no progress for a while; the worker's heartbeat keeps its jobs alive
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE worker_id = ? AND status = 'running'", (now, worker_id))
+
+    def remove_worker(self, worker_id: str):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def active_workers(self, max_age_s: float = 15.0) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat_at >= ?",
+                                (time.time() - max_age_s,)).fetchone()[0]
+
+    def requeue_stale(self) -> int:
+        """Put running jobs whose worker stopped heartbeating back in the queue (they resume from checkpoints)."""
+        if not self.stale_seconds:
+            return 0
+        with closing(self._connect()) as conn:
+            return conn.execute("""UPDATE jobs SET status = 'queued', worker_id = NULL, message = 'Re-queued after worker loss'
+                                   WHERE status = 'running' AND heartbeat_at < ?""",
+                                (time.time() - self.stale_seconds,)).rowcount
+
+    def counts(self) -> dict:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(config.JOB_QUEUE_PATH, config.JOB_QUEUE_MAX_PENDING, config.JOB_STALE_SECONDS)
+        return _job_queue
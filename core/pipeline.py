@@ -0,0 +1,117 @@
+import time, queue, threading
+from concurrent.futures import ThreadPoolExecutor
+from agents.image_agent import image_generator_node, build_image_job, generate_images, finalize_images
+from agents.theme_agent import theme_analyzer_stream_node
+from agents.refinement_agent import (build_images_metadata, planned_images_metadata, request_refinement,
+                                     apply_refinement, build_refinement_prompt, estimate_tokens, refinement_mode,
+                                     refinement_call_attributes)
+from core.flyer_ir import FlyerIR, set_image_slot, serialize_flyer
+from core.state import FlyerState
+from core.tracing import record_span
+
+
+# -------------------------------
+# Overlapped image generation + refinement
+# -------------------------------
+_refinement_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="refine")
+
+
+def image_and_refinement_node(state: FlyerState) -> FlyerState:
+    """
+    Starts the refinement LLM call as soon as theme_json exists and runs diffusion meanwhile.
+    Refinement only needs image paths and layout metadata, which are known before any pixel
+    is generated, so per-flyer latency becomes ~max(LLM, diffusion) instead of their sum.
+    """
+    planned = planned_images_metadata(state)
+    html_for_review = state.html_output or ""
+    if state.flyer_ir:
+        # Review the flyer with its image slots pointing at the paths diffusion is about to write
+        ir = FlyerIR.from_dict(state.flyer_ir)
+        for img in planned:
+            set_image_slot(ir, img["index"], img["path"])
+        html_for_review = serialize_flyer(ir)
+    state.log(
+        f"[refinement_node] Iteration {state.iteration_count} — reviewing HTML with the LLM while images generate.")
+    images_meta_str = build_images_metadata(state, planned)
+    # In patch mode the edits address element ids, so they apply cleanly to the image-filled IR afterwards
+    mode = refinement_mode(state)
+
+    def timed_request():
+        start = time.perf_counter()
+        result = request_refinement(html_for_review, images_meta_str, mode)
+        return result, time.perf_counter() - start, time.time_ns()
+
+    future = _refinement_pool.submit(timed_request)
+    state = image_generator_node(state)
+    (evaluation_json, refined_html, error), duration_s, end_ns = future.result()
+    call = refinement_call_attributes(
+        evaluation_json, estimate_tokens(build_refinement_prompt(html_for_review, images_meta_str, mode)))
+    tokens_est = call["prompt_tokens"] + call["completion_tokens"]
+    # The call ran on the refinement pool; record it afterwards so it nests under this node's span
+    record_span(state, "llm.refine", duration_s, end_ns, mode=mode, overlapped=True, parse_ok=not error, **call)
+
+    # Fallback: if some images failed, the refined layout still applies; apply_refinement reconciles
+    # the <img> tags with the IR, dropping the slots that were never filled.
+    generated = {img.get("index") for img in state.generated_images}
+    missing = [img["index"] + 1 for img in planned if img["index"] not in generated]
+    if missing:
+        state.log(f"⚠️ Images {missing} were not generated; refined flyer uses the available images only.")
+
+    return apply_refinement(state, evaluation_json, refined_html, error, duration_s, tokens_est)
+
+
+# -------------------------------
+# Streamed theme analysis feeding diffusion
+# -------------------------------
+def streaming_theme_image_node(state: FlyerState, on_html=None) -> FlyerState:
+    """
+    Streams the theme LLM response and hands each "images" entry to a diffusion worker the
+    moment it is parsed, so the first image starts generating while the rest of the JSON is
+    still arriving. Jobs that queue up while the worker is busy are generated as one batch.
+    Jobs are tagged with an epoch: an escalated theme call starts a new one, so images from the
+    rejected answer are skipped if still queued and discarded if already generated.
+    """
+    jobs = queue.Queue()
+    saved = {}  # epoch -> {index: generated image entry}
+    epoch = 0
+
+    def diffusion_worker():
+        finished = False
+        while not finished:
+            item = jobs.get()
+            if item is None:
+                return
+            items = [item]
+            while True:
+                try:
+                    item = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                items.append(item)
+            current = epoch
+            batch = [job for job_epoch, job in items if job_epoch == current]
+            if not batch:
+                continue
+            try:
+                generate_images(state, batch, saved.setdefault(current, {}))
+            except Exception as e:
+                state.log(f"❌ [image_generator_node] Critical error: {e}")
+
+    def reset():
+        nonlocal epoch
+        epoch += 1
+
+    worker = threading.Thread(target=diffusion_worker, name="stream-diffusion", daemon=True)
+    worker.start()
+    try:
+        state = theme_analyzer_stream_node(
+            state, on_image=lambda idx, img_data, tone: jobs.put((epoch, build_image_job(idx, img_data, tone))),
+            on_html=on_html, on_reset=reset)
+    finally:
+        jobs.put(None)
+        worker.join()
+
+    return finalize_images(state, saved.get(epoch, {}))
@@ -6,18 +6,30 @@ class FlyerState:
     # Input information
     user_prompt: str = ""
     api_provider: str = "gemini"
+    bypass_cache: bool = False
+    job_id: str = ""
+    output_dir: str = ""  # Root for this run's images/outputs; empty = shared default folders
 
     theme_json: Dict[str, Any] = field(default_factory=dict)
+    theme_model: str = ""  # Model that produced theme_json; keys the theme cache and the prompt index
+    flyer_ir: Dict[str, Any] = field(default_factory=dict)  # FlyerIR.to_dict(); edited by each node
     html_output: str = ""
     html_final: str = ""
     html_refined: str = ""
+    html_refined_base: str = ""  # Latest refined HTML before image injection (input of the next pass)
+    flyer_ir_refined: Dict[str, Any] = field(default_factory=dict)  # IR after the latest patch-mode pass
     flyer_summary: str = ""
     evaluation_json: Dict[str, Any] = field(default_factory=dict)
     generated_images: List[str] = field(default_factory=list)
     iteration_count: int = 1
+    refinement_history: List[Dict[str, Any]] = field(default_factory=list)
 
     # Logging and metadata
     messages: List[str] = field(default_factory=list)
+    trace_id: str = ""
+    spans: List[Dict[str, Any]] = field(default_factory=list)  # Structured timings, see core/tracing.py
+    llm_routing: List[Dict[str, Any]] = field(default_factory=list)  # Flash/Pro decisions, see models/llm_router.py
+    warm_start: Dict[str, Any] = field(default_factory=dict)  # Near-duplicate earlier flyer, see utils/prompt_index.py
     progress_log: str = ""
     error: Optional[str] = None
     needs_refinement: bool = False
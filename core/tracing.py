@@ -0,0 +1,177 @@
+import os, sys, time, uuid, hashlib, threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, spans simply omit RSS growth
+    resource = None
+
+
+# -------------------------------
+# Structured spans on FlyerState
+# -------------------------------
+# Each span is a plain dict appended to state.spans (so it is checkpointed and serialized with the
+# state): name, ids, wall-clock start/end, duration and free-form attributes such as token counts,
+# image resolution, cache hits and memory. Nesting follows the `with span(...)` blocks of the
+# current thread.
+_local = threading.local()
+_MIB = 1024 * 1024
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+# span_id -> CUDA peak bytes seen so far by every open span, across all threads. The CUDA peak counter
+# is process-wide, so it is only read and reset under _cuda_lock, after folding it into all open spans.
+_cuda_peaks = {}
+_cuda_lock = threading.Lock()
+
+
+def _rss_high_water_mib():
+    if resource is None:
+        return None
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (_MIB if sys.platform == "darwin" else 1024)
+
+
+def _cuda():
+    torch = sys.modules.get("torch")  # Only report GPU memory when torch is already loaded
+    return torch.cuda if torch is not None and torch.cuda.is_available() else None
+
+
+def _fold_cuda_peak(cuda):
+    """Credit the peak since the last reset to every open span (caller holds _cuda_lock)."""
+    current = cuda.max_memory_allocated()
+    for span_id, peak in _cuda_peaks.items():
+        if current > peak: _cuda_peaks[span_id] = current
+
+
+def _begin_memory(span_id: str) -> float:
+    """
+    Starts per-span memory accounting; returns the process RSS high-water mark. The CUDA peak counter
+    is reset for the new span once every open span (on any thread) has been credited with the peak
+    so far. Spans open at the same time therefore share the peaks reached while they overlap.
+    """
+    cuda = _cuda()
+    if cuda is not None:
+        with _cuda_lock:
+            _fold_cuda_peak(cuda)
+            cuda.reset_peak_memory_stats()
+            _cuda_peaks[span_id] = 0
+    return _rss_high_water_mib()
+
+
+def _end_memory(span_id: str, rss_at_start) -> dict:
+    """rss_growth_mib: how far the span raised the process peak RSS; cuda_peak_mib: CUDA peak while it was open."""
+    attrs = {}
+    rss = _rss_high_water_mib()
+    if rss is not None and rss_at_start is not None:
+        attrs["rss_growth_mib"] = round(rss - rss_at_start, 1)
+    cuda = _cuda()
+    if cuda is not None:
+        with _cuda_lock:
+            if span_id in _cuda_peaks:
+                # Enclosing and concurrent spans are credited too, so they keep this span's peak
+                _fold_cuda_peak(cuda)
+                attrs["cuda_peak_mib"] = round(_cuda_peaks.pop(span_id) / _MIB, 1)
+    return attrs
+
+
+def _new_span(state, name: str, attributes: dict, parent_id: str = None) -> dict:
+    if not getattr(state, "trace_id", ""):
+        seed = getattr(state, "job_id", "") or uuid.uuid4().hex
+        state.trace_id = hashlib.sha256(seed.encode("utf-8")).hexdigest()[:32]
+    return {
+        "name": name,
+        "trace_id": state.trace_id,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent_id,
+        "thread": threading.current_thread().name,
+        "start_unix_ns": time.time_ns(),
+        "end_unix_ns": None,
+        "duration_ms": None,
+        "status": "ok",
+        "attributes": dict(attributes),
+    }
+
+
+@contextmanager
+def span(state, name: str, **attributes):
+    """Time a block as a span on `state`; the yielded dict's "attributes" can be filled in the block."""
+    stack = _stack()
+    record = _new_span(state, name, attributes, stack[-1]["span_id"] if stack else None)
+    rss_at_start = _begin_memory(record["span_id"])
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["status"] = "error"
+        record["attributes"]["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        stack.pop()
+        record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        record["end_unix_ns"] = record["start_unix_ns"] + int(record["duration_ms"] * 1e6)
+        record["attributes"].update(_end_memory(record["span_id"], rss_at_start))
+        state.spans.append(record)
+
+
+def record_span(state, name: str, duration_s: float, end_unix_ns: int = None, **attributes) -> dict:
+    """
+    Add an already-timed span (e.g. work that ran on another thread) under the current span. Memory
+    is not attributed: it was used before this call, and is counted in the enclosing span.
+    """
+    stack = _stack()
+    record = _new_span(state, name, attributes, stack[-1]["span_id"] if stack else None)
+    record["end_unix_ns"] = end_unix_ns or time.time_ns()
+    record["start_unix_ns"] = record["end_unix_ns"] - int(duration_s * 1e9)
+    record["duration_ms"] = round(duration_s * 1000, 3)
+    state.spans.append(record)
+    return record
+
+
+# -------------------------------
+# Export
+# -------------------------------
+def _otel_value(value) -> dict:
+    if isinstance(value, bool): return {"boolValue": value}
+    if isinstance(value, int): return {"intValue": str(value)}
+    if isinstance(value, float): return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def spans_to_otlp(spans: list, service_name: str = "html-flyer-generator") -> dict:
+    """OTLP/JSON (ExportTraceServiceRequest) payload, accepted by OpenTelemetry collectors' /v1/traces."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}},
+                                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]},
+        "scopeSpans": [{
+            "scope": {"name": "flyer.pipeline"},
+            "spans": [{
+                "traceId": s["trace_id"],
+                "spanId": s["span_id"],
+                **({"parentSpanId": s["parent_id"]} if s["parent_id"] else {}),
+                "name": s["name"],
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(s["start_unix_ns"]),
+                "endTimeUnixNano": str(s["end_unix_ns"]),
+                "attributes": [{"key": k, "value": _otel_value(v)} for k, v in s["attributes"].items() if v is not None]
+                              + [{"key": "thread.name", "value": {"stringValue": s["thread"]}}],
+                "status": {"code": 2 if s["status"] == "error" else 1},
+            } for s in spans],
+        }],
+    }]}
+
+
+def span_summary(spans: list) -> list:
+    """Total / count / max duration per span name, slowest first (for the UI timing tab)."""
+    totals = {}
+    for s in spans:
+        entry = totals.setdefault(s["name"], {"name": s["name"], "count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        entry["count"] += 1
+        entry["total_ms"] = round(entry["total_ms"] + (s["duration_ms"] or 0), 3)
+        entry["max_ms"] = max(entry["max_ms"], s["duration_ms"] or 0)
+    return sorted(totals.values(), key=lambda e: e["total_ms"], reverse=True)
@@ -3,28 +3,139 @@ from langgraph.graph import StateGraph, END
 from agents.image_agent import image_generator_node
 from agents.refinement_agent import refinement_node
 from agents.theme_agent import theme_analyzer_node
+from core import config
+from core.checkpoint import CheckpointStore
+from core.pipeline import image_and_refinement_node, streaming_theme_image_node
 from core.state import FlyerState
+from core.tracing import span
 
 
-def create_workflow() -> StateGraph:
+# -------------------------------
+# Node plan
+# -------------------------------
+def workflow_plan() -> list:
+    """Ordered (node name, function) pairs for the configured execution mode."""
+    if config.THEME_STREAMING:
+        # Streaming theme analysis already generates the images
+        return [("theme", streaming_theme_image_node), ("refine", refinement_node)]
+    if config.PIPELINE_OVERLAP_REFINEMENT:
+        return [("theme", theme_analyzer_node), ("image", image_and_refinement_node)]
+    return [("theme", theme_analyzer_node), ("image", image_generator_node), ("refine", refinement_node)]
+
+
+def _checkpointed(name: str, node_fn, store: CheckpointStore):
+    def run(state: FlyerState) -> FlyerState:
+        # Nodes mutate and return the same state object, so the node span lands on the returned state
+        with span(state, f"node.{name}"):
+            state = node_fn(state)
+        if store and state.job_id:
+            store.save(state.job_id, name, state)
+        return state
+    return run
+
+
+def create_workflow(start_at: str = "theme", store: CheckpointStore = None) -> StateGraph:
     workflow = StateGraph(FlyerState)
+    plan = workflow_plan()
+    nodes = dict(plan)
+    # "refine" is always registered so a job can re-run refinement only, whatever the mode
+    nodes.setdefault("refine", refinement_node)
+    for name, node_fn in nodes.items():
+        workflow.add_node(name, _checkpointed(name, node_fn, store))
+
+    order = [name for name, _ in plan]
+    if start_at not in order:
+        order = [start_at]
+    else:
+        order = order[order.index(start_at):]
 
-    workflow.add_node("theme", theme_analyzer_node)
-    workflow.add_node("image", image_generator_node)
-    workflow.add_node("refine", refinement_node)
+    workflow.set_entry_point(order[0])
+    for current, following in zip(order, order[1:]):
+        workflow.add_edge(current, following)
 
-    workflow.set_entry_point("theme")
-    workflow.add_edge("theme", "image")
-    workflow.add_edge("image", "refine")
-    workflow.add_edge("refine", END)
+    # Bounded refinement loop: keep refining until the score plateaus, the HTML stops changing
+    # or the latency/token budget runs out (see refinement_stop_reason)
+    for name in {order[-1], "refine"}:
+        workflow.add_conditional_edges(name, _next_after_refinement, {"refine": "refine", END: END})
 
     return workflow
 
 
+def _next_after_refinement(state: FlyerState) -> str:
+    # needs_refinement is decided (and the stop reason recorded) at the end of each refinement pass
+    return "refine" if state.needs_refinement else END
+
+
+# -------------------------------
+# Running, resuming and partial re-runs
+# -------------------------------
+def get_checkpoint_store() -> CheckpointStore:
+    return CheckpointStore(config.CHECKPOINT_DIR)
+
+
+def _as_state(result) -> FlyerState:
+    return FlyerState(**result) if isinstance(result, dict) else result
+
+
+def stream_workflow(state: FlyerState, start_at: str = "theme", store: CheckpointStore = None):
+    """Runs the compiled graph, yielding (node name, state) after each completed node."""
+    store = store or get_checkpoint_store()
+    graph = create_workflow(start_at, store).compile()
+    for update in graph.stream(state, stream_mode="updates"):
+        for node, values in update.items():
+            yield node, store.load(state.job_id, node) if state.job_id else _as_state(values)
+
+
+def run_workflow(state: FlyerState, start_at: str = "theme", store: CheckpointStore = None) -> FlyerState:
+    for _, state in stream_workflow(state, start_at, store):
+        pass
+    return state
+
+
+def resume_point(job_id: str, store: CheckpointStore = None) -> tuple:
+    """(checkpointed state, next node to run) for a job; next node is None if it already finished."""
+    store = store or get_checkpoint_store()
+    last = store.last_node(job_id)
+    if last is None:
+        return None, "theme"
+    state = store.load(job_id)
+    order = [name for name, _ in workflow_plan()]
+    position = order.index(last) + 1 if last in order else len(order)
+    if position >= len(order):
+        return state, "refine" if state.needs_refinement else None
+    return state, order[position]
+
+
+def resume_workflow(job_id: str, store: CheckpointStore = None):
+    """Continue a job from the node after its last checkpoint."""
+    store = store or get_checkpoint_store()
+    state, next_node = resume_point(job_id, store)
+    if state is None or next_node is None:
+        return state
+    return run_workflow(state, start_at=next_node, store=store)
+
+
+def rerun_from(job_id: str, node: str = "refine", store: CheckpointStore = None):
+    """Re-run a job from `node`, reusing the checkpoint written before it (e.g. skip diffusion)."""
+    store = store or get_checkpoint_store()
+    order = [name for name, _ in workflow_plan()]
+    previous = order[:order.index(node)] if node in order else order
+    state = None
+    for name in reversed(previous):
+        state = store.load(job_id, name)
+        if state: break
+    if state is None:
+        raise ValueError(f"No checkpoint found before '{node}' for job {job_id}.")
+    if node == "refine":
+        # Start a fresh refinement loop from the checkpointed images and html_final
+        state.refinement_history, state.html_refined_base, state.flyer_ir_refined = [], "", {}
+    return run_workflow(state, start_at=node, store=store)
+
+
 # from IPython.display import Image
 #
 # workflow = create_workflow()
 # # mermaid_code = workflow.draw_mermaid()
 # image = Image(workflow.draw_mermaid_png())
 # with open("VideoMaker.png", "wb") as f:
-#         f.write(image.data)
\ No newline at end of file
+#         f.write(image.data)
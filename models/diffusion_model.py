@@ -0,0 +1,229 @@
+import os, time, threading
+from contextlib import contextmanager
+import torch
+from core import config
+from models.diffusion_scheduler import close_diffusion_schedulers
+
+
+# -------------------------------
+# Device helpers
+# -------------------------------
+def resolve_device(preferred: str = None) -> str:
+    """Pick the accelerator to run diffusion on ('auto' falls back cuda -> mps -> cpu)."""
+    device = (preferred or config.DIFFUSION_DEVICE or "auto").lower()
+    if device != "auto":
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def make_generator(device: str, seed: int):
+    # MPS does not support device-side generators; a CPU generator gives the same reproducibility
+    gen_device = "cpu" if device.startswith("mps") else device
+    return torch.Generator(device=gen_device).manual_seed(int(seed))
+
+
+def pipeline_dtype(device: str):
+    if device.startswith("cuda"):
+        return torch.float16
+    if device == "cpu" and config.DIFFUSION_CPU_DTYPE.lower() in ("bfloat16", "bf16"):
+        return torch.bfloat16
+    return torch.float32  # fp16 on CPU is emulated (slow); MPS is most reliable in fp32
+
+
+def accelerator_memory_mb(device: str) -> float:
+    if device.startswith("cuda") and torch.cuda.is_available():
+        return torch.cuda.memory_allocated() / (1024 * 1024)
+    return 0.0
+
+
+# -------------------------------
+# Pipeline construction
+# -------------------------------
+_pipeline_factory = None
+
+
+def _diffusers_factory(model_id: str, device: str, dtype):
+    # Imported here so that importing the agents does not pay the diffusers import cost
+    from diffusers import DiffusionPipeline
+    return DiffusionPipeline.from_pretrained(model_id, torch_dtype=dtype, use_safetensors=True)
+
+
+def _enabled(setting: str, device: str) -> bool:
+    """auto | true | false switches; 'auto' turns memory savers on where memory bandwidth is the limit."""
+    setting = (setting or "auto").lower()
+    return device in ("cpu", "mps") if setting == "auto" else setting == "true"
+
+
+def configure_cpu_threads() -> int:
+    """Use every core this process may run on (cgroup/affinity aware), or DIFFUSION_CPU_THREADS."""
+    threads = config.DIFFUSION_CPU_THREADS
+    if threads <= 0:
+        threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)  # One pipeline call at a time (run_lock); intra-op threads do the work
+    except RuntimeError:  # Only settable before the first parallel op in the process
+        pass
+    return threads
+
+
+def optimize_pipeline(pipe, device: str) -> list:
+    """Apply the device-appropriate memory/speed settings a pipeline supports. Returns what was applied."""
+    applied = []
+    if device == "cpu":
+        applied.append(f"{configure_cpu_threads()} threads")
+    if _enabled(config.DIFFUSION_ATTENTION_SLICING, device) and hasattr(pipe, "enable_attention_slicing"):
+        pipe.enable_attention_slicing()
+        applied.append("attention slicing")
+    if _enabled(config.DIFFUSION_VAE_TILING, device) and hasattr(pipe, "enable_vae_slicing"):
+        # Decode a batch one image at a time, and large images tile by tile
+        pipe.enable_vae_slicing()
+        pipe.enable_vae_tiling()
+        applied.append("VAE slicing/tiling")
+    unet = getattr(pipe, "unet", None)
+    if unet is not None and device == "cpu":
+        unet.to(memory_format=torch.channels_last)  # Faster oneDNN convolutions
+        applied.append("channels_last")
+    if unet is not None and config.DIFFUSION_COMPILE and hasattr(torch, "compile"):
+        # First call per resolution pays the compile; worth it for long-lived workers only
+        pipe.unet = torch.compile(unet, mode="max-autotune" if device.startswith("cuda") else "default")
+        applied.append("torch.compile")
+    return applied
+
+
+def set_pipeline_factory(factory=None):
+    """Swap the pipeline constructor (e.g. a CPU stub for offline benchmarks). None restores diffusers."""
+    global _pipeline_factory
+    _pipeline_factory = factory
+    with _registries_lock:
+        _registries.clear()
+    close_diffusion_schedulers()
+
+
+# -------------------------------
+# Pipeline residency manager
+# -------------------------------
+class DiffusionPipelineRegistry:
+    """
+    Loads the diffusion pipeline lazily on first use, keeps it warm across requests
+    and moves it back to the CPU when it has been idle or exceeds the memory budget.
+    """
+
+    def __init__(self, model_id: str, device: str = None,
+                 idle_offload_seconds: float = None, memory_budget_mb: float = None):
+        self.model_id = model_id
+        self.device = resolve_device(device)
+        self.idle_offload_seconds = config.DIFFUSION_IDLE_OFFLOAD_SECONDS \
+            if idle_offload_seconds is None else idle_offload_seconds
+        self.memory_budget_mb = config.DIFFUSION_MEMORY_BUDGET_MB if memory_budget_mb is None else memory_budget_mb
+
+        self._pipe = None
+        self._resident = False
+        self._in_use = 0
+        self._last_used = 0.0
+        self._lock = threading.RLock()
+        # Pipeline calls are not thread-safe (the scheduler keeps per-call state); threads sharing
+        # one registry (worker slots, streaming) hold this around each pipe(...) run
+        self.run_lock = threading.Lock()
+        self._idle_timer = None
+        self._stats = {"load_seconds": 0.0, "loads": 0, "acquisitions": 0,
+                       "offloads": 0, "reloads": 0, "reload_seconds": 0.0, "optimizations": []}
+
+    # Loading / residency
+    def _load(self):
+        start = time.perf_counter()
+        dtype = pipeline_dtype(self.device)
+        pipe = (_pipeline_factory or _diffusers_factory)(self.model_id, self.device, dtype)
+        pipe.to(self.device)
+        self._stats["optimizations"] = [str(dtype).replace("torch.", "")] + optimize_pipeline(pipe, self.device)
+        self._pipe = pipe
+        self._resident = True
+        self._stats["loads"] += 1
+        self._stats["load_seconds"] = time.perf_counter() - start
+
+    def _ensure_resident(self):
+        if self._pipe is None:
+            self._load()
+        elif not self._resident:
+            start = time.perf_counter()
+            self._pipe.to(self.device)
+            self._resident = True
+            self._stats["reloads"] += 1
+            self._stats["reload_seconds"] += time.perf_counter() - start
+
+    def offload(self):
+        """Move the pipeline weights off the accelerator (kept in host memory for a fast reload)."""
+        with self._lock:
+            if self._pipe is None or not self._resident or self._in_use or self.device == "cpu":
+                return False
+            self._pipe.to("cpu")
+            self._resident = False
+            self._stats["offloads"] += 1
+            if torch.cuda.is_available(): torch.cuda.empty_cache()
+            return True
+
+    def _offload_if_idle(self):
+        with self._lock:
+            if not self._in_use and time.monotonic() - self._last_used >= self.idle_offload_seconds:
+                self.offload()
+
+    def _schedule_idle_offload(self):
+        if self._idle_timer: self._idle_timer.cancel()
+        if self.idle_offload_seconds <= 0 or self.device == "cpu":
+            return
+        self._idle_timer = threading.Timer(self.idle_offload_seconds, self._offload_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    # Public API
+    @contextmanager
+    def acquire(self):
+        """Yield a warm pipeline; residency is re-evaluated once the caller releases it."""
+        with self._lock:
+            self._ensure_resident()
+            self._in_use += 1
+            self._stats["acquisitions"] += 1
+        try:
+            yield self._pipe
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                self._last_used = time.monotonic()
+                if not self._in_use:
+                    if self.memory_budget_mb and accelerator_memory_mb(self.device) > self.memory_budget_mb:
+                        self.offload()
+                    else:
+                        self._schedule_idle_offload()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "model_id": self.model_id,
+                "device": self.device,
+                "loaded": self._pipe is not None,
+                "resident": self._resident,
+                "in_use": self._in_use,
+                "idle_seconds": round(time.monotonic() - self._last_used, 2) if self._last_used else None,
+                "accelerator_memory_mb": round(accelerator_memory_mb(self.device), 1),
+                **self._stats,
+            }
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_pipeline_registry(model_id: str = None, device: str = None) -> DiffusionPipelineRegistry:
+    """Process-wide registry lookup, one residency manager per (model, device)."""
+    device = resolve_device(device)
+    # CPU-only nodes can serve a smaller (e.g. distilled) model than the GPU default
+    model_id = model_id or (device == "cpu" and config.DIFFUSION_CPU_MODEL_ID) or config.DIFFUSION_MODEL_ID
+    key = (model_id, device)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = DiffusionPipelineRegistry(model_id, device=key[1])
+        return _registries[key]
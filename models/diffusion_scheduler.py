@@ -0,0 +1,147 @@
+import time, threading
+from collections import deque
+from concurrent.futures import Future
+from core import config
+
+
+# -------------------------------
+# Cross-request micro-batching scheduler
+# -------------------------------
+class DiffusionBatchScheduler:
+    """
+    Single dispatcher in front of one pipeline registry. Image jobs submitted by any thread (concurrent
+    flyers in the worker, streaming theme analysis, ...) wait up to `max_wait_s` for compatible jobs
+    (same batch key: resolution, steps, guidance) and run as one batched pipeline call. Each caller
+    gets a Future resolving to its own image or exception. close() runs what is queued and stops the
+    dispatcher thread.
+    """
+
+    def __init__(self, registry, run_batch, batch_key, max_batch_size: int = None, max_wait_ms: float = None):
+        self.registry = registry
+        self.run_batch = run_batch  # (pipe, device, [job]) -> [(job, image_or_exception)]
+        self.batch_key = batch_key
+        self.max_batch_size = max(1, max_batch_size or config.DIFFUSION_MAX_BATCH_SIZE)
+        self.max_wait_s = (config.DIFFUSION_BATCH_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000
+
+        self._pending = []  # [(job, future, enqueued_at)] in arrival order
+        self._cond = threading.Condition()
+        self._closed = False
+        self._waits_ms = deque(maxlen=1000)
+        self._stats = {"requests": 0, "batches": 0, "images": 0, "run_seconds": 0.0, "batch_sizes": {}}
+        self._thread = threading.Thread(target=self._dispatch_loop, name="diffusion-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, job: dict) -> Future:
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Diffusion scheduler is closed")
+            self._pending.append((job, future, time.monotonic()))
+            self._stats["requests"] += 1
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        """
+        Block until some batch key has a full batch, or its oldest request has waited max_wait_s, then
+        take that batch (full ones first). None once closed with nothing left to run.
+        """
+        with self._cond:
+            while True:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return None
+                groups = {}  # batch key -> requests in arrival order, keys ordered by their oldest request
+                for req in self._pending:
+                    groups.setdefault(self.batch_key(req[0]), []).append(req)
+                now = time.monotonic()
+                batch = next((g for g in groups.values() if len(g) >= self.max_batch_size), None)
+                if batch is None and (self._closed or self._pending[0][2] + self.max_wait_s <= now):
+                    batch = next(iter(groups.values()))  # The group holding the oldest request
+                if batch is not None:
+                    batch = batch[:self.max_batch_size]
+                    taken = {id(req) for req in batch}
+                    self._pending = [req for req in self._pending if id(req) not in taken]
+                    return batch
+                self._cond.wait(self._pending[0][2] + self.max_wait_s - now)
+
+    def _dispatch_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            started = time.monotonic()
+            with self._cond:
+                self._waits_ms.extend((started - enqueued_at) * 1000 for _, _, enqueued_at in batch)
+            try:
+                with self.registry.acquire() as pipe, self.registry.run_lock:
+                    results = self.run_batch(pipe, self.registry.device, [job for job, _, _ in batch])
+            except Exception as e:  # Pipeline could not be loaded: fail every caller in the batch
+                results = [(job, e) for job, _, _ in batch]
+            outcomes = {id(job): outcome for job, outcome in results}
+            for job, future, _ in batch:
+                future.set_result(outcomes.get(id(job), RuntimeError("Diffusion batch returned no image for this job")))
+
+            with self._cond:
+                size = len(batch)
+                self._stats["batches"] += 1
+                self._stats["images"] += size
+                self._stats["run_seconds"] += time.monotonic() - started
+                self._stats["batch_sizes"][size] = self._stats["batch_sizes"].get(size, 0) + 1
+
+    def close(self, timeout: float = None):
+        """Refuse new jobs, run the queued ones without waiting for batch-mates, and stop the dispatcher."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            waits = sorted(self._waits_ms)
+            batches = self._stats["batches"]
+            return {
+                "requests": self._stats["requests"],
+                "batches": batches,
+                "queued": len(self._pending),
+                "mean_batch_size": round(self._stats["images"] / batches, 2) if batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._stats["batch_sizes"].items())),
+                "queue_wait_ms_mean": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "queue_wait_ms_p95": round(waits[int(0.95 * (len(waits) - 1))], 1) if waits else 0.0,
+                "run_seconds": round(self._stats["run_seconds"], 2),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_s * 1000,
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def configure_scheduler(concurrent_flyers: int):
+    """
+    Resolves DIFFUSION_SCHEDULER_ENABLED=auto for a process running this many flyers at once. A lone
+    flyer submits all of its images together, so the batching wait would only add latency.
+    """
+    if config.DIFFUSION_SCHEDULER_MODE == "auto":
+        config.DIFFUSION_SCHEDULER_ENABLED = concurrent_flyers > 1
+
+
+def get_diffusion_scheduler(registry, run_batch, batch_key) -> DiffusionBatchScheduler:
+    """Process-wide scheduler per pipeline registry, so every job in the process shares its batches."""
+    with _schedulers_lock:
+        # Keyed on the registry itself: an id() could be reused by a later registry
+        if registry not in _schedulers:
+            _schedulers[registry] = DiffusionBatchScheduler(registry, run_batch, batch_key)
+        return _schedulers[registry]
+
+
+def close_diffusion_schedulers():
+    """Close and forget every scheduler (their registries are being replaced)."""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+        _schedulers.clear()
+    for scheduler in schedulers:
+        scheduler.close()
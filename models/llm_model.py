@@ -1,23 +1,121 @@
+import hashlib, threading
 from langchain_google_genai import ChatGoogleGenerativeAI
 from core import config
 
 
+# -------------------------------
+# Process-wide LLM client registry
+# -------------------------------
+# Clients are built once per (model, api key, temperature) and shared by every node and session,
+# so HTTP connections / TLS sessions are pooled instead of being re-established on each call.
+_clients = {}
+_clients_lock = threading.Lock()
+_llm_factory = None
+
+
+def _gemini_factory(model: str, api_key: str, temperature: float):
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=api_key,
+        temperature=temperature,
+        convert_system_message_to_human=True,
+    )
+
+
+def set_llm_factory(factory=None):
+    """Swap the client constructor (e.g. a local fake chat model in tests). None restores Gemini."""
+    global _llm_factory
+    _llm_factory = factory
+    reset_llm_clients()
+
+
+def reset_llm_clients():
+    with _clients_lock:
+        _clients.clear()
+
+
+def llm_available(api_key: str) -> bool:
+    """A model can be called with this key (any key works with a swapped-in factory)."""
+    return bool(api_key) or _llm_factory is not None
+
+
+def get_llm(model: str = None, api_key: str = None, temperature: float = None):
+    model = model or config.ACTIVE_MODEL
+    api_key = config.ACTIVE_API_KEY if api_key is None else api_key
+    temperature = config.LLM_TEMPERATURE if temperature is None else temperature
+    factory = _llm_factory or _gemini_factory
+
+    if not api_key and factory is _gemini_factory:
+        raise RuntimeError(f"❌ Failed to initialize Gemini LLM ({model}): missing API key.")
+
+    key = (model, hashlib.sha256(api_key.encode("utf-8")).hexdigest(), temperature)
+    with _clients_lock:
+        if key not in _clients:
+            try:
+                _clients[key] = factory(model, api_key, temperature)
+            except Exception as e:
+                raise RuntimeError(f"❌ Failed to initialize Gemini LLM ({model}): {e}")
+        return _clients[key]
+
+
 def initialize_llm():
-    try:
-        model = config.ACTIVE_MODEL
-        api_key = config.ACTIVE_API_KEY
+    # Kept for existing callers; returns the shared client for the active model
+    return get_llm()
+
+
+# -------------------------------
+# Invocation helpers
+# -------------------------------
+# Token usage reported by the provider for the latest call on each thread (see last_usage)
+_usage = threading.local()
+
+
+def _record_usage(message, accumulate: bool = False):
+    usage = getattr(message, "usage_metadata", None) or {}
+    if usage.get("input_tokens") is None and usage.get("output_tokens") is None:
+        return
+    previous = getattr(_usage, "last", None) if accumulate else None
+    # Streamed chunks carry per-chunk deltas
+    _usage.last = {key: (previous or {}).get(key, 0) + (usage.get(key) or 0) for key in ("input_tokens", "output_tokens")}
+
+
+def reset_usage():
+    _usage.last = None
+
+
+def last_usage():
+    """{"input_tokens", "output_tokens"} the provider reported for this thread's latest call, or None."""
+    return getattr(_usage, "last", None)
+
+
+def invoke_llm(prompt, llm=None) -> str:
+    reset_usage()
+    response = (llm or get_llm()).invoke(prompt)
+    _record_usage(response)
+    return getattr(response, "content", str(response)).strip()
+
+
+def stream_llm(prompt, llm=None):
+    """Yield text chunks as the model streams them."""
+    reset_usage()
+    for chunk in (llm or get_llm()).stream(prompt):
+        _record_usage(chunk, accumulate=True)
+        content = getattr(chunk, "content", chunk)
+        if content: yield content if isinstance(content, str) else str(content)
+
+
+async def ainvoke_llm(prompt, llm=None) -> str:
+    reset_usage()
+    response = await (llm or get_llm()).ainvoke(prompt)
+    _record_usage(response)
+    return getattr(response, "content", str(response)).strip()
 
-        if not api_key:
-            raise ValueError(f"Missing API key for Gemini {model_type.upper()} model.")
 
-        llm = ChatGoogleGenerativeAI(
-            model=model,
-            google_api_key=api_key,
-            temperature=0.6,
-            convert_system_message_to_human=True,
-        )
-        return llm
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting Gemini calls; real counts come from last_usage()
+    return len(text or "") // 4
 
-    except Exception as e:
-        raise RuntimeError(f"❌ Failed to initialize Gemini LLM ({model_type}): {e}")
 
+def llm_client_stats() -> dict:
+    with _clients_lock:
+        return {"clients": len(_clients), "models": sorted({key[0] for key in _clients})}
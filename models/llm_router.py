@@ -0,0 +1,263 @@
+import re, time, threading
+from collections import deque
+from contextlib import contextmanager
+from core import config
+from models.llm_model import get_llm, invoke_llm, estimate_tokens, llm_available, reset_usage, last_usage
+
+
+# -------------------------------
+# Complexity signals
+# -------------------------------
+def prompt_complexity(text: str) -> float:
+    """0..1 from the request's length and number of distinct requirements (clauses, list items)."""
+    text = text or ""
+    clauses = len(re.findall(r"[,;:\n]|\band\b|\bwith\b|\bbut\b", text, re.IGNORECASE))
+    return round(min(1.0, len(text.split()) / 120 + clauses / 12), 3)
+
+
+def flyer_complexity(html: str) -> float:
+    """0..1 from the number of addressable flyer elements the reviewer has to balance."""
+    return round(min(1.0, len(re.findall(r'\bid="', html or "")) / 16), 3)
+
+
+# -------------------------------
+# Flash / Pro router
+# -------------------------------
+def _tier_settings(tier: str) -> tuple:
+    if tier == "flash":
+        return config.Gemini2Flash_MODEL, config.Gemini2Flash_API_KEY, config.LLM_FLASH_PRICE_PER_MTOK
+    return config.Gemini2Pro_MODEL, config.Gemini2Pro_API_KEY, config.LLM_PRO_PRICE_PER_MTOK
+
+
+def routed_models() -> list:
+    """Models a routed call may be answered by, Pro first. Cached answers are keyed on the model that produced them."""
+    if config.LLM_ROUTING != "adaptive":
+        return [config.ACTIVE_MODEL]
+    return [config.Gemini2Pro_MODEL, config.Gemini2Flash_MODEL]
+
+
+def _cost(tier: str, prompt_tokens: int, completion_tokens: int) -> float:
+    input_price, output_price = _tier_settings(tier)[2]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+class LLMRouter:
+    """
+    Picks Flash or Pro per call from the request's complexity, the node's latency SLO, load
+    (queued jobs + in-flight LLM calls) and Flash's recent validation failures on that node.
+    Flash output that fails validation is escalated to Pro. Every decision is returned as a
+    plain dict with its latency and cost, so callers can keep it on the state.
+    """
+
+    def __init__(self, window: int = None):
+        self.window = max(1, window or config.LLM_ROUTER_WINDOW)
+        self._lock = threading.Lock()
+        self._outcomes = {}  # (node, tier) -> deque of recent ok flags
+        self._latency = {}  # (node, tier) -> EWMA seconds
+        self._in_flight = 0
+        self._queued_jobs = 0
+        self._held_back = {}  # node -> decisions kept off Flash because of its failure rate
+        self._totals = {"calls": 0, "escalations": 0, "flash": 0, "pro": 0,
+                        "cost_usd": 0.0, "pro_equivalent_usd": 0.0}
+
+    # Signals
+    def observe_queue_depth(self, queued_jobs: int):
+        """Jobs waiting for this process (e.g. reported by the worker from the job queue)."""
+        with self._lock:
+            self._queued_jobs = max(0, int(queued_jobs))
+
+    @contextmanager
+    def in_flight(self):
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def failure_rate(self, node: str, tier: str) -> tuple:
+        """(failure rate, samples) over the last `window` calls of `tier` on `node`."""
+        with self._lock:
+            outcomes = self._outcomes.get((node, tier), ())
+            return (1 - sum(outcomes) / len(outcomes) if outcomes else 0.0), len(outcomes)
+
+    # Decisions
+    def decide(self, node: str, complexity: float, slo_s: float = None) -> dict:
+        slo_s = slo_s or {"theme": config.LLM_THEME_SLO_SECONDS, "refine": config.LLM_REFINE_SLO_SECONDS}.get(node)
+        with self._lock:
+            load = self._queued_jobs + self._in_flight
+            expected_pro_s = self._latency.get((node, "pro"))
+        decision = {"node": node, "complexity": complexity, "load": load, "slo_s": slo_s,
+                    "expected_pro_s": round(expected_pro_s, 2) if expected_pro_s else None, "escalated_from": None}
+
+        if config.LLM_ROUTING != "adaptive":
+            tier, reason = ("flash" if config.ACTIVE_MODEL == config.Gemini2Flash_MODEL else "pro"), "fixed routing"
+        elif not llm_available(config.Gemini2Flash_API_KEY):
+            tier, reason = "pro", "flash not configured"
+        else:
+            rate, samples = self.failure_rate(node, "flash")
+            pressure = []
+            if load >= config.LLM_ROUTER_QUEUE_DEPTH:
+                pressure.append(f"load {load}")
+            if slo_s and expected_pro_s and expected_pro_s > slo_s:
+                pressure.append(f"pro ~{expected_pro_s:.1f}s over {slo_s:.0f}s SLO")
+
+            failing = samples >= 5 and rate >= config.LLM_ROUTER_MAX_FLASH_FAILURE_RATE
+            if failing:
+                with self._lock:
+                    self._held_back[node] = self._held_back.get(node, 0) + 1
+                    # Probe Flash once per window so a recovered Flash can win traffic back
+                    probe = self._held_back[node] % self.window == 0
+            if failing and not probe:
+                tier, reason = "pro", f"flash failing validation ({rate:.0%} of last {samples})"
+            elif failing:
+                tier, reason = "flash", "probe after validation failures"
+            elif complexity > config.LLM_ROUTER_COMPLEXITY_THRESHOLD and not pressure:
+                tier, reason = "pro", f"complex request ({complexity:.2f})"
+            elif pressure:
+                tier, reason = "flash", ", ".join(pressure)
+            else:
+                tier, reason = "flash", f"simple request ({complexity:.2f})"
+        decision.update(tier=tier, model=_tier_settings(tier)[0], reason=reason)
+        return decision
+
+    def escalate(self, decision: dict, reason: str) -> dict:
+        with self._lock:
+            self._totals["escalations"] += 1
+        return {**decision, "tier": "pro", "model": _tier_settings("pro")[0], "reason": reason,
+                "escalated_from": decision["model"]}
+
+    def client(self, decision: dict):
+        if config.LLM_ROUTING != "adaptive":
+            return get_llm()
+        model, api_key, _ = _tier_settings(decision["tier"])
+        return get_llm(model, api_key)
+
+    def record(self, decision: dict, latency_s: float, prompt_tokens: int, completion_tokens: int,
+               ok: bool, error: str = None, tokens_estimated: bool = True) -> dict:
+        """
+        Fold one call's outcome into the node's statistics; returns the decision with its impact.
+        tokens_estimated marks counts from estimate_tokens rather than the provider's usage metadata.
+        """
+        tier, key = decision["tier"], (decision["node"], decision["tier"])
+        cost = _cost(tier, prompt_tokens, completion_tokens)
+        pro_cost = _cost("pro", prompt_tokens, completion_tokens)
+        with self._lock:
+            self._outcomes.setdefault(key, deque(maxlen=self.window)).append(ok)
+            if ok:
+                previous = self._latency.get(key)
+                self._latency[key] = latency_s if previous is None else 0.8 * previous + 0.2 * latency_s
+            self._totals["calls"] += 1
+            self._totals[tier] += 1
+            self._totals["cost_usd"] += cost
+            self._totals["pro_equivalent_usd"] += pro_cost
+        expected = decision["expected_pro_s"]
+        return {**decision, "ok": ok, "error": error, "latency_s": round(latency_s, 3),
+                "latency_vs_pro_s": round(latency_s - expected, 3) if expected and tier != "pro" else None,
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "tokens_estimated": tokens_estimated, "cost_usd": round(cost, 6), "saved_vs_pro_usd": round(pro_cost - cost, 6)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            totals = dict(self._totals)
+            latency = {f"{node}/{tier}": round(s, 2) for (node, tier), s in self._latency.items()}
+            failures = {f"{node}/{tier}": round(1 - sum(o) / len(o), 2)
+                        for (node, tier), o in self._outcomes.items() if o}
+            load = self._queued_jobs + self._in_flight
+        totals.update(cost_usd=round(totals["cost_usd"], 4),
+                      pro_equivalent_usd=round(totals["pro_equivalent_usd"], 4))
+        return {**totals, "load": load, "latency_ewma_s": latency, "failure_rate": failures}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_llm_router() -> LLMRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = LLMRouter()
+        return _router
+
+
+def _add_usage(tokens: dict, prompt_tokens: int, raw: str):
+    """Add the latest call's provider-reported usage to `tokens`, or estimates when it reported none."""
+    usage = last_usage()
+    if usage:
+        tokens["prompt"] += usage["input_tokens"]
+        tokens["completion"] += usage["output_tokens"]
+    else:
+        tokens["prompt"] += prompt_tokens
+        tokens["completion"] += estimate_tokens(raw)
+        tokens["estimated"] = True
+
+
+def invoke_routed(node: str, prompt: str, parse, complexity: float, decisions: list = None, call=None,
+                  slo_s: float = None):
+    """
+    Routed LLM call: parse(raw_text, reask) -> result, raising ValueError when the output fails
+    validation. Flash failures escalate to Pro instead of being re-asked; Pro may re-ask through
+    `reask`. call(llm, escalated) -> raw text overrides the plain invoke (e.g. streaming).
+    Each attempt's decision is appended to `decisions`, with tokens and cost including its re-asks.
+    """
+    router = get_llm_router()
+    decisions = [] if decisions is None else decisions
+    decision = router.decide(node, complexity, slo_s)
+    prompt_tokens = estimate_tokens(prompt)
+    while True:
+        llm = router.client(decision)
+        escalated = decision["escalated_from"] is not None
+        adaptive_flash = config.LLM_ROUTING == "adaptive" and decision["tier"] == "flash"
+        start = time.perf_counter()
+        reset_usage()
+        try:
+            with router.in_flight():
+                raw = call(llm, escalated) if call else invoke_llm(prompt, llm)
+        except Exception as e:
+            # Timeouts, quota errors etc. count against the tier and stay visible in the routing trace
+            decisions.append({**router.record(decision, time.perf_counter() - start, prompt_tokens, 0, ok=False,
+                                              error=f"{type(e).__name__}: {e}"), "call_failed": True})
+            raise
+        # Token totals of this attempt: the call plus every re-ask parse() makes
+        tokens = {"prompt": 0, "completion": 0, "estimated": False, "reasks": 0}
+        _add_usage(tokens, prompt_tokens, raw)
+
+        def reask(reask_prompt, llm=llm, tokens=tokens):
+            reset_usage()
+            text = invoke_llm(reask_prompt, llm)
+            tokens["reasks"] += 1
+            _add_usage(tokens, estimate_tokens(reask_prompt), text)
+            return text
+
+        try:
+            result = parse(raw, None if adaptive_flash else reask)
+        except ValueError as e:
+            decisions.append({**router.record(decision, time.perf_counter() - start, tokens["prompt"],
+                                              tokens["completion"], ok=False, error=str(e),
+                                              tokens_estimated=tokens["estimated"]), "reasks": tokens["reasks"]})
+            if not adaptive_flash:
+                raise
+            decision = router.escalate(decision, f"flash output failed validation: {e}")
+            continue
+        except Exception as e:
+            # A re-ask call that failed outright; the tokens already spent still count
+            decisions.append({**router.record(decision, time.perf_counter() - start, tokens["prompt"],
+                                              tokens["completion"], ok=False, error=f"{type(e).__name__}: {e}",
+                                              tokens_estimated=tokens["estimated"]),
+                              "reasks": tokens["reasks"], "call_failed": True})
+            raise
+        decisions.append({**router.record(decision, time.perf_counter() - start, tokens["prompt"], tokens["completion"],
+                                          ok=True, tokens_estimated=tokens["estimated"]), "reasks": tokens["reasks"]})
+        return result
+
+
+def record_routing(state, decisions: list):
+    """Keep a node's routing decisions on the state (checkpointed with it) and log them."""
+    for d in decisions:
+        state.llm_routing.append(d)
+        outcome = "ok" if d["ok"] else ("call failed" if d.get("call_failed") else "failed validation")
+        if d.get("reasks"): outcome += f" after {d['reasks']} re-ask(s)"
+        state.log(f"🧭 {d['node']} → {d['tier']} ({d['reason']}): {outcome} in {d['latency_s']:.1f}s, "
+                  f"${d['cost_usd']:.4f} (saved ${d['saved_vs_pro_usd']:.4f} vs Pro)")
@@ -0,0 +1,85 @@
+import sys, threading
+from types import ModuleType, SimpleNamespace
+import pytest
+from core import tracing
+
+MIB = 1024 * 1024
+
+
+class FakeCuda:
+    """Process-wide allocation counter with a resettable peak, like torch.cuda."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.allocated = 0
+        self.peak = 0
+
+    def is_available(self):
+        return True
+
+    def alloc(self, mib):
+        with self._lock:
+            self.allocated += mib * MIB
+            self.peak = max(self.peak, self.allocated)
+
+    def free(self, mib):
+        with self._lock:
+            self.allocated -= mib * MIB
+
+    def max_memory_allocated(self):
+        with self._lock:
+            return self.peak
+
+    def reset_peak_memory_stats(self):
+        with self._lock:
+            self.peak = self.allocated
+
+
+@pytest.fixture
+def cuda(monkeypatch):
+    fake = FakeCuda()
+    torch = ModuleType("torch")
+    torch.cuda = fake
+    monkeypatch.setitem(sys.modules, "torch", torch)
+    return fake
+
+
+def test_concurrent_span_keeps_peak_reached_before_another_thread_resets(cuda):
+    state_a, state_b = SimpleNamespace(spans=[]), SimpleNamespace(spans=[])
+    allocated, b_done = threading.Event(), threading.Event()
+
+    def long_span():
+        with tracing.span(state_a, "image"):
+            cuda.alloc(512)
+            cuda.free(512)
+            allocated.set()
+            b_done.wait(5)
+
+    def short_spans():
+        allocated.wait(5)
+        for _ in range(3):
+            with tracing.span(state_b, "theme"):
+                cuda.alloc(8)
+                cuda.free(8)
+        b_done.set()
+
+    threads = [threading.Thread(target=long_span), threading.Thread(target=short_spans)]
+    for t in threads: t.start()
+    for t in threads: t.join(10)
+
+    assert state_a.spans[0]["attributes"]["cuda_peak_mib"] == 512
+    assert [s["attributes"]["cuda_peak_mib"] for s in state_b.spans] == [8, 8, 8]
+    assert not tracing._cuda_peaks
+
+
+def test_nested_span_peak_counts_toward_parent(cuda):
+    state = SimpleNamespace(spans=[])
+    with tracing.span(state, "pipeline"):
+        cuda.alloc(16)
+        cuda.free(16)
+        with tracing.span(state, "diffusion"):
+            cuda.alloc(64)
+            cuda.free(64)
+    inner, outer = state.spans
+    assert inner["attributes"]["cuda_peak_mib"] == 64
+    assert outer["attributes"]["cuda_peak_mib"] == 64
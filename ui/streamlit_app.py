@@ -1,10 +1,13 @@
-import sys, os
+import sys, os, json, time, uuid
 from utils.summary_utils import generate_summary
-from agents.theme_agent import theme_analyzer_node
-from agents.refinement_agent import refinement_node
-from agents.image_agent import image_generator_node, inject_images_for_preview
+from core import config
+from core.job_queue import get_job_queue, QueueFullError
 from core.state import FlyerState
-from utils.helpers import inject_images_for_display
+from core.tracing import span_summary, spans_to_otlp
+from core.workflow import stream_workflow, resume_point, rerun_from, get_checkpoint_store, workflow_plan
+from utils.artifacts import get_artifact_store
+from utils.helpers import inject_images_for_preview
+from utils.prompt_index import find_similar_flyer
 import streamlit as st
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -56,6 +59,7 @@ def create_interface(model, api):
     with col2:
         user_prompt = render_prompt_section()
         handle_generation(user_prompt, api)
+        poll_queued_job()
         render_results()
         render_footer()
 
@@ -93,37 +97,167 @@ def render_prompt_section():
 def handle_generation(user_prompt, api_provider):
     st.markdown("<div class='card'><div class='section-title'>✨ Convert Instructions into Visual</div></div>",
                 unsafe_allow_html=True)
+    bypass_cache = st.checkbox("♻️ Ignore cached theme for this prompt", value=False)
     if st.button("🚀 Generate Flyer", type="primary", use_container_width=True):
         st.session_state.generate_clicked = True
         st.session_state.processing_complete = False
-        generation_process(user_prompt, api_provider)
+        generation_process(user_prompt, api_provider, bypass_cache)
+
+    # Checkpointed jobs can be resumed after a failure, or refined again without re-running diffusion
+    last_job_id = st.session_state.get("last_job_id")
+    if last_job_id:
+        col_resume, col_refine = st.columns(2)
+        if col_resume.button("⏯️ Resume last job", use_container_width=True):
+            state, next_node = resume_point(last_job_id)
+            # A job that failed before its first checkpoint restarts from its original prompt
+            prompt = state.user_prompt if state else st.session_state.get("last_job_prompt", "")
+            options = st.session_state.get("last_job_options", {})
+            if next_node is None:
+                st.info("Last job already completed.")
+            elif not prompt:
+                st.warning("The last job's prompt is no longer available; generate the flyer again.")
+            elif queue_available():
+                # The worker resumes from the job's last checkpoint
+                submit_job(prompt, options, last_job_id)
+            else:
+                run_graph(state or FlyerState(user_prompt=prompt, job_id=last_job_id, **options), start_at=next_node)
+        if col_refine.button("🛠️ Re-run refinement only", use_container_width=True):
+            if queue_available():
+                state = get_checkpoint_store().load(last_job_id)
+                if state is None:
+                    st.warning("The last job has no checkpoint to refine yet; resume it instead.")
+                    return
+                submit_job(state.user_prompt, {"rerun_from": "refine"}, last_job_id)
+                return
+            try:
+                state = rerun_from(last_job_id, "refine")
+                state.flyer_summary = generate_summary(state.theme_json)
+                st.session_state.final_state = state
+            except ValueError as e:
+                st.warning(str(e))
 
 
 # Generation workflow
-def generation_process(user_prompt: str, api_provider: str):
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+NODE_STATUS = {
+    "theme": "🎨 Theme analysis complete",
+    "image": "🖼️ Images generated",
+    "refine": "🛠️ Flyer refined",
+}
+
+
+def generation_process(user_prompt: str, api_provider: str, bypass_cache: bool = False):
+    if not user_prompt or not isinstance(user_prompt, str):
+        st.error("❌ Generation failed: ValueError: Invalid user prompt: must be a non-empty string.")
+        st.session_state.processing_complete = True
+        return
+
+    # Retention GC for other sessions' artifacts (content-addressed, so nothing in use is overwritten)
+    previous_job_id = st.session_state.get("last_job_id")
+    if previous_job_id: get_artifact_store().touch(previous_job_id)
+    get_artifact_store().gc()
+    if not bypass_cache and config.SEMANTIC_CACHE_MODE == "suggest":
+        show_warm_start(user_prompt.strip())
+
+    options = {"api_provider": api_provider, "bypass_cache": bypass_cache}
+    if queue_available():
+        submit_job(user_prompt.strip(), options)
+        return
+
+    state = FlyerState(user_prompt=user_prompt.strip(), job_id=uuid.uuid4().hex, **options)
+    remember_last_job(state.job_id, state.user_prompt, options)
+    run_graph(state)
+
+
+def remember_last_job(job_id: str, prompt: str, options: dict):
+    """Resume needs the prompt and options when the job failed before writing any checkpoint."""
+    st.session_state.last_job_id = job_id
+    st.session_state.last_job_prompt = prompt
+    st.session_state.last_job_options = {k: v for k, v in options.items() if k in ("api_provider", "bypass_cache")}
+
+
+def show_warm_start(prompt: str):
+    """Instant preview of the closest earlier flyer while the new one is generated."""
     try:
-        status_text.info("🚀 Initializing workflow...")
-        progress_bar.progress(10)
+        match = find_similar_flyer(prompt)
+    except Exception:
+        return  # The preview is optional; the pipeline logs index problems itself
+    if not match:
+        return
+    st.info(f"⚡ Similar earlier flyer (similarity {match['similarity']:.2f}): \"{match['prompt']}\". "
+            "Shown while the new flyer is generated; set SEMANTIC_CACHE_MODE=reuse to use such matches directly.")
+    if match["images"]:
+        cols = st.columns(len(match["images"]))
+        for col, img in zip(cols, match["images"]):
+            # The file find_similar_flyer checked; it can still vanish (artifact GC) before it is read
+            try:
+                col.image(img.get("original_path") or img["path"], use_container_width=True)
+            except Exception:
+                col.caption("Preview image no longer available.")
 
-        if not user_prompt or not isinstance(user_prompt, str):
-            raise ValueError("Invalid user prompt: must be a non-empty string.")
 
-        state = FlyerState(user_prompt=user_prompt.strip(), api_provider=api_provider)
-        progress_bar.progress(20)
+# Background queue: when a worker.py process is alive, jobs run there and this session only polls.
+# The job id is kept in the URL, so a browser refresh picks the running job back up.
+def queue_available() -> bool:
+    return config.JOB_QUEUE_ENABLED and get_job_queue().active_workers() > 0
 
-        status_text.info("🎨 Extracting instructions & analyzing theme...")
-        state = theme_analyzer_node(state)
-        progress_bar.progress(30)
 
-        status_text.info("🖼️ Generating images...")
-        state = image_generator_node(state)
-        progress_bar.progress(60)
+def submit_job(prompt: str, options: dict, job_id: str = None):
+    try:
+        job_id = get_job_queue().submit(prompt, options, job_id)
+    except QueueFullError as e:
+        st.warning(f"⏳ {e}")
+        st.session_state.processing_complete = True
+        return
+    if not options.get("rerun_from"): remember_last_job(job_id, prompt, options)
+    st.session_state.queued_job_id = job_id
+    st.session_state.polled_job_done = None
+    st.query_params["job"] = job_id
 
-        status_text.info("🛠️ Refining the flyer...")
-        state = refinement_node(state)
-        progress_bar.progress(80)
+
+def poll_queued_job():
+    job_id = st.session_state.get("queued_job_id") or st.query_params.get("job")
+    if not job_id or st.session_state.get("polled_job_done") == job_id:
+        return
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return
+    if job["options"].get("rerun_from"):
+        st.session_state.last_job_id = job_id
+    else:  # Also restores Resume after a browser refresh
+        remember_last_job(job_id, job["prompt"], job["options"])
+
+    if job["status"] in ("queued", "running"):
+        waiting = f" (position {job['position']} in queue)" if job["status"] == "queued" else ""
+        st.progress(job["progress"])
+        st.info(f"🚀 {job['message']}{waiting}")
+        time.sleep(config.JOB_QUEUE_POLL_SECONDS)
+        st.rerun()
+
+    st.session_state.polled_job_done = job_id
+    st.session_state.queued_job_id = None
+    st.session_state.processing_complete = True
+    if job["status"] == "done":
+        st.session_state.final_state = get_checkpoint_store().load(job_id)
+        st.success("✅ Flyer generated successfully!")
+    elif job["status"] == "failed":
+        st.error(f"❌ Generation failed: {job['error']}")
+
+
+def run_graph(state: FlyerState, start_at: str = "theme"):
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    try:
+        status_text.info("🚀 Running flyer workflow...")
+        progress_bar.progress(10)
+
+        # Progress follows the configured node plan (extra refinement passes stay at the last step)
+        order = [name for name, _ in workflow_plan()]
+        done = order.index(start_at) if start_at in order else 0
+        # Each node is checkpointed, so a failure here keeps the work of completed nodes
+        for node, state in stream_workflow(state, start_at=start_at):
+            done += 1
+            status_text.info(NODE_STATUS.get(node, f"✅ {node} complete"))
+            progress_bar.progress(10 + 80 * min(done, len(order)) // max(len(order), 1))
 
         status_text.info("📝 Generating flyer summary...")
         state.flyer_summary = generate_summary(state.theme_json)
@@ -140,6 +274,25 @@ def generation_process(user_prompt: str, api_provider: str):
         st.session_state.processing_complete = True
 
 
+# Preview memoization: the raw HTML is small, the base64-embedded previews are megabytes,
+# so reruns reuse the embedded result until the HTML or an image file changes
+def assets_signature(final_state: FlyerState) -> tuple:
+    signature = []
+    for img in getattr(final_state, "generated_images", []) or []:
+        try:
+            st_ = os.stat(img["path"])
+            signature.append((img["path"], st_.st_mtime_ns, st_.st_size))
+        except OSError:
+            signature.append((img["path"], None, None))
+    return tuple(signature)
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_previews(original_html: str, refined_html: str, signature: tuple):
+    # `signature` only participates in the cache key (image paths + mtimes + sizes)
+    return inject_images_for_preview(original_html), inject_images_for_preview(refined_html)
+
+
 # Flyer tab
 def render_flyer_tab(final_state: FlyerState, tab):
     with tab:
@@ -150,13 +303,11 @@ def render_flyer_tab(final_state: FlyerState, tab):
         st.markdown("<div class='card'><div class='section-title'>🏞️ Generated Flyer Preview</div></div>",
                     unsafe_allow_html=True)
 
-        # 1. Temporarily inject <img> tags into original HTML (using the helper from utils.helpers)
-        original_html_with_img_tags = inject_images_for_display(final_state)
-        # 2. Convert image paths to base64 for Streamlit display
-        original_html_with_images = inject_images_for_preview(original_html_with_img_tags)
-
-        # Refined HTML is already prepared by the refinement node
-        refined_html_with_images = inject_images_for_preview(final_state.html_refined or final_state.html_final)
+        # html_final is serialized from the flyer IR with its image slots filled, so it already
+        # carries the <img> tags; convert image paths to base64 for Streamlit display (memoized across reruns)
+        original_html_with_images, refined_html_with_images = build_previews(
+            final_state.html_final, final_state.html_refined or final_state.html_final,
+            assets_signature(final_state))
 
         # Display HTML in Streamlit
         st.markdown("### 📝 Original Flyer HTML")
@@ -171,6 +322,16 @@ def render_flyer_tab(final_state: FlyerState, tab):
         with st.expander("🔍 View Refined HTML"):
             st.code(final_state.html_refined or final_state.html_final, language="html")
 
+        # The flyer embeds size-optimized copies; the full-resolution originals are kept for export
+        originals = [img for img in final_state.generated_images if os.path.exists(img.get("original_path", ""))]
+        if originals:
+            with st.expander("📦 Original images"):
+                for img in originals:
+                    with open(img["original_path"], "rb") as f:
+                        st.download_button(f"⬇️ Image {img['index'] + 1} (full resolution PNG)", f.read(),
+                                           file_name=f"flyer_image_{img['index'] + 1}.png", mime="image/png",
+                                           key=f"original_{img['index']}")
+
 
 # Summary tab
 def render_summary_tab(final_state: FlyerState, tab):
@@ -208,6 +369,38 @@ def render_refinement_review_tab(final_state: FlyerState, tab):
         else:
             st.warning("No refinement review data found.")
 
+        history = getattr(final_state, "refinement_history", [])
+        if history:
+            st.markdown("**Refinement passes**")
+            st.dataframe(history, use_container_width=True)
+
+        routing = getattr(final_state, "llm_routing", [])
+        if routing:
+            st.markdown("**Model routing**")
+            st.dataframe([{key: d.get(key) for key in ("node", "tier", "reason", "ok", "latency_s", "cost_usd",
+                                                        "saved_vs_pro_usd", "escalated_from")} for d in routing],
+                         use_container_width=True)
+
+
+# Timings tab
+def render_timings_tab(final_state: FlyerState, tab):
+    with tab:
+        st.markdown("<div class='card'><div class='section-title'>⏱️ Timings</div></div>",
+                    unsafe_allow_html=True)
+        spans = getattr(final_state, "spans", []) or []
+        if not spans:
+            st.info("No timing data recorded for this flyer.")
+            return
+
+        summary = span_summary(spans)
+        st.bar_chart(summary, x="name", y="total_ms")
+        st.dataframe(summary, use_container_width=True)
+        with st.expander("🧵 All spans"):
+            st.dataframe([{"name": s["name"], "duration_ms": s["duration_ms"], "status": s["status"],
+                           "thread": s["thread"], **s["attributes"]} for s in spans], use_container_width=True)
+        st.download_button("⬇️ Download trace (OTLP JSON)", json.dumps(spans_to_otlp(spans), indent=2),
+                           file_name=f"trace_{final_state.job_id or 'flyer'}.json", mime="application/json")
+
 
 # Results overview
 def render_results():
@@ -218,10 +411,11 @@ def render_results():
         st.info("✏️ Write your flyer instructions above and click **Generate** to see the results.")
         return
 
-    tabs = st.tabs(["🏞️ Generated Flyer", "📈 Flyer Summary", "🔍 Refinement Review"])
+    tabs = st.tabs(["🏞️ Generated Flyer", "📈 Flyer Summary", "🔍 Refinement Review", "⏱️ Timings"])
     render_flyer_tab(final_state, tabs[0])
     render_summary_tab(final_state, tabs[1])
     render_refinement_review_tab(final_state, tabs[2])
+    render_timings_tab(final_state, tabs[3])
 
 
 # Footer
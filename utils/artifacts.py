@@ -0,0 +1,156 @@
+import os, io, time, sqlite3, hashlib, threading, tempfile
+from contextlib import closing
+from core import config
+from core.checkpoint import CheckpointStore
+
+
+# -------------------------------
+# Atomic file writes
+# -------------------------------
+def atomic_write_bytes(path: str, data: bytes) -> str:
+    """Write via a temp file in the same folder + os.replace, so readers never see a partial file."""
+    folder = os.path.dirname(path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    return path
+
+
+def encode_png(img) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# -------------------------------
+# Per-job, content-addressed artifact store
+# -------------------------------
+class ArtifactStore:
+    """
+    Artifacts (images, HTML) live once under <root>/blobs/<aa>/<sha256><ext>; each job holds named
+    references to them in a small SQLite index. Identical content written by several jobs (e.g.
+    image cache hits) is stored once and deleted when the last job referencing it is released.
+    Paths are unique per content, so concurrent sessions never overwrite each other's files.
+    """
+
+    def __init__(self, root: str, retention_seconds: float, max_jobs: int):
+        self.root = root
+        self.retention_seconds = retention_seconds
+        self.max_jobs = max_jobs
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                job_id TEXT PRIMARY KEY,
+                                created_at REAL NOT NULL,
+                                last_used REAL NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS refs (
+                                job_id TEXT NOT NULL,
+                                name TEXT NOT NULL,
+                                blob TEXT NOT NULL,
+                                PRIMARY KEY (job_id, name))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_refs_blob ON refs(blob)")
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.root, "index.sqlite3"), timeout=30, isolation_level=None)
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.root, "blobs", blob[:2], blob).replace("\\", "/")
+
+    def put(self, job_id: str, name: str, data: bytes, ext: str) -> str:
+        """Store `data` as the job's artifact `name` (replacing a previous version) and return its path."""
+        blob = hashlib.sha256(data).hexdigest() + ext
+        path = self._blob_path(blob)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # The reference is taken before the file is (re)written: a concurrent release() holding the
+            # write lock either sees this reference or has already unlinked the old file.
+            conn.execute("BEGIN IMMEDIATE")
+            old = conn.execute("SELECT blob FROM refs WHERE job_id = ? AND name = ?", (job_id, name)).fetchone()
+            conn.execute("INSERT INTO jobs (job_id, created_at, last_used) VALUES (?, ?, ?) "
+                         "ON CONFLICT(job_id) DO UPDATE SET last_used = excluded.last_used", (job_id, now, now))
+            conn.execute("INSERT OR REPLACE INTO refs (job_id, name, blob) VALUES (?, ?, ?)", (job_id, name, blob))
+            if old and old[0] != blob:
+                self._delete_orphans(conn, [old[0]])
+            conn.execute("COMMIT")
+        if not os.path.exists(path):
+            atomic_write_bytes(path, data)
+        return path
+
+    def paths(self, job_id: str) -> dict:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT name, blob FROM refs WHERE job_id = ?", (job_id,)).fetchall()
+        return {name: self._blob_path(blob) for name, blob in rows}
+
+    def touch(self, job_id: str):
+        """Mark a job as in use (e.g. its preview is on screen) so retention keeps it."""
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE jobs SET last_used = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def _delete_orphans(self, conn, blobs) -> int:
+        removed = 0
+        for blob in set(blobs):
+            if conn.execute("SELECT 1 FROM refs WHERE blob = ? LIMIT 1", (blob,)).fetchone():
+                continue
+            try:
+                os.remove(self._blob_path(blob))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def release(self, job_id: str) -> int:
+        """Drop the job's references; blobs no other job references are deleted. Returns blobs removed."""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            blobs = [row[0] for row in conn.execute("SELECT blob FROM refs WHERE job_id = ?", (job_id,))]
+            conn.execute("DELETE FROM refs WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            removed = self._delete_orphans(conn, blobs)
+            conn.execute("COMMIT")
+        return removed
+
+    def gc(self, now: float = None, checkpoints=None) -> dict:
+        """
+        Release jobs unused for longer than the retention period, then the oldest beyond max_jobs.
+        Their checkpoints (in `checkpoints`, default CHECKPOINT_DIR) are deleted too: a resume or
+        re-run from them would point at the released artifacts.
+        """
+        checkpoints = checkpoints or CheckpointStore(config.CHECKPOINT_DIR)
+        now = now or time.time()
+        with closing(self._connect()) as conn:
+            expired = []
+            if self.retention_seconds:
+                expired = [row[0] for row in conn.execute(
+                    "SELECT job_id FROM jobs WHERE last_used < ?", (now - self.retention_seconds,))]
+            if self.max_jobs:
+                expired += [row[0] for row in conn.execute(
+                    "SELECT job_id FROM jobs ORDER BY last_used DESC LIMIT -1 OFFSET ?", (self.max_jobs,))]
+        expired = list(dict.fromkeys(expired))
+        removed = sum(self.release(job_id) for job_id in expired)
+        pruned = sum(checkpoints.delete(job_id) for job_id in expired)
+        return {"jobs_released": len(expired), "blobs_removed": removed, "checkpoints_pruned": pruned}
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as conn:
+            jobs = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            refs, blobs = conn.execute("SELECT COUNT(*), COUNT(DISTINCT blob) FROM refs").fetchone()
+        return {"jobs": jobs, "references": refs, "blobs": blobs}
+
+
+_artifact_store = None
+_artifact_store_lock = threading.Lock()
+
+
+def get_artifact_store() -> ArtifactStore:
+    global _artifact_store
+    with _artifact_store_lock:
+        if _artifact_store is None:
+            _artifact_store = ArtifactStore(config.ARTIFACT_DIR, config.ARTIFACT_RETENTION_HOURS * 3600,
+                                            config.ARTIFACT_MAX_JOBS)
+        return _artifact_store
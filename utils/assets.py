@@ -0,0 +1,53 @@
+import io, os
+from PIL import Image
+from core import config
+from core.flyer_ir import FlyerIR, image_footprint
+from utils.artifacts import atomic_write_bytes, get_artifact_store
+from utils.helpers import image_path, images_folder, uses_artifact_store
+
+
+# -------------------------------
+# Display assets
+# -------------------------------
+# The PNG straight out of diffusion is kept as the export original; the flyer HTML and every preview
+# reference a copy scaled to the slot's rendered pixel size and transcoded to WebP/JPEG.
+ASSET_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg", "jpg": ".jpg", "png": ".png"}
+
+
+def asset_extension(fmt: str = None) -> str:
+    return ASSET_EXTENSIONS.get((fmt or config.ASSET_FORMAT).lower(), ".webp")
+
+
+def fit_to_footprint(img: Image.Image, width: float, height: float) -> Image.Image:
+    """Smallest downscale that still covers a width x height box (object-fit: cover); never upscales."""
+    scale = max(width / img.width, height / img.height)
+    if scale >= 1.0:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+
+def encode_asset(img: Image.Image, fmt: str = None, quality: int = None) -> bytes:
+    fmt = (fmt or config.ASSET_FORMAT).lower()
+    quality = config.ASSET_QUALITY if quality is None else quality
+    buffer = io.BytesIO()
+    if fmt in ("jpeg", "jpg"):
+        img.convert("RGB").save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "png":
+        img.save(buffer, format="PNG", optimize=True)
+    else:
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def display_image_path(index, folder="flyer_images") -> str:
+    return os.path.splitext(image_path(index, folder))[0] + asset_extension()
+
+
+def save_display_asset(state, img, index, size, canvas: tuple = None) -> str:
+    """Saves the optimized display copy of a generated image for the slot's `size` and returns its path."""
+    width, height = image_footprint(size, *(canvas or (FlyerIR.width, FlyerIR.height)))
+    data = encode_asset(fit_to_footprint(img, width * config.ASSET_SCALE, height * config.ASSET_SCALE))
+    if uses_artifact_store(state):
+        return get_artifact_store().put(state.job_id, f"image_{index}_display", data, asset_extension())
+    return atomic_write_bytes(display_image_path(index, images_folder(state)), data)
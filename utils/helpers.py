@@ -1,4 +1,7 @@
-import os, re, base64
+import os, re, base64, difflib, threading
+from collections import OrderedDict
+from core import config
+from utils.artifacts import atomic_write_bytes, encode_png, get_artifact_store
 
 
 # -------------------------------
@@ -55,14 +58,41 @@ def parse_size(size_str: str) -> str:
         return "auto"
 
 
+def html_structure_similarity(a: str, b: str) -> float:
+    """0..1 similarity of two HTML documents compared tag-by-tag / style-declaration-by-declaration."""
+    if a == b: return 1.0
+    tokenize = lambda html: re.findall(r"<[^>\s]+|[\w-]+\s*:\s*[^;\"']+|[^<>\s]+", html or "")
+    return difflib.SequenceMatcher(None, tokenize(a), tokenize(b), autojunk=False).ratio()
+
+
 # -------------------------------
 # File & HTML helpers
 # -------------------------------
+def images_folder(state=None) -> str:
+    """Per-run image folder: '<output_dir>/flyer_images' for isolated jobs, 'flyer_images' otherwise."""
+    output_dir = getattr(state, "output_dir", "") or ""
+    return os.path.join(output_dir, "flyer_images").replace("\\", "/") if output_dir else "flyer_images"
+
+
+def image_path(index, folder="flyer_images"):
+    return os.path.join(folder, f"flyer_img_{index}.png").replace("\\", "/")
+
+
 def save_image_locally(img, index, folder="flyer_images"):
-    os.makedirs(folder, exist_ok=True)
-    path = os.path.join(folder, f"flyer_img_{index}.png")
-    img.save(path)
-    return path.replace("\\", "/")
+    return atomic_write_bytes(image_path(index, folder), encode_png(img))
+
+
+def uses_artifact_store(state) -> bool:
+    """Jobs without an explicit output_dir (e.g. Streamlit sessions) write to the shared artifact store."""
+    return config.ARTIFACT_STORE_ENABLED and bool(getattr(state, "job_id", "")) \
+        and not getattr(state, "output_dir", "")
+
+
+def save_job_image(state, img, index) -> str:
+    """Saves a generated image for the state's job; store paths are content-addressed, so never shared by accident."""
+    if uses_artifact_store(state):
+        return get_artifact_store().put(state.job_id, f"image_{index}", encode_png(img), ".png")
+    return save_image_locally(img, index, images_folder(state))
 
 
 def get_image_base64(path: str):
@@ -71,57 +101,76 @@ def get_image_base64(path: str):
         return base64.b64encode(f.read()).decode()
 
 
-def inject_images_for_preview(html_content: str) -> str:
-    """Converts local image paths in HTML to Base64 data URIs for browser/Streamlit display."""
-    matches = re.findall(r'src=["\'](flyer_images/[^"\']+)["\']', html_content)
-    for img_path in set(matches):
-        b64 = get_image_base64(img_path)
-        if b64: html_content = html_content.replace(img_path, f"data:image/png;base64,{b64}")
-    return html_content
+# -------------------------------
+# Encoded asset cache for previews
+# -------------------------------
+IMAGE_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+# Local image files only: data: URIs and http(s) URLs contain ":" and are left alone
+PREVIEW_SRC_PATTERN = re.compile(r'(src=["\'])([^"\':]+\.(?:png|jpe?g|webp))(["\'])', re.IGNORECASE)
+_ENCODE_CHUNK = 3 * 64 * 1024  # Multiple of 3 so chunked base64 output concatenates cleanly
 
+_encoded_assets = OrderedDict()  # (path, mtime_ns, size) -> data URI, least recently used first
+_encoded_assets_bytes = 0
+_encoded_assets_lock = threading.Lock()
 
-def save_html(state_or_content, filename="flyer.html", content_override=None):
-    """Saves HTML content, prioritizing content_override (used to save Base64-embedded previews)."""
-    html = content_override or getattr(state_or_content, "html_refined", None) or getattr(state_or_content,
-                                                                                          "html_final", None)
-    if not html: return None
-    os.makedirs("outputs", exist_ok=True)
-    path = os.path.join("outputs", filename)
-    with open(path, "w", encoding="utf-8") as f: f.write(html)
-    return path
 
+def _encode_file_base64(path: str) -> str:
+    # Stream the file in chunks instead of loading + encoding one large bytes object
+    parts = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(_ENCODE_CHUNK)
+            if not chunk: break
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
 
-# -------------------------------
-# 💡 NEW HELPER for Display Fix (Problem 2)
-# -------------------------------
-def inject_images_for_display(final_state):
-    """
-    Temporarily injects the actual <img> tags (reading position/size/radius)
-    into the 'original' HTML (which only has placeholders) for the Streamlit preview.
-    """
-    html_content = final_state.html_final
-    if not html_content or not getattr(final_state, "generated_images", None):
-        return html_content
 
-    temp_html = html_content
-    theme_images_meta = final_state.theme_json.get("images", [])
+def get_image_data_uri(path: str):
+    """Data URI for a local image, memoized by path + mtime + size within PREVIEW_ASSET_CACHE_MB."""
+    global _encoded_assets_bytes
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _encoded_assets_lock:
+        if key in _encoded_assets:
+            _encoded_assets.move_to_end(key)
+            return _encoded_assets[key]
+
+    mime = IMAGE_MIME_TYPES.get(os.path.splitext(path)[1].lower(), "image/png")
+    data_uri = f"data:{mime};base64,{_encode_file_base64(path)}"
+
+    limit = config.PREVIEW_ASSET_CACHE_MB * 1024 * 1024
+    with _encoded_assets_lock:
+        if key not in _encoded_assets and len(data_uri) <= limit:
+            _encoded_assets[key] = data_uri
+            _encoded_assets_bytes += len(data_uri)
+            while _encoded_assets_bytes > limit:
+                _, evicted = _encoded_assets.popitem(last=False)
+                _encoded_assets_bytes -= len(evicted)
+    return data_uri
 
-    for idx, img in enumerate(final_state.generated_images):
-        x, y = get_position_coordinates(img.get("pos", "center"))
-        z_index = 0 if img.get("layer", "foreground") == "background" else 2
-        size = parse_size(img.get("size", "40%"))
 
-        # Read the border_radius from the theme JSON for dynamic shapes
-        current_img_meta = theme_images_meta[idx] if idx < len(theme_images_meta) else {}
-        border_radius = current_img_meta.get("border_radius", "10px")
+def inject_images_for_preview(html_content: str) -> str:
+    """Converts local image paths in HTML to Base64 data URIs for browser/Streamlit display."""
+    if not html_content or "<img" not in html_content:
+        return html_content
 
-        # Set z-index dynamically based on size/layer for stacking context
-        z_index = 1 if '100%' in str(size) and 'background' in img.get("layer", "").lower() else 2
+    def to_data_uri(match):
+        data_uri = get_image_data_uri(match.group(2))
+        return f"{match.group(1)}{data_uri}{match.group(3)}" if data_uri else match.group(0)
 
-        img_tag = f'<img src="{img["path"]}" style="position:absolute;top:{y}%;left:{x}%;width:{size};height:{size};transform:translate(-50%,-50%);z-index:{z_index};pointer-events:none;border-radius:{border_radius};object-fit:cover;"/>'
-        placeholder = f""
+    # One regex pass builds the output once instead of a full str.replace copy per image
+    return PREVIEW_SRC_PATTERN.sub(to_data_uri, html_content)
 
-        # Replace the placeholder with the <img> tag
-        temp_html = temp_html.replace(placeholder, img_tag)
 
-    return temp_html
\ No newline at end of file
+def save_html(state_or_content, filename="flyer.html", content_override=None):
+    """Saves HTML content, prioritizing content_override (used to save Base64-embedded previews)."""
+    html = content_override or getattr(state_or_content, "html_refined", None) or getattr(state_or_content,
+                                                                                          "html_final", None)
+    if not html: return None
+    if uses_artifact_store(state_or_content):
+        return get_artifact_store().put(state_or_content.job_id, filename, html.encode("utf-8"), ".html")
+    folder = os.path.join(getattr(state_or_content, "output_dir", "") or "", "outputs")
+    return atomic_write_bytes(os.path.join(folder, filename), html.encode("utf-8"))
@@ -0,0 +1,129 @@
+import os, json, hashlib, threading, tempfile
+from collections import OrderedDict
+from PIL import Image
+from core import config
+
+
+# -------------------------------
+# Content-addressed image cache
+# -------------------------------
+def image_cache_key(prompt: str, model_id: str, steps: int, guidance_scale: float, seed: int,
+                    height=None, width=None) -> str:
+    """Hash of everything that determines the diffusion output."""
+    payload = json.dumps({"prompt": prompt, "model_id": model_id, "steps": steps,
+                          "guidance_scale": guidance_scale, "seed": seed,
+                          "height": height, "width": width}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """
+    On-disk PNG cache with size-bounded LRU eviction. Entries are written atomically
+    (temp file + os.replace) so concurrent readers never see a partial image.
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> size in bytes, least recently used first
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._generation_seconds, self._generated = 0.0, 0
+        os.makedirs(folder, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.png")
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith(".png"): continue
+            st = os.stat(os.path.join(self.folder, name))
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+
+    def get(self, key: str):
+        path = self._path(key)
+        with self._lock:
+            if key not in self._index and not os.path.exists(path):
+                self._stats["misses"] += 1
+                return None
+        try:
+            with Image.open(path) as img:
+                img.load()
+                result = img.copy()
+            os.utime(path)  # Refresh recency for other processes sharing the folder
+        except OSError:
+            with self._lock:
+                self._index.pop(key, None)
+                self._stats["misses"] += 1
+            return None
+        with self._lock:
+            self._index[key] = os.path.getsize(path)
+            self._index.move_to_end(key)
+            self._stats["hits"] += 1
+        return result
+
+    def put(self, key: str, img) -> str:
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, format="PNG")
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._index[key] = os.path.getsize(path)
+            self._index.move_to_end(key)
+            self._stats["writes"] += 1
+            self._evict()
+        return path
+
+    def _evict(self):
+        total = sum(self._index.values())
+        while total > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._stats["evictions"] += 1
+
+    def record_generation(self, seconds: float, n_images: int = 1):
+        """Feed observed diffusion time so stats() can estimate the GPU time saved by hits."""
+        with self._lock:
+            self._generation_seconds += seconds
+            self._generated += n_images
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            avg = self._generation_seconds / self._generated if self._generated else 0.0
+            return {
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self._index),
+                "bytes": sum(self._index.values()),
+                "avg_generation_seconds": round(avg, 2),
+                "saved_seconds_estimate": round(self._stats["hits"] * avg, 1),
+            }
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    """Process-wide cache instance, or None when IMAGE_CACHE_ENABLED is off."""
+    global _image_cache
+    if not config.IMAGE_CACHE_ENABLED:
+        return None
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(config.IMAGE_CACHE_DIR, int(config.IMAGE_CACHE_MAX_MB * 1024 * 1024))
+        return _image_cache
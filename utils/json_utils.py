@@ -0,0 +1,273 @@
+import re, json
+from core import config
+from utils.prompt_utils import JSON_REASK_PROMPT
+
+
+# -------------------------------
+# Incremental JSON parsing for streamed LLM output
+# -------------------------------
+class IncrementalJSONParser:
+    """
+    Consumes a streamed JSON object chunk by chunk in a single pass and reports values as soon
+    as they are complete:
+      - on_value(key, value): a top-level key's value has been fully received
+      - on_item(key, index, item): an object inside a top-level array (e.g. "images") is complete
+    Anything before the first '{' (markdown fences, commentary) is ignored.
+    """
+
+    def __init__(self, on_value=None, on_item=None, array_keys=("images",)):
+        self.on_value = on_value
+        self.on_item = on_item
+        self.array_keys = set(array_keys)
+        self.buffer = ""
+        self.values = {}
+        self.done = False
+
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._expect_key = False
+        self._expect_value = False
+        self._key = None
+        self._value_start = None
+        self._item_start = None
+        self._item_count = 0
+
+    def feed(self, chunk: str):
+        if self.done or not chunk:
+            return
+        self.buffer += chunk
+        buf = self.buffer
+        for i in range(self._pos, len(buf)):
+            c = buf[i]
+            if not self._stack:
+                if c == "{":
+                    self._stack.append("{")
+                    self._expect_key = True
+                continue
+
+            depth = len(self._stack)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if depth == 1 and self._expect_key:
+                        self._key = json.loads(buf[self._string_start:i + 1])
+                        self._expect_key = False
+                continue
+
+            if c.isspace():
+                continue
+            if depth == 1 and self._expect_value:
+                self._value_start = i
+                self._expect_value = False
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._stack.append(c)
+                if (len(self._stack) == 3 and c == "{" and self._stack[1] == "["
+                        and self._key in self.array_keys):
+                    self._item_start = i
+            elif c in "}]":
+                self._stack.pop()
+                depth = len(self._stack)
+                if depth == 2 and self._item_start is not None:
+                    self._emit_item(json.loads(buf[self._item_start:i + 1]))
+                    self._item_start = None
+                elif depth == 1 and self._value_start is not None:
+                    self._emit_value(buf[self._value_start:i + 1])
+                elif depth == 0:
+                    if self._value_start is not None:
+                        self._emit_value(buf[self._value_start:i])
+                    self.done = True
+                    self._pos = i + 1
+                    return
+            elif c == "," and depth == 1:
+                if self._value_start is not None:
+                    self._emit_value(buf[self._value_start:i])
+                self._expect_key = True
+            elif c == ":" and depth == 1:
+                self._expect_value = True
+        self._pos = len(buf)
+
+    def _emit_value(self, raw: str):
+        value = json.loads(raw.strip())
+        self.values[self._key] = value
+        self._value_start = None
+        if self.on_value: self.on_value(self._key, value)
+
+    def _emit_item(self, item):
+        index = self._item_count
+        self._item_count += 1
+        if self.on_item: self.on_item(self._key, index, item)
+
+    @property
+    def item_count(self) -> int:
+        """Array items reported through on_item so far."""
+        return self._item_count
+
+    def result(self) -> dict:
+        if not self.done:
+            raise ValueError("Incomplete JSON object in LLM stream.")
+        return dict(self.values)
+
+
+# -------------------------------
+# Tolerant extraction and repair for complete LLM responses
+# -------------------------------
+class JSONExtractionError(ValueError):
+    """No usable JSON object could be recovered from an LLM response."""
+
+
+_CLOSERS = {"{": "}", "[": "]"}
+_FENCED_OBJECT = re.compile(r"```(?:json)?\s*\{", re.IGNORECASE)
+_MAX_CANDIDATES = 3  # Objects tried per response; keeps extraction linear in the response length
+
+
+def _scan_object(text: str, start: int) -> tuple:
+    """
+    One pass from the '{' at `start` to its balanced close, copying the object while dropping
+    // and /* */ comments and trailing commas (strings are copied verbatim). If the text ends first,
+    the copy is cut back to the last point where every value was complete and the open containers
+    are closed, so a partial trailing value is dropped rather than guessed. Returns (json_text, repairs,
+    offset just past the object).
+    """
+    out, stack, repairs = [], [], []
+    safe = None  # (len(out), open containers) at the last point the copy was a valid prefix
+    in_string = escape = False
+    i, n = start, len(text)
+    while i < n:
+        c = text[i]
+        if in_string:
+            out.append(c)
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+            out.append(c)
+        elif c == "/" and text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            repairs.append("comment")
+            continue
+        elif c == "/" and text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            repairs.append("comment")
+            continue
+        elif c in "{[":
+            stack.append(c)
+            out.append(c)
+            # Only the root counts as a cut point: cutting at a nested opener would invent an empty value
+            if len(stack) == 1: safe = (len(out), tuple(stack))
+        elif c in "}]":
+            if not stack or _CLOSERS[stack[-1]] != c:
+                raise JSONExtractionError(f"Unbalanced '{c}' at offset {i}")
+            j = len(out)
+            while j and out[j - 1].isspace(): j -= 1
+            if j and out[j - 1] == ",":
+                del out[j - 1:]
+                repairs.append("trailing comma")
+            stack.pop()
+            out.append(c)
+            if not stack:
+                return "".join(out), repairs, i + 1
+            safe = (len(out), tuple(stack))
+        elif c == ",":
+            safe = (len(out), tuple(stack))
+            out.append(c)
+        else:
+            out.append(c)
+        i += 1
+
+    length, open_containers = safe
+    repairs.append("truncated")
+    return "".join(out[:length]) + "".join(_CLOSERS[c] for c in reversed(open_containers)), repairs, n
+
+
+def extract_json(text: str, schema: dict = None) -> tuple:
+    """
+    (object, repairs) for the first usable top-level JSON object in `text` (fenced block preferred).
+    With a schema, the first candidate that also validates wins; if none does, the first one that
+    parsed is returned so the caller can report its problems.
+    """
+    text = text or ""
+    fenced = _FENCED_OBJECT.search(text)
+    start = fenced.end() - 1 if fenced else text.find("{")
+    error, first = "No JSON object found in LLM output.", None
+    for _ in range(_MAX_CANDIDATES):
+        if start < 0:
+            break
+        try:
+            candidate, repairs, end = _scan_object(text, start)
+            # strict=False accepts raw newlines / tabs inside strings, a common LLM defect
+            value = json.loads(candidate, strict=False)
+        except ValueError as e:  # Includes JSONDecodeError and JSONExtractionError
+            error, end = f"Invalid JSON: {e}", start + 1
+        else:
+            if isinstance(value, dict):
+                found = value, list(dict.fromkeys(repairs))
+                if not schema or not validate_json_schema(value, schema):
+                    return found
+                first = first or found
+        # Past the whole object, so its nested objects do not use up the candidates
+        start = text.find("{", end)
+    if first:
+        return first
+    raise JSONExtractionError(error)
+
+
+def validate_json_schema(value, schema: dict, path: str = "") -> list:
+    """
+    Problems (empty list = valid) for a minimal schema: {key: type, tuple of types, or nested schema}.
+    Every schema key is required; extra keys are allowed.
+    """
+    if not isinstance(value, dict):
+        return [f"{path or 'response'} must be an object"]
+    problems = []
+    for key, expected in schema.items():
+        where = f"{path}.{key}" if path else key
+        if key not in value:
+            problems.append(f"missing key '{where}'")
+        elif isinstance(expected, dict):
+            problems.extend(validate_json_schema(value[key], expected, where))
+        elif not isinstance(value[key], expected):
+            names = "/".join(t.__name__ for t in (expected if isinstance(expected, tuple) else (expected,)))
+            problems.append(f"'{where}' must be {names}, got {type(value[key]).__name__}")
+    return problems
+
+
+def parse_llm_json(text: str, schema: dict = None, reask=None, max_reasks: int = None) -> tuple:
+    """
+    Extract, repair and validate an LLM JSON response. When that is not enough and `reask`
+    (prompt -> response text) is given, sends a targeted correction prompt, at most `max_reasks` times.
+    Returns (object, report) where report = {"repairs": [...], "reasks": n}.
+    """
+    max_reasks = config.LLM_JSON_REASK_ATTEMPTS if max_reasks is None else max_reasks
+    report = {"repairs": [], "reasks": 0}
+    while True:
+        try:
+            value, repairs = extract_json(text, schema)
+            report["repairs"].extend(r for r in repairs if r not in report["repairs"])
+            problems = validate_json_schema(value, schema) if schema else []
+        except JSONExtractionError as e:
+            problems = [str(e)]
+        if not problems:
+            return value, report
+        if reask is None or report["reasks"] >= max_reasks:
+            raise JSONExtractionError("; ".join(problems))
+        report["reasks"] += 1
+        text = reask(JSON_REASK_PROMPT.replace("{problems}", "\n".join(f"- {p}" for p in problems))
+                     .replace("{expected_keys}", ", ".join(schema or {}) or "of the original request")
+                     .replace("{previous_response}", text or ""))
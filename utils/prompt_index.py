@@ -0,0 +1,217 @@
+import os, re, json, time, zlib, sqlite3, threading
+from contextlib import closing
+import numpy as np
+from core import config
+from utils.prompt_utils import THEME_ANALYZER_PROMPT
+from utils.theme_cache import normalize_prompt, theme_cache_key
+from models.llm_router import routed_models
+
+
+# -------------------------------
+# Hashed n-gram prompt vectors
+# -------------------------------
+# Wording that does not change the flyer being asked for
+_STOPWORDS = {"a", "an", "the", "for", "of", "to", "and", "with", "in", "on", "at", "my", "our", "me", "us",
+              "please", "create", "make", "design", "generate", "build", "i", "we", "want", "need", "some"}
+_SYNONYMS = {"poster": "flyer", "leaflet": "flyer", "banner": "flyer", "brochure": "flyer", "ad": "flyer",
+             "luxury": "premium", "luxurious": "premium", "upscale": "premium", "high-end": "premium",
+             "deluxe": "premium", "exclusive": "premium", "cheap": "budget", "affordable": "budget",
+             "sale": "discount", "offer": "discount", "deal": "discount"}
+_WORD = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+
+
+def prompt_words(prompt: str) -> list:
+    """Lower-cased content words, crudely singularized, with domain synonyms folded together."""
+    words = (w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+             for w in _WORD.findall((prompt or "").lower()))
+    words = (_SYNONYMS.get(w, w) for w in words)
+    return [w for w in words if w not in _STOPWORDS]
+
+
+def prompt_key_terms(prompt: str) -> set:
+    """Names and numbers (product names, prices, dates) that two prompts must share to be interchangeable."""
+    terms = set(re.findall(r"\d+(?:[.,:]\d+)*", prompt or ""))
+    for sentence in re.split(r"[.!?\n]+", prompt or ""):
+        words = sentence.split()[1:]  # A sentence's first word is capitalized anyway
+        terms.update(w.lower() for w in (re.sub(r"[^\w'-]", "", w) for w in words) if w[:1].isupper())
+    return {_SYNONYMS.get(t, t) for t in terms} - _STOPWORDS
+
+
+def prompt_vector(prompt: str, dim: int = None) -> np.ndarray:
+    """
+    L2-normalized signed feature-hashing vector of word unigrams, word bigrams and character
+    trigrams (the trigrams absorb inflections and typos). Word order only matters through the bigrams,
+    so "green tea flyer for Gyokuro" and "Gyokuro green tea flyer" land close together.
+    """
+    dim = dim or config.SEMANTIC_CACHE_DIM
+    words = prompt_words(prompt)
+    features = [(w, 1.0) for w in words] + [(f"{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+    features += [(f"#{w[i:i + 3]}", 0.25) for w in (f" {w} " for w in words) for i in range(len(w) - 2)]
+    vector = np.zeros(dim, dtype=np.float32)
+    if not features:
+        return vector
+    # crc32 rather than hash(): vectors are persisted and must be stable across processes
+    hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f, _ in features), dtype=np.uint64, count=len(features))
+    weights = np.fromiter((w for _, w in features), dtype=np.float32, count=len(features))
+    signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, (hashes % dim).astype(np.intp), weights * signs)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def theme_scope(model: str) -> str:
+    """Themes are only interchangeable between prompts analyzed by the same model, temperature and template."""
+    return theme_cache_key("", model, config.LLM_TEMPERATURE, THEME_ANALYZER_PROMPT)
+
+
+# -------------------------------
+# Near-duplicate prompt index (SQLite + in-memory matrix)
+# -------------------------------
+class PromptIndex:
+    """
+    Past prompts with the theme JSON and images they produced. Vectors live in SQLite (shared by the
+    UI and worker processes) and are mirrored into one NumPy matrix, so a lookup is a single
+    matrix-vector product. Bounded by max_entries (least recently used evicted first) and a TTL.
+    """
+
+    def __init__(self, db_path: str, max_entries: int, ttl_seconds: float, dim: int):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "rejected": 0, "writes": 0, "evictions": 0}
+        self._matrices = {}  # scope -> ((rows, last write) at load time, ids, matrix)
+        if os.path.dirname(db_path): os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS prompt_index (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                scope TEXT NOT NULL,
+                                prompt_norm TEXT NOT NULL,
+                                prompt TEXT NOT NULL,
+                                key_terms TEXT NOT NULL,
+                                vector BLOB NOT NULL,
+                                theme_json TEXT NOT NULL,
+                                images TEXT NOT NULL,
+                                job_id TEXT,
+                                created_at REAL NOT NULL,
+                                last_access REAL NOT NULL,
+                                UNIQUE (scope, prompt_norm))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_prompt_index_access ON prompt_index(last_access)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self._stats[name] += n
+
+    def _refresh(self, conn, scope: str):
+        """Reload the matrix when another process (or this one) has written since the last load."""
+        signature = conn.execute("SELECT COUNT(*), MAX(created_at) FROM prompt_index WHERE scope = ?",
+                                 (scope,)).fetchone()
+        with self._lock:
+            loaded = self._matrices.get(scope)
+            if loaded and loaded[0] == signature:
+                return loaded[1], loaded[2]
+        rows = conn.execute("SELECT id, vector FROM prompt_index WHERE scope = ? AND created_at >= ?",
+                            (scope, time.time() - self.ttl_seconds if self.ttl_seconds else 0)).fetchall()
+        ids = [row[0] for row in rows]
+        matrix = (np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), self.dim)
+                  if rows else np.zeros((0, self.dim), dtype=np.float32))
+        with self._lock:
+            self._matrices[scope] = (signature, ids, matrix)
+        return ids, matrix
+
+    def nearest(self, prompt: str, scopes: list, threshold: float, candidates: int = 5):
+        """
+        Closest stored prompt in any of `scopes` at or above `threshold` that shares the query's
+        names and numbers, or None.
+        """
+        query = prompt_vector(prompt, self.dim)
+        with closing(self._connect()) as conn, conn:
+            loaded = [self._refresh(conn, scope) for scope in scopes]
+            ids = [(scope, i) for scope, (scope_ids, _) in zip(scopes, loaded) for i in scope_ids]
+            if not ids or not query.any():
+                self._count("misses")
+                return None
+            similarities = np.concatenate([matrix @ query for _, matrix in loaded])
+            order = np.argsort(-similarities)[:candidates]
+            query_terms = prompt_key_terms(prompt)
+            query_vocabulary = query_terms | set(prompt_words(prompt))
+            norm, oldest = normalize_prompt(prompt), time.time() - self.ttl_seconds if self.ttl_seconds else 0
+            for i in order:
+                if similarities[i] < threshold:
+                    break
+                row = conn.execute("SELECT prompt, prompt_norm, key_terms, theme_json, images, job_id "
+                                   "FROM prompt_index WHERE id = ? AND created_at >= ?", (ids[i][1], oldest)).fetchone()
+                if row is None:
+                    continue
+                # Same wording around a different product name or price is a different flyer
+                terms = set(json.loads(row[2]))
+                if row[1] != norm and not (query_terms <= terms | set(prompt_words(row[0]))
+                                           and terms <= query_vocabulary):
+                    self._count("rejected")
+                    continue
+                conn.execute("UPDATE prompt_index SET last_access = ? WHERE id = ?", (time.time(), ids[i][1]))
+                self._count("hits")
+                return {"scope": ids[i][0], "prompt": row[0], "similarity": round(float(similarities[i]), 4),
+                        "theme_json": json.loads(row[3]), "images": json.loads(row[4]), "job_id": row[5]}
+        self._count("misses")
+        return None
+
+    def add(self, prompt: str, scope: str, theme_json: dict, images: list, job_id: str = None):
+        now = time.time()
+        vector = prompt_vector(prompt, self.dim)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""INSERT OR REPLACE INTO prompt_index
+                                (scope, prompt_norm, prompt, key_terms, vector, theme_json, images, job_id,
+                                 created_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (scope, normalize_prompt(prompt), prompt, json.dumps(sorted(prompt_key_terms(prompt))),
+                          vector.tobytes(), json.dumps(theme_json), json.dumps(images), job_id, now, now))
+            evicted = 0
+            if self.ttl_seconds:
+                evicted += conn.execute("DELETE FROM prompt_index WHERE created_at < ?",
+                                        (now - self.ttl_seconds,)).rowcount
+            if self.max_entries:
+                evicted += conn.execute("""DELETE FROM prompt_index WHERE id NOT IN (
+                                               SELECT id FROM prompt_index ORDER BY last_access DESC LIMIT ?)""",
+                                        (self.max_entries,)).rowcount
+        self._count("writes")
+        if evicted: self._count("evictions", evicted)
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM prompt_index").fetchone()[0]
+        with self._lock:
+            return {**self._stats, "entries": entries}
+
+
+_prompt_index = None
+_prompt_index_lock = threading.Lock()
+
+
+def get_prompt_index():
+    """Process-wide index, or None when SEMANTIC_CACHE_MODE is off."""
+    global _prompt_index
+    if config.SEMANTIC_CACHE_MODE not in ("suggest", "reuse"):
+        return None
+    with _prompt_index_lock:
+        if _prompt_index is None:
+            _prompt_index = PromptIndex(config.SEMANTIC_CACHE_PATH, config.SEMANTIC_CACHE_MAX_ENTRIES,
+                                        config.SEMANTIC_CACHE_TTL_SECONDS, config.SEMANTIC_CACHE_DIM)
+        return _prompt_index
+
+
+def find_similar_flyer(prompt: str):
+    """
+    Closest earlier flyer for `prompt` among themes from any model routing may use (match["model"]),
+    with only the images whose files still exist; None on no match.
+    """
+    index = get_prompt_index()
+    scopes = {theme_scope(model): model for model in routed_models()}
+    match = index.nearest(prompt, list(scopes), config.SEMANTIC_CACHE_THRESHOLD) if index else None
+    if match:
+        match["model"] = scopes[match.pop("scope")]
+        match["images"] = [img for img in match["images"] if os.path.exists(img.get("original_path") or img["path"])]
+    return match
@@ -102,8 +102,8 @@ You are an **expert visual designer and HTML optimization engineer**. Your task
 2️⃣ **HTML Refinement:**
    - **MUST:** Directly modify the HTML flyer (`{html_final}`) to solve any noted issues (e.g., adjusting opacity, changing colors for contrast, fine-tuning element positions/sizes).
    - **CONSTRAINTS:**
-     - **DO NOT** add or remove image placeholders (``).
-     - **DO NOT** change the content of the image placeholders.
+     - **DO NOT** add, remove or change the `<img id="image-N">` elements or their `src`.
+     - **Keep every element `id`** (`shape-N`, `text-N`, `image-N`, `overlay`); restyle via the `<style>` classes or inline styles.
      - **DO NOT** change the actual text content (`"content"`).
      - **ONLY** adjust HTML attributes/styles for aesthetic improvement.
 
@@ -112,7 +112,7 @@ Return a single JSON object with your judgment and the improved HTML.
 
 {{ 
   "judgment": "A detailed critique of the current layout, specific changes made (e.g., 'Increased text shadow for contrast'), and the final score (Score: 8.5/10).", 
-  "edited_html": "<The complete, optimized HTML code, ready for image injection>" 
+  "edited_html": "<The complete, optimized HTML code>" 
 }}
 
 Here is the flyer HTML:
@@ -124,6 +124,40 @@ Images (for contextual reference; you cannot change them, only optimize their su
 **Refine HTML to harmonize text & images, guaranteeing excellent readability and a premium, layered appearance. Ensure shapes and text elements complement the overall visual flow.**
 """
 
+refinement_patch_prompt = """
+You are an **expert visual designer and HTML optimization engineer**. Your task is to refine a generated flyer to achieve **maximum visual impact, balance, and luxury aesthetics** while maintaining the image/text assets.
+
+1️⃣ **Critical Evaluation:**
+   - Review the flyer's layout, color harmony, typography pairing, and overall balance.
+   - Specifically, check for **readability and contrast** between text and the images/shapes behind it.
+   - Give a final **aesthetic score from 0–10** (10 being perfect high-end design).
+
+2️⃣ **Style Edits (do NOT return HTML):**
+   - Express every improvement as CSS declarations on an element `id` from the flyer below (`flyer`, `shape-N`, `text-N`, `image-N`, `overlay`).
+   - Each edit sets or overrides declarations; use `null` to remove a declaration. Wave shapes take their color from `fill`.
+   - **CONSTRAINTS:**
+     - **DO NOT** change text content or image sources; they are not editable.
+     - **ONLY** reference ids that exist in the flyer. Keep values plain CSS (no `;`, `{`, `}`, quotes or `url()`).
+
+3️⃣ **Return JSON:**
+Return a single JSON object and nothing else:
+
+{
+  "judgment": "A detailed critique of the current layout, the changes made (e.g., 'Increased text shadow for contrast'), and the final score (Score: 8.5/10).",
+  "score": 8.5,
+  "edits": [
+    {"id": "text-0", "style": {"text-shadow": "2px 4px 12px rgba(0,0,0,0.5)", "color": "#FFFFFF"}},
+    {"id": "shape-1", "style": {"opacity": "0.4"}}
+  ]
+}
+
+Here is the flyer HTML:
+{html_final}
+
+Images (for contextual reference; you cannot change them, only restyle the elements around them):
+{images_meta_str}
+"""
+
 DESCRIPTIVE_SUMMARY_PROMPT = """
 You are a **professional creative copywriter**.
 
@@ -140,4 +174,16 @@ Avoid technical words like 'div', 'hex', 'z-index', or 'HTML'.
 
 FLYER DATA (use this as the source for your descriptive summary):
 {flyer_data_json}
-"""
\ No newline at end of file
+"""
+
+JSON_REASK_PROMPT = """
+Your previous response could not be used as JSON. Problems found:
+{problems}
+
+Expected: one JSON object with the keys {expected_keys}. No markdown fences, no comments, no trailing commas, no text before or after the object.
+
+Return ONLY the corrected JSON object. Keep all the content of your previous response; fix only what is listed above.
+
+Previous response:
+{previous_response}
+"""
@@ -0,0 +1,209 @@
+import os, re
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageOps
+from core.flyer_ir import FlyerIR, build_flyer_ir, set_image_slot
+
+
+# -------------------------------
+# Browser-free flyer rasterizer (Pillow)
+# -------------------------------
+# Draws the flyer IR directly: background, shapes, waves, text and composited images. It covers
+# the subset of CSS the IR emits (absolute %/px boxes, translate(-50%,-50%) centering, opacity,
+# border-radius, z-index), which is enough for thumbnails, galleries and layout checks.
+
+def flyer_ir_for(state, refined: bool = False) -> FlyerIR:
+    """IR to render for a state: the refined IR if asked for, else the image-filled one (built from theme_json if absent)."""
+    data = (refined and getattr(state, "flyer_ir_refined", None)) or getattr(state, "flyer_ir", None)
+    if data:
+        return FlyerIR.from_dict(data)
+    ir = build_flyer_ir(state.theme_json)
+    for idx, img in enumerate(state.generated_images):
+        set_image_slot(ir, img.get("index", idx), img["path"])
+    return ir
+
+
+def _length(value, total: float, default: float = None):
+    value = str(value or "").strip()
+    match = re.match(r"^(-?[\d.]+)\s*(%|px)?$", value)
+    if not match:
+        return default
+    number = float(match.group(1))
+    return number * total / 100 if match.group(2) == "%" else number
+
+
+def _color(value, opacity: float = 1.0, default=(0, 0, 0)):
+    value = str(value or "").strip()
+    try:
+        rgb = ImageColor.getrgb(value)
+    except ValueError:
+        # Gradients and other non-solid paints: use their first color
+        match = re.search(r"#[0-9a-fA-F]{3,8}\b|rgba?\([^)]*\)", value)
+        try:
+            rgb = ImageColor.getrgb(match.group(0)) if match else default
+        except ValueError:
+            rgb = default
+    alpha = rgb[3] if len(rgb) == 4 else 255
+    return rgb[:3] + (int(alpha * max(0.0, min(opacity, 1.0))),)
+
+
+def _box(style: dict, width: float, height: float, scale: float):
+    """(left, top, right, bottom) in output pixels for an absolutely positioned element."""
+    w = _length(style.get("width"), width, 0) * scale
+    h = _length(style.get("height"), height, 0) * scale
+    if "inset" in style:
+        inset = _length(style["inset"], width, 0) * scale
+        return inset, inset, width * scale - inset, height * scale - inset
+    left = _length(style.get("left"), width)
+    top = _length(style.get("top"), height)
+    x = left * scale if left is not None else 0
+    if top is not None:
+        y = top * scale
+    elif _length(style.get("bottom"), height) is not None:
+        y = height * scale - _length(style["bottom"], height) * scale - h
+    else:
+        y = 0
+    if "translate(-50%,-50%)" in style.get("transform", "").replace(" ", ""):
+        x, y = x - w / 2, y - h / 2
+    return x, y, x + w, y + h
+
+
+def _radius(style: dict, box) -> float:
+    radius = str(style.get("border-radius", "0")).strip()
+    w, h = box[2] - box[0], box[3] - box[1]
+    if radius.endswith("%"):
+        return min(w, h) * min(float(radius[:-1] or 0), 50) / 100
+    return _length(radius, 0, 0)
+
+
+def _rounded_mask(size, radius: float) -> Image.Image:
+    mask = Image.new("L", size, 0)
+    if radius >= min(size) / 2:  # border-radius:50% on a non-square box is an ellipse
+        ImageDraw.Draw(mask).ellipse((0, 0, size[0] - 1, size[1] - 1), fill=255)
+    else:
+        ImageDraw.Draw(mask).rounded_rectangle((0, 0, size[0] - 1, size[1] - 1), radius=radius, fill=255)
+    return mask
+
+
+def _z_index(element) -> int:
+    try:
+        return int(element.style.get("z-index", 0))
+    except ValueError:
+        return 0
+
+
+_font_cache = {}
+
+
+def _font(size: int, bold: bool):
+    key = (size, bold)
+    if key not in _font_cache:
+        try:
+            _font_cache[key] = ImageFont.truetype("DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf", size)
+        except OSError:
+            _font_cache[key] = ImageFont.load_default(size=size)
+    return _font_cache[key]
+
+
+def _wave_points(box, edge: str, samples: int = 24) -> list:
+    # Same curve as the serialized <svg> (viewBox 0 0 800 240): M0,120 C200,40 400,200 800,120 L800,240 L0,240 Z
+    x0, y0, x1, y1 = box
+    sx, sy = (x1 - x0) / 800, (y1 - y0) / 240
+    points = []
+    for i in range(samples + 1):
+        t = i / samples
+        px = 3 * (1 - t) ** 2 * t * 200 + 3 * (1 - t) * t ** 2 * 400 + t ** 3 * 800
+        py = (1 - t) ** 3 * 120 + 3 * (1 - t) ** 2 * t * 40 + 3 * (1 - t) * t ** 2 * 200 + t ** 3 * 120
+        points.append((x0 + px * sx, y0 + py * sy))
+    points += [(x1, y1), (x0, y1)]
+    if edge == "top":  # Wave anchored to the top edge is drawn mirrored
+        points = [(x, y0 + y1 - y) for x, y in points]
+    return points
+
+
+def _draw_text(layer: Image.Image, element, box_origin, scale: float):
+    style = element.style
+    size = max(6, int(round(_length(style.get("font-size"), 0, 40) * scale)))
+    font = _font(size, style.get("font-weight") == "700")
+    color = style.get("color", "#000000")
+    if color == "transparent":
+        color = style.get("background", "#000000")
+    draw = ImageDraw.Draw(layer)
+    x, y = box_origin
+    anchor = "mm" if "translate(-50%,-50%)" in style.get("transform", "").replace(" ", "") else "la"
+    if style.get("text-shadow", "none") != "none":
+        offset = max(1, int(round(3 * scale)))
+        draw.text((x + offset, y + offset), element.content, font=font, fill=(0, 0, 0, 90), anchor=anchor)
+    draw.text((x, y), element.content, font=font, fill=_color(color), anchor=anchor)
+
+
+def _paste_image(canvas: Image.Image, element, box, cache: dict):
+    src = element.content
+    if not src or src.startswith("data:") or not os.path.exists(src):
+        return
+    w, h = max(1, int(round(box[2] - box[0]))), max(1, int(round(box[3] - box[1])))
+    if src not in cache:
+        with Image.open(src) as img:
+            img.draft("RGB", (w, h))  # JPEG decoders can downscale while decoding
+            cache[src] = img.convert("RGBA")
+    fitted = ImageOps.fit(cache[src], (w, h), Image.Resampling.BILINEAR)  # object-fit: cover
+    radius = _radius(element.style, box)
+    mask = _rounded_mask((w, h), radius) if radius else None
+    if mask is not None:
+        fitted.putalpha(Image.composite(fitted.getchannel("A"), Image.new("L", (w, h), 0), mask))
+    canvas.alpha_composite(fitted, (int(round(box[0])), int(round(box[1]))))
+
+
+def render_flyer(ir: FlyerIR, scale: float = 0.5) -> Image.Image:
+    """Rasterizes the flyer IR to an RGBA image of (ir.width*scale, ir.height*scale)."""
+    width, height = ir.width, ir.height
+    out_w, out_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+    canvas = Image.new("RGBA", (out_w, out_h), _color(ir.style.get("background", "#FFFFFF")))
+    images = {}
+
+    for element in sorted(ir.elements, key=_z_index):
+        style = element.style
+        opacity = float(_length(style.get("opacity"), 1, 1.0))
+        if element.kind == "overlay":
+            continue
+        box = _box(style, width, height, scale)
+
+        if element.kind == "image":
+            _paste_image(canvas, element, box, images)
+            continue
+
+        layer = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        if element.kind == "shape":
+            radius = _radius(style, box)
+            fill = _color(style.get("background", "#FFFFFF"), opacity)
+            if radius >= min(box[2] - box[0], box[3] - box[1]) / 2:
+                draw.ellipse(box, fill=fill)
+            else:
+                draw.rounded_rectangle(box, radius=radius, fill=fill)
+        elif element.kind == "wave":
+            edge = "top" if "top" in style else "bottom"
+            draw.polygon(_wave_points(box, edge), fill=_color(style.get("fill", "#FFFFFF"), opacity))
+        elif element.kind == "text" and element.content:
+            _draw_text(layer, element, (box[0], box[1]), scale)
+        canvas.alpha_composite(layer)
+
+    radius = _length(ir.style.get("border-radius"), 0, 0) * scale
+    if radius:
+        canvas.putalpha(Image.composite(canvas.getchannel("A"), Image.new("L", canvas.size, 0),
+                                        _rounded_mask(canvas.size, radius)))
+    return canvas
+
+
+def save_thumbnail(ir: FlyerIR, path: str, scale: float = 0.5, quality: int = 80) -> str:
+    """Renders and writes a PNG/WebP/JPEG thumbnail (format from the file extension)."""
+    folder = os.path.dirname(path)
+    if folder: os.makedirs(folder, exist_ok=True)
+    image = render_flyer(ir, scale)
+    if path.lower().endswith((".jpg", ".jpeg")):
+        flattened = Image.new("RGB", image.size, (255, 255, 255))
+        flattened.paste(image, mask=image.getchannel("A"))
+        flattened.save(path, quality=quality)
+    elif path.lower().endswith(".webp"):
+        image.save(path, quality=quality, method=4)
+    else:
+        image.save(path, optimize=False)
+    return path
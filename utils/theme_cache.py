@@ -0,0 +1,97 @@
+import os, re, json, time, sqlite3, hashlib, threading
+from contextlib import closing
+from core import config
+
+
+# -------------------------------
+# Persistent theme JSON cache (SQLite)
+# -------------------------------
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", (prompt or "").strip().lower())
+
+
+def theme_cache_key(prompt: str, model: str, temperature: float, template: str) -> str:
+    template_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()
+    payload = json.dumps({"prompt": normalize_prompt(prompt), "model": model,
+                          "temperature": temperature, "template": template_hash}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ThemeCache:
+    """Stores validated theme JSON keyed by prompt/model/template, with TTL and max-entries eviction."""
+
+    def __init__(self, db_path: str, ttl_seconds: float, max_entries: int):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        if os.path.dirname(db_path): os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS theme_cache (
+                                key TEXT PRIMARY KEY,
+                                theme_json TEXT NOT NULL,
+                                created_at REAL NOT NULL,
+                                last_access REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_theme_cache_access ON theme_cache(last_access)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self._stats[name] += n
+
+    def get(self, key: str):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT theme_json, created_at FROM theme_cache WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM theme_cache WHERE key = ?", (key,))
+                self._count("evictions")
+                row = None
+            if row:
+                conn.execute("UPDATE theme_cache SET last_access = ? WHERE key = ?", (now, key))
+        if not row:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return json.loads(row[0])
+
+    def put(self, key: str, theme_json: dict):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO theme_cache (key, theme_json, created_at, last_access) "
+                         "VALUES (?, ?, ?, ?)", (key, json.dumps(theme_json), now, now))
+            evicted = 0
+            if self.ttl_seconds:
+                evicted += conn.execute("DELETE FROM theme_cache WHERE created_at < ?",
+                                        (now - self.ttl_seconds,)).rowcount
+            if self.max_entries:
+                evicted += conn.execute("""DELETE FROM theme_cache WHERE key NOT IN (
+                                               SELECT key FROM theme_cache ORDER BY last_access DESC LIMIT ?)""",
+                                        (self.max_entries,)).rowcount
+        self._count("writes")
+        if evicted: self._count("evictions", evicted)
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM theme_cache").fetchone()[0]
+        with self._lock:
+            return {**self._stats, "entries": entries}
+
+
+_theme_cache = None
+_theme_cache_lock = threading.Lock()
+
+
+def get_theme_cache():
+    """Process-wide cache instance, or None when THEME_CACHE_ENABLED is off."""
+    global _theme_cache
+    if not config.THEME_CACHE_ENABLED:
+        return None
+    with _theme_cache_lock:
+        if _theme_cache is None:
+            _theme_cache = ThemeCache(config.THEME_CACHE_PATH, config.THEME_CACHE_TTL_SECONDS,
+                                      config.THEME_CACHE_MAX_ENTRIES)
+        return _theme_cache
@@ -0,0 +1,110 @@
+# worker.py
+#
+# Flyer generation worker. Owns the diffusion pipeline and the LLM clients for the whole process
+# and runs the jobs the Streamlit app submits to the local job queue (core/job_queue.py). Several
+# sessions therefore share one warm GPU model, and a browser refresh does not lose a running job.
+#
+# Usage:
+#   python worker.py                    (JOB_WORKER_CONCURRENCY jobs at a time)
+#   python worker.py --concurrency 3
+
+import os, sys, uuid, socket, argparse, threading
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from core import config
+from core.job_queue import get_job_queue
+from core.state import FlyerState
+from core.workflow import workflow_plan, stream_workflow, get_checkpoint_store, resume_point, rerun_from
+from models.diffusion_scheduler import configure_scheduler
+from models.llm_router import get_llm_router
+from utils.summary_utils import generate_summary
+
+
+class FlyerWorker:
+    def __init__(self, concurrency: int = None, poll_seconds: float = None, verbose: bool = False):
+        self.queue = get_job_queue()
+        self.store = get_checkpoint_store()
+        self.concurrency = max(1, concurrency or config.JOB_WORKER_CONCURRENCY)
+        configure_scheduler(self.concurrency)
+        self.poll_seconds = poll_seconds or config.JOB_QUEUE_POLL_SECONDS
+        self.verbose = verbose
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._running = 0
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _report(self, job_id: str, node: str, done: int, total: int, message: str):
+        # 10% when the job starts, 90% when the last graph node completes, 100% once finished
+        self.queue.progress(job_id, node, 10 + 80 * min(done, total) // max(total, 1), message)
+        if self.verbose: print(f"[{job_id}] {message}")
+
+    def run_job(self, job: dict):
+        job_id, options = job["job_id"], job["options"]
+        try:
+            if options.get("rerun_from"):
+                self._report(job_id, options["rerun_from"], 0, 1, f"Re-running from {options['rerun_from']}")
+                state = rerun_from(job_id, options["rerun_from"], self.store)
+            else:
+                # Jobs re-queued after a crash (or resumed from the UI) continue after their last checkpoint
+                state, start_at = resume_point(job_id, self.store)
+                if state is None:
+                    state = FlyerState(user_prompt=job["prompt"], api_provider=options.get("api_provider", "gemini"),
+                                       bypass_cache=options.get("bypass_cache", False), job_id=job_id)
+                if start_at is not None:
+                    order = [name for name, _ in workflow_plan()]
+                    done = order.index(start_at) if start_at in order else 0
+                    for node, state in stream_workflow(state, start_at=start_at, store=self.store):
+                        done += 1
+                        self._report(job_id, node, done, len(order), f"{node} complete")
+            state.flyer_summary = generate_summary(state.theme_json)
+            self.store.save(job_id, "summary", state)
+            self.queue.finish(job_id)
+        except Exception as e:
+            self.queue.finish(job_id, f"{type(e).__name__}: {e}")
+
+    def _slot(self):
+        while not self._stop.is_set():
+            job = self.queue.claim(self.worker_id)
+            if job is None:
+                self._stop.wait(self.poll_seconds)
+                continue
+            with self._running_lock:
+                self._running += 1
+            try:
+                self.run_job(job)
+            finally:
+                with self._running_lock:
+                    self._running -= 1
+
+    def run(self):
+        slots = [threading.Thread(target=self._slot, name=f"flyer-worker-{i}", daemon=True)
+                 for i in range(self.concurrency)]
+        for slot in slots: slot.start()
+        print(f"👷 Worker {self.worker_id} running {self.concurrency} job slot(s) on {config.JOB_QUEUE_PATH}")
+        try:
+            while not self._stop.is_set():
+                self.queue.worker_heartbeat(self.worker_id, self._running)
+                # Waiting jobs push the LLM router towards Flash
+                get_llm_router().observe_queue_depth(self.queue.counts().get("queued", 0))
+                requeued = self.queue.requeue_stale()
+                if requeued: print(f"♻️ Re-queued {requeued} job(s) from lost workers")
+                self._stop.wait(max(self.poll_seconds, 2.0))
+        except KeyboardInterrupt:
+            print("🛑 Stopping after the running jobs finish...")
+            self._stop.set()
+            for slot in slots: slot.join()
+        finally:
+            self.queue.remove_worker(self.worker_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued flyer jobs (submitted by the Streamlit app)")
+    parser.add_argument("--concurrency", type=int, default=config.JOB_WORKER_CONCURRENCY, help="Jobs run at a time")
+    parser.add_argument("--poll", type=float, default=config.JOB_QUEUE_POLL_SECONDS, help="Queue poll interval (s)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    FlyerWorker(args.concurrency, args.poll, args.verbose).run()
+
+
+if __name__ == "__main__":
+    main()